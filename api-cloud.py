@@ -1,18 +1,13 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import asyncio
 import uuid
 import datetime
-import copy
-import json
-import pickle
-import base64
 import sys
 import os
 import importlib.util
-from google.cloud import firestore
 
 # Add nodes directory to Python path with absolute path
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -41,7 +36,6 @@ def load_module(name, file_path):
 
 # Import LangGraph dependencies
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import InMemorySaver
 
 # Load agent modules from files
 try:
@@ -64,6 +58,7 @@ try:
     
     # Access components from the modules
     DietState = states_module.DietState
+    last_reply = states_module.last_reply
     intolerance_search = intolerancias_module.intolerance_search
     mensaje_intolerancias = mensaje_intolerancias_module.mensaje_intolerancias
     intolerancias_router = intolerancias_router_module.intolerancias_router
@@ -87,101 +82,17 @@ class MessageRequest(BaseModel):
     message: str
 
 class SessionResponse(BaseModel):
-    session_id: str
     sessions: List[str]
+    next_page_token: Optional[str] = None
+
+class NewSessionResponse(BaseModel):
+    session_id: str
 
 class MessageResponse(BaseModel):
     session_id: str
     response: str
     state: Dict[str, Any]
 
-# FirestoreSaver implementation
-class FirestoreSaver:
-    def __init__(self, 
-                 collection_name: str = "diet_conversations", 
-                 project_id: str = "diap3-458416",
-                 database_id: str = "agente-context-prueba"
-                ):
-        self.collection_name = collection_name
-        self.db = firestore.Client(project=project_id, database=database_id)
-        self._cache = {}
-        print(f"🔌 Connected to Firestore (database: {database_id}, collection: {collection_name})")
-    
-    def get(self, key: str) -> Optional[Dict]:
-        # Try to get from cache first
-        if key in self._cache:
-            return self._cache[key]
-        
-        # Try to get from Firestore
-        doc_ref = self.db.collection(self.collection_name).document(key)
-        doc = doc_ref.get()
-        
-        if not doc.exists:
-            return None
-        
-        data = doc.to_dict()
-        
-        # Deserialize pickled data if needed
-        if "pickled_data" in data:
-            pickled_data = base64.b64decode(data["pickled_data"])
-            state = pickle.loads(pickled_data)
-        else:
-            state = data
-            
-            # Restore numeric keys in diet structure
-            if "diet" in state and "diet_serialized" in state:
-                try:
-                    state["diet"] = json.loads(state["diet_serialized"])
-                    del state["diet_serialized"]
-                except:
-                    print("⚠️ Error deserializing diet")
-        
-        # Update cache
-        self._cache[key] = state
-        return state
-    
-    def put(self, key: str, value: Dict) -> None:
-        # Update cache
-        self._cache[key] = value
-        
-        # Create a copy to avoid modifying the original
-        firestore_value = copy.deepcopy(value)
-        
-        # Preprocess data to be compatible with Firestore
-        if "diet" in firestore_value and isinstance(firestore_value["diet"], dict):
-            try:
-                firestore_value["diet_serialized"] = json.dumps(firestore_value["diet"])
-                diet_simple = {}
-                for day, meals in firestore_value["diet"].items():
-                    day_str = f"día_{day}" if isinstance(day, int) else str(day)
-                    diet_simple[day_str] = {}
-                    for meal_name, items in meals.items():
-                        diet_simple[day_str][meal_name] = list(items.keys()) if isinstance(items, dict) else "Info no disponible"
-                
-                firestore_value["diet"] = diet_simple
-            except Exception as e:
-                print(f"⚠️ Error serializing diet: {e}")
-                firestore_value["diet"] = {}
-                firestore_value["diet_serialized"] = "{}"
-        
-        # Save to Firestore
-        doc_ref = self.db.collection(self.collection_name).document(key)
-        
-        try:
-            doc_ref.set(firestore_value)
-        except TypeError as e:
-            print(f"⚠️ Error saving to Firestore: {e}")
-            pickled_data = pickle.dumps(value)
-            encoded_data = base64.b64encode(pickled_data).decode('utf-8')
-            doc_ref.set({"pickled_data": encoded_data})
-    
-    def list_sessions(self):
-        try:
-            return [doc.id for doc in self.db.collection(self.collection_name).list_documents()]
-        except Exception as e:
-            print(f"Error listing sessions: {e}")
-            return []
-
 # Initialize FastAPI
 app = FastAPI(title="Diet Assistant API")
 
@@ -194,8 +105,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize Firestore Saver
+# Initialize Firestore Saver (shared with api.py and arquitecture.py); saves go through the write-behind queue
+from firestore_saver import FirestoreSaver, session_record
+from write_behind import WriteBehindQueue
+from firestore_checkpointer import create_checkpointer, turn_input
 firestore_saver = FirestoreSaver()
+write_behind = WriteBehindQueue(firestore_saver)
+
+@app.on_event("shutdown")
+def drain_write_behind():
+    """Write the session saves still queued before the process exits"""
+    write_behind.close()
 
 # Initialize agent graph
 workflow = StateGraph(DietState)
@@ -236,41 +156,24 @@ workflow.add_edge("hacer_lista_compra", "poner_precio")
 workflow.add_edge("poner_precio", END)
 workflow.add_edge("otros", END)
 
-# Compile the graph
-memory_saver = InMemorySaver()
-graph = workflow.compile(checkpointer=memory_saver)
+# Compile the graph with the persistent checkpointer (keeps only the latest checkpoints per session)
+checkpointer = create_checkpointer(db=firestore_saver.db)
+graph = workflow.compile(checkpointer=checkpointer)
 
 # API endpoints
 @app.get("/sessions", response_model=SessionResponse)
-async def list_sessions():
-    """List all available sessions"""
-    sessions = firestore_saver.list_sessions()
-    
-    # Create a new session ID if needed
-    if not sessions:
-        new_session_id = f"usuario_1"
-    else:
-        # Extract numbers from existing session IDs
-        user_numbers = []
-        for session in sessions:
-            try:
-                if session.startswith("usuario_"):
-                    num = int(session.split("_")[1])
-                    user_numbers.append(num)
-            except (ValueError, IndexError):
-                continue
-        
-        # Generate next session ID
-        next_number = max(user_numbers, default=0) + 1
-        new_session_id = f"usuario_{next_number}"
-    
-    return SessionResponse(
-        session_id=new_session_id,
-        sessions=sessions
-    )
+async def list_sessions(page_size: int = 50, page_token: Optional[str] = None):
+    """List sessions one page at a time (read only)"""
+    page = firestore_saver.list_sessions_page(page_size=min(max(page_size, 1), 500), start_after=page_token)
+    return SessionResponse(sessions=page["sessions"], next_page_token=page["next_page_token"])
+
+@app.post("/sessions", response_model=NewSessionResponse)
+def create_session():
+    """Reserve a new session ID from the atomic counter"""
+    return NewSessionResponse(session_id=firestore_saver.allocate_session_id())
 
 @app.post("/message", response_model=MessageResponse)
-async def process_message(request: MessageRequest, background_tasks: BackgroundTasks):
+async def process_message(request: MessageRequest):
     """Process a message and get a response from the agent"""
     
     # If no session_id provided, create a new one
@@ -279,55 +182,21 @@ async def process_message(request: MessageRequest, background_tasks: BackgroundT
     else:
         session_id = request.session_id
     
-    # Get current state or create new one
-    state = firestore_saver.get(session_id)
-    if state is None:
-        state = {
-            "messages": [],
-            "intolerances": [],
-            "forbidden_foods": [],
-            "diet": {},
-            "budget": None,
-            "info_dietas": "",
-            "grocery_list": [],
-            "metadata": {
-                "created_at": datetime.datetime.now().isoformat(),
-                "last_active": datetime.datetime.now().isoformat(),
-                "session_id": session_id
-            }
-        }
+    config = {"configurable": {"thread_id": session_id}}
     
-    # Update metadata
-    if "metadata" in state:
-        state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-    
-    # Add user message to state
-    state["messages"].append({"role": "user", "content": request.message})
-    prev_len = len(state["messages"])
+    # The checkpointer restores the session, so only the new message is sent
+    graph_input = turn_input(session_id, request.message)
     
     try:
-        # Process with the agent
-        result = graph.invoke(
-            state,
-            config={"configurable": {"thread_id": session_id}},
-        )
-        state = result  # Update state
-        
-        # Update metadata
-        if "metadata" in state:
-            state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
+        # Process with the agent; only the final checkpoint of the turn is stored
+        state = graph.invoke(graph_input, config=config, durability="exit")
         
         # Get assistant's response
-        new_msgs = state["messages"][prev_len:]
-        assistant_msgs = [m for m in new_msgs if m.get("role") == "assistant"]
-        
-        if assistant_msgs:
-            response_text = assistant_msgs[-1]['content']
-        else:
-            response_text = "No response from assistant"
+        response_text = last_reply(state["messages"]) or "No response from assistant"
         
-        # Save state in the background
-        background_tasks.add_task(firestore_saver.put, session_id, state)
+        # Save the session's messages and metadata in the background (the graph state is
+        # already in the checkpoint)
+        write_behind.submit(session_id, session_record(state))
         
         return MessageResponse(
             session_id=session_id,
@@ -336,13 +205,15 @@ async def process_message(request: MessageRequest, background_tasks: BackgroundT
         )
         
     except Exception as e:
-        # Log error and add to metadata
-        if "metadata" in state:
-            state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-            state["metadata"]["last_error"] = str(e)
-        
-        # Try to save state despite error
-        background_tasks.add_task(firestore_saver.put, session_id, state)
+        # Record the error on the last saved state of the session
+        state = dict(graph.get_state(config).values)
+        if state:
+            state["metadata"] = {
+                **state.get("metadata", {}),
+                "last_active": datetime.datetime.now().isoformat(),
+                "last_error": str(e),
+            }
+            write_behind.submit(session_id, session_record(state))
         
         # Print detailed error info
         import traceback
@@ -2,7 +2,6 @@ import streamlit as st
 import requests
 import json
 import pandas as pd
-import base64
 import os
 import sys
 from datetime import datetime
@@ -10,13 +9,19 @@ from datetime import datetime
 # Configure API endpoint
 API_URL = "http://localhost:8000"  # Update this with your API URL when deployed
 
-# Function to download a file
-def get_download_link(file_path, file_name):
-    with open(file_path, "rb") as file:
-        contents = file.read()
-    b64 = base64.b64encode(contents).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="{file_name}">Descargar {file_name}</a>'
-    return href
+# Grocery list export of a session, downloaded from the API (None if the session has none yet).
+# Cached per turn so reruns of the script do not hit the API again.
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_grocery_list(session_id, turn, prices=False, file_format="csv"):
+    try:
+        response = requests.get(
+            f"{API_URL}/sessions/{session_id}/grocery-list",
+            params={"format": file_format, "prices": int(prices)},
+            timeout=30
+        )
+    except requests.RequestException:
+        return None
+    return response.content if response.status_code == 200 else None
 
 # Set page config
 st.set_page_config(
@@ -30,16 +35,18 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
     
 if "session_id" not in st.session_state:
-    # Get available sessions from the API
+    # Get available sessions from the API and reserve a new session ID (GET /sessions is read only)
     try:
         response = requests.get(f"{API_URL}/sessions")
         if response.status_code == 200:
-            data = response.json()
-            st.session_state.available_sessions = data["sessions"]
-            st.session_state.session_id = data["session_id"]  # Default to the new session ID
+            st.session_state.available_sessions = response.json()["sessions"]
+            response = requests.post(f"{API_URL}/sessions")
+        if response.status_code == 200:
+            st.session_state.session_id = response.json()["session_id"]  # Default to the new session ID
         else:
             st.error(f"Error connecting to API: {response.text}")
-            st.session_state.available_sessions = []
+            if "available_sessions" not in st.session_state:
+                st.session_state.available_sessions = []
             st.session_state.session_id = "usuario_new"
     except Exception as e:
         st.error(f"Error connecting to API: {str(e)}")
@@ -78,7 +85,7 @@ with st.sidebar:
         if st.button("Crear Nueva Sesión"):
             # Get a new session ID from the API
             try:
-                response = requests.get(f"{API_URL}/sessions")
+                response = requests.post(f"{API_URL}/sessions")
                 if response.status_code == 200:
                     data = response.json()
                     st.session_state.session_id = data["session_id"]
@@ -96,22 +103,17 @@ with st.sidebar:
     # Check for CSV files to download
     st.subheader("Descargar Archivos")
     
-    lista_compra_path = "lista_compra.csv"
-    lista_compra_precio_path = "lista_compra_con_precio.csv"
-    
-    # Also check in nodes directory
-    nodes_lista_compra_path = os.path.join("nodes", "lista_compra.csv")
-    nodes_lista_compra_precio_path = os.path.join("nodes", "lista_compra_con_precio.csv")
-    
-    if os.path.exists(lista_compra_path):
-        st.markdown(get_download_link(lista_compra_path, "lista_compra.csv"), unsafe_allow_html=True)
-    elif os.path.exists(nodes_lista_compra_path):
-        st.markdown(get_download_link(nodes_lista_compra_path, "lista_compra.csv"), unsafe_allow_html=True)
-        
-    if os.path.exists(lista_compra_precio_path):
-        st.markdown(get_download_link(lista_compra_precio_path, "lista_compra_con_precio.csv"), unsafe_allow_html=True)
-    elif os.path.exists(nodes_lista_compra_precio_path):
-        st.markdown(get_download_link(nodes_lista_compra_precio_path, "lista_compra_con_precio.csv"), unsafe_allow_html=True)
+    turn = len(st.session_state.messages)
+    downloads = [
+        ("lista_compra.csv", False, "csv", "text/csv"),
+        ("lista_compra_con_precio.csv", True, "csv", "text/csv"),
+        ("lista_compra_con_precio.xlsx", True, "xlsx",
+         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ]
+    for file_name, prices, file_format, mime in downloads:
+        contents = fetch_grocery_list(st.session_state.session_id, turn, prices, file_format)
+        if contents:
+            st.download_button(f"Descargar {file_name}", contents, file_name=file_name, mime=mime)
     
     # About section
     st.subheader("Sobre el Asistente")
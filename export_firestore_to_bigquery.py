@@ -1,291 +1,60 @@
+"""
+Exporta las sesiones de Firestore (diet_conversations) a BigQuery (dataset analytics):
+conversations, grocery_items y meals.
+
+Las tres tablas se generan en una sola lectura de la colección. El estado de cada sesión
+(dieta, lista de la compra...) se lee de su último checkpoint; las sesiones que aún no se
+han migrado al checkpointer se leen del propio documento. Por defecto la exportación
+es incremental: solo se leen las sesiones con metadata.last_active posterior a la marca
+de la última exportación (guardada en {collection}_meta/bigquery_export), se cargan en
+tablas *_staging y se fusionan con MERGE en una transacción: las filas de las sesiones
+exportadas se sustituyen y el resto no se tocan.
+
+Las filas se escriben por lotes en ficheros Parquet (bq_export/*.parquet) con los tipos de
+los esquemas de BigQuery, y se cargan tal cual, sin convertirlas ni revalidarlas.
+
+--full vuelve a leer toda la colección y reemplaza las tablas (por ejemplo, para quitar
+las sesiones borradas de Firestore).
+
+Uso:
+    python export_firestore_to_bigquery.py
+    python export_firestore_to_bigquery.py --full
+    python export_firestore_to_bigquery.py --since 2025-05-01T00:00:00 --dry-run
+"""
+import argparse
+import datetime
 import os
+import sys
 import json
 import math
 import ast
-import re
+import pyarrow as pa
+import pyarrow.parquet as pq
 from google.cloud import firestore
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodes"))
+from firestore_saver import FirestoreSaver
+from firestore_checkpointer import create_checkpointer
+
 # --- CONFIGURATION ---
-SERVICE_ACCOUNT_FILE = "/Users/joaquin/Documents/GitHub/DATA_IA_PROJECT/diap3-458416-e2b338560b68.json"
+SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "/Users/joaquin/Documents/GitHub/DATA_IA_PROJECT/diap3-458416-e2b338560b68.json")
 PROJECT_ID = "diap3-458416"
+DATABASE_ID = "agente-context-prueba"
 COLLECTION_NAME = "diet_conversations"
 BQ_DATASET = "analytics"
+EXPORT_DIR = "bq_export"
+# Filas por row group de los ficheros Parquet (lo que se acumula en memoria por tabla)
+PARQUET_BATCH_ROWS = 50_000
 
-# --- AUTHENTICATION ---
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-db = firestore.Client(project=PROJECT_ID, credentials=credentials, database="agente-context-prueba")
-bq_client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
-
-# --- CREATE DATASET IF NEEDED ---
-dataset_ref = bq_client.dataset(BQ_DATASET)
-try:
-    bq_client.get_dataset(dataset_ref)
-    print(f"Dataset {BQ_DATASET} already exists")
-except Exception:
-    print(f"Creating dataset {BQ_DATASET}...")
-    dataset = bigquery.Dataset(dataset_ref)
-    bq_client.create_dataset(dataset)
+# Documento con la marca de agua de la exportación incremental
+EXPORT_STATE_DOC = "bigquery_export"
+# Margen hacia atrás en cada exportación: last_active lo pone la instancia al procesar el
+# turno y la escritura puede llegar a Firestore algo después (cola de escritura diferida)
+EXPORT_OVERLAP = datetime.timedelta(minutes=10)
 
-# --- UTILITY FUNCTIONS ---
-def json_serializable(obj):
-    """Convert special values to JSON-serializable format"""
-    if isinstance(obj, float) and (math.isnan(obj) or math.isinf(obj)):
-        return None
-    return obj
-
-def clean_string(s):
-    """Clean strings of any problematic characters"""
-    if not isinstance(s, str):
-        return s
-    # Replace any non-printable characters
-    return re.sub(r'[^\x20-\x7E]', '', s)
-
-def safe_json_dump(obj):
-    """Convert object to JSON safely, cleaning strings and handling special values"""
-    if isinstance(obj, dict):
-        return {k: safe_json_dump(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [safe_json_dump(item) for item in obj]
-    elif isinstance(obj, str):
-        return clean_string(obj)
-    elif isinstance(obj, float) and (math.isnan(obj) or math.isinf(obj)):
-        return None
-    else:
-        return obj
-
-# --- FETCH DOCUMENTS ---
-print("Fetching Firestore documents...")
-docs = db.collection(COLLECTION_NAME).stream()
-
-# --- PREPARE EXPORT DIRECTORY ---
-export_dir = "bq_export"
-os.makedirs(export_dir, exist_ok=True)
-
-# --- EXPORT CONVERSATIONS ---
-print("Exporting conversation metadata...")
-with open(f"{export_dir}/conversations.jsonl", "w") as f:
-    for doc in docs:
-        data = doc.to_dict()
-        doc_id = doc.id
-        
-        # Create a simplified conversation record
-        record = {
-            "document_id": doc_id,
-            "has_diet": "diet" in data,
-            "has_grocery_list": "grocery_list" in data,
-            "budget": str(data.get("budget", "")) if data.get("budget") is not None else "",
-            "intolerances": json.dumps(data.get("intolerances", [])) if isinstance(data.get("intolerances"), list) else str(data.get("intolerances", "")),
-            "forbidden_foods": json.dumps(data.get("forbidden_foods", [])) if isinstance(data.get("forbidden_foods"), list) else str(data.get("forbidden_foods", ""))
-        }
-        
-        # Clean and write as a single JSON line
-        clean_record = safe_json_dump(record)
-        try:
-            json_line = json.dumps(clean_record)
-            f.write(json_line + "\n")
-        except Exception as e:
-            print(f"Error serializing conversation for doc {doc_id}: {e}")
-
-# --- EXPORT GROCERY ITEMS ---
-print("Exporting grocery items...")
-docs = db.collection(COLLECTION_NAME).stream()
-
-with open(f"{export_dir}/grocery_items.jsonl", "w") as f:
-    for doc in docs:
-        data = doc.to_dict()
-        doc_id = doc.id
-        
-        grocery_list = data.get("grocery_list", [])
-        
-        if not grocery_list:
-            continue
-            
-        if isinstance(grocery_list, list):
-            for item_index, item in enumerate(grocery_list):
-                try:
-                    # Handle dictionary items
-                    if isinstance(item, dict):
-                        record = {
-                            "document_id": doc_id,
-                            "product": str(item.get("Producto", "")) if item.get("Producto") is not None else "",
-                            "quantity": float(item.get("Cantidad")) if item.get("Cantidad") is not None and not (isinstance(item.get("Cantidad"), float) and math.isnan(item.get("Cantidad"))) else None,
-                            "units": str(item.get("Unidades", "")) if item.get("Unidades") is not None else "",
-                            "matching_product": str(item.get("Producto_Coincidente", "")) if item.get("Producto_Coincidente") is not None else "",
-                            "estimated_price": float(item.get("Precio_Estimado")) if item.get("Precio_Estimado") is not None and not (isinstance(item.get("Precio_Estimado"), float) and math.isnan(item.get("Precio_Estimado"))) else None,
-                            "units_needed": float(item.get("Unidades_Necesarias")) if item.get("Unidades_Necesarias") is not None and not (isinstance(item.get("Unidades_Necesarias"), float) and math.isnan(item.get("Unidades_Necesarias"))) else None
-                        }
-                        
-                        # Clean and write as a single JSON line
-                        clean_record = safe_json_dump(record)
-                        json_line = json.dumps(clean_record)
-                        f.write(json_line + "\n")
-                    
-                    # Handle string items (format: "Product: quantity unit")
-                    elif isinstance(item, str) and ":" in item:
-                        parts = item.split(":", 1)
-                        if len(parts) == 2:
-                            product = parts[0].strip()
-                            qty_part = parts[1].strip().split(" ", 1)
-                            
-                            if len(qty_part) >= 1:
-                                try:
-                                    quantity = float(qty_part[0])
-                                    unit = qty_part[1] if len(qty_part) > 1 else ""
-                                    
-                                    record = {
-                                        "document_id": doc_id,
-                                        "product": product,
-                                        "quantity": quantity,
-                                        "units": unit,
-                                        "matching_product": "",
-                                        "estimated_price": None,
-                                        "units_needed": None
-                                    }
-                                    
-                                    # Clean and write as a single JSON line
-                                    clean_record = safe_json_dump(record)
-                                    json_line = json.dumps(clean_record)
-                                    f.write(json_line + "\n")
-                                except ValueError:
-                                    print(f"Could not parse quantity from: {item}")
-                except Exception as e:
-                    print(f"Error with grocery item {item_index} in doc {doc_id}: {e}")
-
-# --- EXPORT DIET MEALS ---
-print("Exporting meal data...")
-docs = db.collection(COLLECTION_NAME).stream()
-
-with open(f"{export_dir}/meals.jsonl", "w") as f:
-    for doc in docs:
-        data = doc.to_dict()
-        doc_id = doc.id
-        
-        # Function to process diet dictionaries
-        def process_diet_dict(diet_dict, doc_id):
-            meals_found = 0
-            try:
-                # Process each day's meals
-                for day, day_meals in diet_dict.items():
-                    for meal_type, meal_items in day_meals.items():
-                        for food_item, food_details in meal_items.items():
-                            # Extract quantity and unit from tuple
-                            if isinstance(food_details, tuple) and len(food_details) == 2:
-                                quantity, unit = food_details
-                                record = {
-                                    "document_id": doc_id,
-                                    "day": int(day),
-                                    "meal_type": str(meal_type),
-                                    "food_item": str(food_item),
-                                    "quantity": float(quantity),
-                                    "unit": str(unit)
-                                }
-                                
-                                # Clean and write as a single JSON line
-                                clean_record = safe_json_dump(record)
-                                json_line = json.dumps(clean_record)
-                                f.write(json_line + "\n")
-                                meals_found += 1
-            except Exception as e:
-                print(f"Error processing meals in doc {doc_id}: {e}")
-            return meals_found
-        
-        # First try to find diet in the assistant messages
-        if "assistant_messages" in data:
-            for msg in data.get("assistant_messages", []):
-                if isinstance(msg, str) and "¡Aquí tienes tu dieta" in msg:
-                    try:
-                        # Find the diet dictionary in the string
-                        diet_str = msg.split("\n", 1)[1] if "\n" in msg else ""
-                        if diet_str:
-                            # Try to parse the diet dictionary
-                            try:
-                                diet_dict = ast.literal_eval(diet_str)
-                                meals_found = process_diet_dict(diet_dict, doc_id)
-                                if meals_found > 0:
-                                    print(f"Found {meals_found} meals in assistant_messages for doc {doc_id}")
-                            except (SyntaxError, ValueError) as e:
-                                print(f"Could not parse diet in assistant_messages for doc {doc_id}: {e}")
-                    except Exception as e:
-                        print(f"Error processing assistant message in doc {doc_id}: {e}")
-        
-        # Check messages array
-        if "messages" in data:
-            for msg in data.get("messages", []):
-                if isinstance(msg, dict) and msg.get("role") == "assistant" and "¡Aquí tienes tu dieta" in msg.get("content", ""):
-                    try:
-                        # Find the diet dictionary in the string
-                        diet_str = msg.get("content", "").split("\n", 1)[1] if "\n" in msg.get("content", "") else ""
-                        if diet_str:
-                            # Try to parse the diet dictionary
-                            try:
-                                diet_dict = ast.literal_eval(diet_str)
-                                meals_found = process_diet_dict(diet_dict, doc_id)
-                                if meals_found > 0:
-                                    print(f"Found {meals_found} meals in messages for doc {doc_id}")
-                            except (SyntaxError, ValueError) as e:
-                                print(f"Could not parse diet in messages for doc {doc_id}: {e}")
-                    except Exception as e:
-                        print(f"Error processing message in doc {doc_id}: {e}")
-        
-        # Check conversation array
-        if "conversation" in data:
-            for msg in data.get("conversation", []):
-                if isinstance(msg, dict) and msg.get("role") == "assistant" and "¡Aquí tienes tu dieta" in msg.get("content", ""):
-                    try:
-                        # Find the diet dictionary in the string
-                        diet_str = msg.get("content", "").split("\n", 1)[1] if "\n" in msg.get("content", "") else ""
-                        if diet_str:
-                            # Try to parse the diet dictionary
-                            try:
-                                diet_dict = ast.literal_eval(diet_str)
-                                meals_found = process_diet_dict(diet_dict, doc_id)
-                                if meals_found > 0:
-                                    print(f"Found {meals_found} meals in conversation for doc {doc_id}")
-                            except (SyntaxError, ValueError) as e:
-                                print(f"Could not parse diet in conversation for doc {doc_id}: {e}")
-                    except Exception as e:
-                        print(f"Error processing conversation in doc {doc_id}: {e}")
-
-# --- VALIDATE EXPORTED FILES ---
-print("Validating exported JSONL files...")
-
-def validate_jsonl_file(file_path):
-    """Validate each line in the JSONL file to ensure it's valid JSON"""
-    if not os.path.exists(file_path):
-        print(f"File does not exist: {file_path}")
-        return False
-    
-    print(f"Validating {file_path}...")
-    valid_lines = []
-    line_count = 0
-    
-    with open(file_path, "r") as f:
-        for i, line in enumerate(f):
-            line_count += 1
-            try:
-                # Attempt to parse the JSON
-                json.loads(line)
-                valid_lines.append(line)
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON at line {i+1}: {e}")
-                print(f"Problematic line: {line[:100]}...")
-    
-    # Write back only the valid lines
-    with open(file_path, "w") as f:
-        for line in valid_lines:
-            f.write(line)
-    
-    print(f"Validated {file_path}: {len(valid_lines)} valid lines out of {line_count}")
-    return len(valid_lines) > 0
-
-# Validate all files
-conversations_valid = validate_jsonl_file(f"{export_dir}/conversations.jsonl")
-grocery_items_valid = validate_jsonl_file(f"{export_dir}/grocery_items.jsonl")
-meals_valid = validate_jsonl_file(f"{export_dir}/meals.jsonl")
-
-# --- DEFINE TABLE SCHEMAS ---
+# --- TABLE SCHEMAS ---
 conversations_schema = [
     bigquery.SchemaField("document_id", "STRING"),
     bigquery.SchemaField("has_diet", "BOOLEAN"),
@@ -314,48 +83,352 @@ meals_schema = [
     bigquery.SchemaField("unit", "STRING")
 ]
 
-# --- UPLOAD FILES TO BIGQUERY ---
-print("Uploading data to BigQuery...")
+TABLES = {
+    "conversations": conversations_schema,
+    "grocery_items": grocery_items_schema,
+    "meals": meals_schema,
+}
+
+# Tipos Arrow de los ficheros Parquet, derivados de los esquemas de BigQuery
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "BOOLEAN": pa.bool_(),
+    "FLOAT": pa.float64(),
+    "INTEGER": pa.int64(),
+}
+
+def arrow_schema(schema):
+    return pa.schema([pa.field(field.name, ARROW_TYPES[field.field_type]) for field in schema])
 
-# Helper function to load data from file
-def load_table_from_file(table_name, schema, file_path):
-    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+# --- UTILITY FUNCTIONS ---
+def json_serializable(obj):
+    """Convert special values to JSON-serializable format"""
+    if isinstance(obj, float) and (math.isnan(obj) or math.isinf(obj)):
+        return None
+    return obj
+
+def to_float(value):
+    """float() for numbers, None for missing or NaN values"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return float(value)
+
+# --- RECORD BUILDERS ---
+def conversation_record(doc_id, data):
+    """Simplified conversation record"""
+    return {
+        "document_id": doc_id,
+        "has_diet": "diet" in data,
+        "has_grocery_list": "grocery_list" in data,
+        "budget": str(data.get("budget", "")) if data.get("budget") is not None else "",
+        "intolerances": json.dumps(data.get("intolerances", []), ensure_ascii=False) if isinstance(data.get("intolerances"), list) else str(data.get("intolerances", "")),
+        "forbidden_foods": json.dumps(data.get("forbidden_foods", []), ensure_ascii=False) if isinstance(data.get("forbidden_foods"), list) else str(data.get("forbidden_foods", ""))
+    }
+
+def grocery_records(doc_id, data):
+    """One record per grocery list item"""
+    grocery_list = data.get("grocery_list", [])
+    if not isinstance(grocery_list, list):
+        return
+
+    for item_index, item in enumerate(grocery_list):
+        try:
+            # Handle dictionary items
+            if isinstance(item, dict):
+                yield {
+                    "document_id": doc_id,
+                    "product": str(item.get("Producto", "")) if item.get("Producto") is not None else "",
+                    "quantity": to_float(item.get("Cantidad")),
+                    "units": str(item.get("Unidades", "")) if item.get("Unidades") is not None else "",
+                    "matching_product": str(item.get("Producto_Coincidente", "")) if item.get("Producto_Coincidente") is not None else "",
+                    "estimated_price": to_float(item.get("Precio_Estimado")),
+                    "units_needed": to_float(item.get("Unidades_Necesarias"))
+                }
+
+            # Handle string items (format: "Product: quantity unit")
+            elif isinstance(item, str) and ":" in item:
+                product, qty = item.split(":", 1)
+                qty_part = qty.strip().split(" ", 1)
+                try:
+                    quantity = float(qty_part[0])
+                except ValueError:
+                    print(f"Could not parse quantity from: {item}")
+                    continue
+                yield {
+                    "document_id": doc_id,
+                    "product": product.strip(),
+                    "quantity": quantity,
+                    "units": qty_part[1] if len(qty_part) > 1 else "",
+                    "matching_product": "",
+                    "estimated_price": None,
+                    "units_needed": None
+                }
+        except Exception as e:
+            print(f"Error with grocery item {item_index} in doc {doc_id}: {e}")
+
+def diet_records(doc_id, diet_dict):
+    """One record per food item of a diet {day: {meal: {food: (quantity, unit)}}}"""
+    records = []
+    try:
+        for day, day_meals in diet_dict.items():
+            for meal_type, meal_items in day_meals.items():
+                for food_item, food_details in meal_items.items():
+                    # Extract quantity and unit from tuple
+                    if isinstance(food_details, (tuple, list)) and len(food_details) == 2:
+                        quantity, unit = food_details
+                        records.append({
+                            "document_id": doc_id,
+                            "day": int(day),
+                            "meal_type": str(meal_type),
+                            "food_item": str(food_item),
+                            "quantity": float(quantity),
+                            "unit": str(unit)
+                        })
+    except Exception as e:
+        print(f"Error processing meals in doc {doc_id}: {e}")
+    return records
+
+def meal_records(doc_id, data):
+    """Meals of the session's diet; old sessions without a stored diet are parsed from their messages"""
+    if isinstance(data.get("diet"), dict) and data["diet"]:
+        return diet_records(doc_id, data["diet"])
+
+    records = []
+    for field in ("assistant_messages", "messages", "conversation"):
+        for msg in data.get(field) or []:
+            content = msg if isinstance(msg, str) else msg.get("content", "") if isinstance(msg, dict) and msg.get("role") == "assistant" else ""
+            if not isinstance(content, str) or "¡Aquí tienes tu dieta" not in content or "\n" not in content:
+                continue
+            try:
+                # The diet dictionary follows the first line of the message
+                found = diet_records(doc_id, ast.literal_eval(content.split("\n", 1)[1]))
+                if found:
+                    print(f"Found {len(found)} meals in {field} for doc {doc_id}")
+                records.extend(found)
+            except (SyntaxError, ValueError) as e:
+                print(f"Could not parse diet in {field} for doc {doc_id}: {e}")
+    return records
+
+# --- FIRESTORE ---
+def read_watermark(db):
+    doc = db.collection(f"{COLLECTION_NAME}_meta").document(EXPORT_STATE_DOC).get()
+    return (doc.to_dict() or {}).get("last_active") if doc.exists else None
+
+def save_watermark(db, last_active, sessions):
+    db.collection(f"{COLLECTION_NAME}_meta").document(EXPORT_STATE_DOC).set({
+        "last_active": last_active,
+        "sessions": sessions,
+        "exported_at": firestore.SERVER_TIMESTAMP,
+    })
+
+def changed_sessions(db, since):
+    """Session documents active after `since` (all of them if since is None)"""
+    collection = db.collection(COLLECTION_NAME)
+    if since is None:
+        return collection.stream()
+    start = (datetime.datetime.fromisoformat(since) - EXPORT_OVERLAP).isoformat()
+    return collection.where("metadata.last_active", ">", start).stream()
+
+class ParquetTableWriter:
+    """
+    Writes records to a Parquet file with a fixed schema, PARQUET_BATCH_ROWS rows at a time
+    (one row group per batch). No file is left behind if no record is written.
+    """
+
+    def __init__(self, path, schema, batch_rows=PARQUET_BATCH_ROWS):
+        self.path = path
+        self.schema = arrow_schema(schema)
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._columns = {name: [] for name in self.schema.names}
+        self._buffered = 0
+        self._writer = None
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, record):
+        for name, values in self._columns.items():
+            values.append(record.get(name))
+        self._buffered += 1
+        if self._buffered >= self.batch_rows:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        return self.rows
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        batch = pa.RecordBatch.from_pydict(self._columns, schema=self.schema)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self.schema, compression="zstd")
+        self._writer.write_batch(batch)
+        self.rows += self._buffered
+        self._columns = {name: [] for name in self.schema.names}
+        self._buffered = 0
+
+def session_state(saver, checkpointer, doc_id, raw):
+    """Graph state of a session: its latest checkpoint, or the state stored in the document"""
+    checkpoint = checkpointer.get_tuple({"configurable": {"thread_id": doc_id, "checkpoint_ns": ""}})
+    if checkpoint is not None:
+        return checkpoint.checkpoint["channel_values"]
+    # Chunked, packed and legacy documents are decoded like the agent did
+    return saver.decode_document(doc_id, raw)
+
+def export_sessions(saver, checkpointer, docs, export_dir):
+    """
+    Write the three Parquet files in a single pass over the documents.
+    Returns (exported document ids, highest metadata.last_active seen, rows per table).
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    writers = {table: ParquetTableWriter(f"{export_dir}/{table}.parquet", schema) for table, schema in TABLES.items()}
+    exported, high_water = [], None
+
+    def write(table, record):
+        # Parquet strings are UTF-8, so names with accents (piñones, jamón) are written as they are
+        writers[table].write({name: json_serializable(value) for name, value in record.items()})
+
+    try:
+        for doc in docs:
+            doc_id = doc.id
+            raw = doc.to_dict() or {}
+            try:
+                data = session_state(saver, checkpointer, doc_id, raw)
+            except Exception as e:
+                print(f"Error decoding doc {doc_id}: {e}")
+                continue
+
+            write("conversations", conversation_record(doc_id, data))
+            for record in grocery_records(doc_id, data):
+                write("grocery_items", record)
+            for record in meal_records(doc_id, data):
+                write("meals", record)
+
+            exported.append(doc_id)
+            last_active = (raw.get("metadata") or {}).get("last_active")
+            if isinstance(last_active, str) and (high_water is None or last_active > high_water):
+                high_water = last_active
+    finally:
+        counts = {table: writer.close() for table, writer in writers.items()}
+
+    return exported, high_water, counts
+
+# --- BIGQUERY ---
+def ensure_dataset(bq_client):
+    dataset_ref = bq_client.dataset(BQ_DATASET)
+    try:
+        bq_client.get_dataset(dataset_ref)
+        print(f"Dataset {BQ_DATASET} already exists")
+    except Exception:
+        print(f"Creating dataset {BQ_DATASET}...")
+        bq_client.create_dataset(bigquery.Dataset(dataset_ref))
+
+def table_id(table_name):
+    return f"{PROJECT_ID}.{BQ_DATASET}.{table_name}"
+
+def load_table_from_file(bq_client, table_name, schema, file_path, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE):
+    """Load a Parquet file into a table; without a file the table is left empty, with the schema"""
+    if not os.path.exists(file_path):
         print(f"No data to load for {table_name}")
+        if write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE:
+            bq_client.delete_table(table_id(table_name), not_found_ok=True)
+        bq_client.create_table(bigquery.Table(table_id(table_name), schema=schema), exists_ok=True)
         return
-    
-    table_id = f"{PROJECT_ID}.{BQ_DATASET}.{table_name}"
-    
+
     # Configure the load job
     job_config = bigquery.LoadJobConfig(
-        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        source_format=bigquery.SourceFormat.PARQUET,
         schema=schema,
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-        max_bad_records=10  # Allow some bad records
+        write_disposition=write_disposition
     )
-    
+
     print(f"Loading data into {table_name}...")
-    
-    # Load the file
     with open(file_path, "rb") as source_file:
-        job = bq_client.load_table_from_file(
-            source_file,
-            table_id,
-            job_config=job_config
-        )
-    
-    # Wait for the job to complete
+        job = bq_client.load_table_from_file(source_file, table_id(table_name), job_config=job_config)
     job.result()
-    
-    # Get loaded rows count
-    table = bq_client.get_table(table_id)
+
+    table = bq_client.get_table(table_id(table_name))
     print(f"Loaded {table.num_rows} rows into {table_name}")
 
-# Load all tables
-if conversations_valid:
-    load_table_from_file("conversations", conversations_schema, f"{export_dir}/conversations.jsonl")
-if grocery_items_valid:
-    load_table_from_file("grocery_items", grocery_items_schema, f"{export_dir}/grocery_items.jsonl")
-if meals_valid:
-    load_table_from_file("meals", meals_schema, f"{export_dir}/meals.jsonl")
+def merge_staging(bq_client):
+    """
+    Merge the *_staging tables into the targets in one transaction: conversations are
+    upserted by document_id, and the grocery items and meals of every exported session
+    are replaced by the staged ones.
+    """
+    for table_name, schema in TABLES.items():
+        bq_client.create_table(bigquery.Table(table_id(table_name), schema=schema), exists_ok=True)
+
+    columns = [field.name for field in conversations_schema if field.name != "document_id"]
+    exported_ids = f"SELECT document_id FROM `{table_id('conversations_staging')}`"
+    statements = [f"""
+        MERGE `{table_id('conversations')}` T
+        USING `{table_id('conversations_staging')}` S
+        ON T.document_id = S.document_id
+        WHEN MATCHED THEN UPDATE SET {', '.join(f'{c} = S.{c}' for c in columns)}
+        WHEN NOT MATCHED THEN INSERT ROW;"""]
+    # Child rows have no key of their own: those of the exported sessions are replaced
+    for table_name in ("grocery_items", "meals"):
+        statements.append(f"""
+        DELETE FROM `{table_id(table_name)}` WHERE document_id IN ({exported_ids});
+        INSERT INTO `{table_id(table_name)}` SELECT * FROM `{table_id(table_name + '_staging')}`;""")
+
+    script = "BEGIN TRANSACTION;" + "".join(statements) + "\nCOMMIT TRANSACTION;"
+    print("Merging staging tables...")
+    bq_client.query(script).result()
+
+    for table_name in TABLES:
+        bq_client.delete_table(table_id(f"{table_name}_staging"), not_found_ok=True)
+
+# --- MAIN ---
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="Export every session and replace the tables")
+    parser.add_argument("--since", help="Export sessions active after this ISO timestamp instead of the saved mark")
+    parser.add_argument("--dry-run", action="store_true", help="Only write the Parquet files (no BigQuery, mark not updated)")
+    parser.add_argument("--export-dir", default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    # --- AUTHENTICATION ---
+    credentials = None
+    if os.path.exists(SERVICE_ACCOUNT_FILE):
+        credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+    db = firestore.Client(project=PROJECT_ID, credentials=credentials, database=DATABASE_ID)
+    saver = FirestoreSaver(collection_name=COLLECTION_NAME, project_id=PROJECT_ID, database_id=DATABASE_ID, db=db)
+    checkpointer = create_checkpointer(db=db)
+
+    since = None if args.full else (args.since or read_watermark(db))
+    print(f"Fetching Firestore documents ({'all' if since is None else f'active since {since}'})...")
+    exported, high_water, counts = export_sessions(saver, checkpointer, changed_sessions(db, since), args.export_dir)
+    print(f"Exported {len(exported)} sessions: " + ", ".join(f"{n} {t}" for t, n in counts.items()))
+
+    if args.dry_run:
+        return
+    if not exported:
+        print("No sessions changed since the last export")
+        return
+
+    bq_client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+    ensure_dataset(bq_client)
+
+    print("Uploading data to BigQuery...")
+    if since is None:
+        # Full export: replace the tables
+        for table_name, schema in TABLES.items():
+            load_table_from_file(bq_client, table_name, schema, f"{args.export_dir}/{table_name}.parquet")
+    else:
+        for table_name, schema in TABLES.items():
+            load_table_from_file(bq_client, f"{table_name}_staging", schema, f"{args.export_dir}/{table_name}.parquet")
+        merge_staging(bq_client)
+
+    # Only move the mark forward once BigQuery has the data
+    if high_water and (since is None or high_water > since):
+        save_watermark(db, high_water, len(exported))
+    print("Export process completed successfully!")
+
 
-print("Export process completed successfully!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
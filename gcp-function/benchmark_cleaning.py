@@ -0,0 +1,108 @@
+"""
+Benchmark de la limpieza de nombres de producto antes de buscar en OpenFoodFacts.
+
+Compara, sobre mercadona_products.csv (o el CSV que se indique):
+  - legacy: la versión anterior, ocho re.sub por nombre en un bucle de Python
+  - scalar: clean_product_name_for_search con el patrón precompilado, nombre a nombre
+  - vectorised: normalize_products (marca + nombre limpio + precio) sobre el DataFrame entero
+
+y cuenta cuántos nombres limpios difieren de la versión anterior.
+
+Uso:
+    python benchmark_cleaning.py
+    python benchmark_cleaning.py --csv mercadona_products.csv --repeat 5 --scale 10
+"""
+import argparse
+import io
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+# Sin clientes de GCP: el benchmark no necesita credenciales ni red
+os.environ.setdefault("OFF_OFFLINE", "1")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from main import (MERCADONA_BRANDS, clean_product_name_for_search, detect_encoding, find_price_column,
+                  normalize_products)
+
+
+def legacy_clean_product_name_for_search(product_name, brand_to_remove=None):
+    """Versión anterior, para comparar resultados y tiempos"""
+    if not isinstance(product_name, str):
+        return ""
+    name = product_name.lower()
+    if brand_to_remove:
+        name = name.replace(brand_to_remove.lower(), "")
+
+    name = re.sub(r'\b\d+\s*bricks?\s*x\s*\d+\s*g\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\bp(ie|aquete|ieza)\s*\d+\s*g\s*(aprox\.?)?\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\b(paquete|bolsa|tarrina|bandeja|brick)\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\b\d+\s*ud(s)?\.?\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\b\d+x\d+\s*g\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\b\d+(\.\d+)?\s*(g|kg|l|ml)\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\baprox\.?\b', '', name, flags=re.IGNORECASE).strip()
+    name = re.sub(r'\s+', ' ', name).strip()
+
+    if not name or len(name.split()) < 1:
+        name = product_name.lower()
+        if brand_to_remove:
+            name = name.replace(brand_to_remove.lower(), "").strip()
+        name = " ".join(name.split()[:3])
+    return name
+
+
+def detect_brand(name):
+    lower = name.lower() if isinstance(name, str) else ""
+    return next((brand for brand in MERCADONA_BRANDS if brand in lower), None)
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mercadona_products.csv"))
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones por variante (se toma la mejor)")
+    parser.add_argument("--scale", type=int, default=1, help="Replica el CSV N veces para simular un catálogo mayor")
+    args = parser.parse_args()
+
+    with open(args.csv, "rb") as f:
+        content = f.read()
+    df = pd.read_csv(io.StringIO(content.decode(detect_encoding(content))))
+    df = pd.concat([df] * args.scale, ignore_index=True)
+    names = df["Nombre"].tolist()
+    print(f"📦 {len(df)} productos de {args.csv}\n")
+
+    legacy_s, legacy = best_of(
+        lambda: [legacy_clean_product_name_for_search(n, detect_brand(n)) for n in names], args.repeat)
+    scalar_s, scalar = best_of(
+        lambda: [clean_product_name_for_search(n, detect_brand(n)) for n in names], args.repeat)
+    price_col = find_price_column(df.columns)
+    vector_s, normalized = best_of(lambda: normalize_products(df.copy(), price_col), args.repeat)
+    vectorised = normalized["_search_name"].tolist()
+
+    print(f"{'variante':<12} {'tiempo (ms)':>12} {'µs/nombre':>10} {'speedup':>8} {'distintos':>10}")
+    for label, seconds, result in [("legacy", legacy_s, legacy), ("scalar", scalar_s, scalar),
+                                   ("vectorised", vector_s, vectorised)]:
+        mismatches = sum(a != b for a, b in zip(legacy, result))
+        print(f"{label:<12} {seconds * 1000:>12.1f} {seconds / len(names) * 1e6:>10.1f} "
+              f"{legacy_s / seconds:>7.1f}x {mismatches:>10}")
+    print("\n(vectorised incluye además la detección de marca y el parseo del precio)")
+
+    examples = [(n, a, b) for n, a, b in zip(names, legacy, vectorised) if a != b][:10]
+    if examples:
+        print("\n⚠️ Nombres que cambian respecto a la versión anterior:")
+        for name, old, new in examples:
+            print(f"  {name!r}: {old!r} -> {new!r}")
+
+
+if __name__ == "__main__":
+    main()
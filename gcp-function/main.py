@@ -1,16 +1,25 @@
 import csv
+import hashlib
 import json
+import math
 import time
 import logging
 import os
+import random
+import sqlite3
+import threading
+import io
 import pandas as pd
 import requests
-from io import StringIO
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import chardet
 import re
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 from google.cloud import storage
-import pandas_gbq
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime
 
 # Configure logging
@@ -21,28 +30,268 @@ logger = logging.getLogger(__name__)
 OFF_API_SEARCH_V1_URL = "https://world.openfoodfacts.org/cgi/search.pl"
 OFF_API_PRODUCT_V2_URL_TEMPLATE = "https://world.openfoodfacts.org/api/v2/product/{barcode}.json"
 
-SLEEP_TIME = 6
 USER_AGENT = os.environ.get('USER_AGENT', "MercadonaProductEnricher/1.2") 
 MERCADONA_BRANDS = ["hacendado"]
 
+# OpenFoodFacts rate limits (requests per minute): 100 for product lookups, 10 for searches
+OFF_PRODUCT_RATE_PER_MIN = float(os.environ.get('OFF_PRODUCT_RATE_PER_MIN', '100'))
+OFF_SEARCH_RATE_PER_MIN = float(os.environ.get('OFF_SEARCH_RATE_PER_MIN', '10'))
+ENRICH_WORKERS = int(os.environ.get('ENRICH_WORKERS', '8'))
+REQUEST_TIMEOUT = float(os.environ.get('OFF_REQUEST_TIMEOUT', '20'))
+MAX_RETRIES = int(os.environ.get('OFF_MAX_RETRIES', '4'))
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+# Local cache of OpenFoodFacts lookups (SQLite). Matches are reused for OFF_CACHE_TTL_DAYS and
+# "not found" answers for OFF_CACHE_NEGATIVE_TTL_DAYS. OFF_CACHE_BLOB keeps the file in the
+# bucket between runs (empty to disable). With OFF_OFFLINE=1 lookups are answered only from the
+# cache, whatever its age, and the job enriches OFFLINE_INPUT_CSV into OFFLINE_OUTPUT_CSV
+# without touching the network.
+OFF_CACHE_PATH = os.environ.get('OFF_CACHE_PATH', 'off_cache.sqlite')
+OFF_CACHE_TTL_DAYS = float(os.environ.get('OFF_CACHE_TTL_DAYS', '30'))
+OFF_CACHE_NEGATIVE_TTL_DAYS = float(os.environ.get('OFF_CACHE_NEGATIVE_TTL_DAYS', '7'))
+OFF_CACHE_BLOB = os.environ.get('OFF_CACHE_BLOB', 'cache/off_cache.sqlite')
+OFF_OFFLINE = os.environ.get('OFF_OFFLINE', '').lower() in ('1', 'true', 'yes')
+OFFLINE_INPUT_CSV = os.environ.get('OFFLINE_INPUT_CSV', 'mercadona_products.csv')
+OFFLINE_OUTPUT_CSV = os.environ.get('OFFLINE_OUTPUT_CSV', 'mercadona_enriched_offline.csv')
+
 # GCP Configuration from environment variables
 GCP_PROJECT = os.environ.get('GCP_PROJECT', 'diap3-458416')
 GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'bucket_csv_scraper')
 GCS_FILE_NAME = os.environ.get('GCS_FILE_NAME', 'mercadona_products.csv')
 BQ_DATASET = os.environ.get('BQ_DATASET', 'food_data')
 BQ_TABLE = os.environ.get('BQ_TABLE', 'mercadona_enriched_products')
+BQ_LOCATION = os.environ.get('BQ_LOCATION', 'europe-west1')
+BQ_STAGING_TABLE = os.environ.get('BQ_STAGING_TABLE', f"{BQ_TABLE}_staging")
+
+# Input columns that define a product version: a row is re-enriched only when one of them changes
+HASH_COLUMNS = ('Nombre', 'Descripcion_del_producto', 'Precio', 'Barcode')
+
+# Streaming: the CSV is read from GCS CSV_CHUNK_ROWS rows at a time, its encoding is detected
+# on the first ENCODING_SAMPLE_BYTES, and enriched rows are written as Parquet to
+# gs://<bucket>/GCS_STAGING_PREFIX/ for a single load job
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '1000'))
+ENCODING_SAMPLE_BYTES = 64 * 1024
+GCS_CHUNK_BYTES = 1024 * 1024  # multiple of 256 KB, as resumable uploads require
+GCS_STAGING_PREFIX = os.environ.get('GCS_STAGING_PREFIX', 'staging')
+
+# Columns added by enrich_product_data
+OFF_RESULT_COLUMNS = ['off_product_name', 'off_barcode', 'off_brands', 'off_quantity', 'nutriscore_grade',
+                      'ecoscore_grade', 'nova_group', 'ingredients_text', 'energy_kcal_100g',
+                      'fat_100g', 'saturated_fat_100g', 'carbohydrates_100g', 'sugars_100g',
+                      'fiber_100g', 'proteins_100g', 'salt_100g', 'sodium_100g']
+
+# Stop looking up products after this many seconds (0 = no limit), leaving the rest of the
+# function timeout for the MERGE and the cache upload; the next run picks up the products
+# that were not merged yet
+MAX_RUNTIME_SECONDS = float(os.environ.get('MAX_RUNTIME_SECONDS', '0'))
+run_deadline = None  # time.monotonic() at which MAX_RUNTIME_SECONDS runs out, set by process_products
+
+
+class DeadlineReached(Exception):
+    """The time budget ran out before a product was looked up; it is left for the next run"""
+
+
+def check_deadline(wait=0.0):
+    """Raise DeadlineReached if the time budget is over, or would be after waiting `wait` seconds"""
+    if run_deadline is not None and time.monotonic() + wait > run_deadline:
+        raise DeadlineReached()
+
+# Initialize GCP clients (not in offline mode, which runs without credentials or network)
+storage_client = None if OFF_OFFLINE else storage.Client(project=GCP_PROJECT)
+bq_client = None if OFF_OFFLINE else bigquery.Client(project=GCP_PROJECT)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: at most `rate_per_minute` acquisitions per minute, with bursts up to `capacity`"""
+
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """Wait for a token; raises DeadlineReached, without taking it, if it comes after `deadline`"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Reserve the token now (the balance may go negative) so waiting threads are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            if deadline is not None and now + wait > deadline:
+                self._tokens += 1
+                raise DeadlineReached()
+        if wait > 0:
+            time.sleep(wait)
+
+
+product_limiter = TokenBucket(OFF_PRODUCT_RATE_PER_MIN)
+search_limiter = TokenBucket(OFF_SEARCH_RATE_PER_MIN)
+
+
+class OFFCache:
+    """SQLite cache of OpenFoodFacts lookups, keyed by barcode or by (search terms, brand filter)"""
+
+    def __init__(self, path, ttl_days=OFF_CACHE_TTL_DAYS, negative_ttl_days=OFF_CACHE_NEGATIVE_TTL_DAYS, offline=OFF_OFFLINE):
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.negative_ttl = negative_ttl_days * 86400
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS off_responses (
+                cache_key TEXT PRIMARY KEY,
+                product TEXT,               -- JSON of the product, NULL when OFF had no match
+                fetched_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def barcode_key(barcode):
+        return f"barcode:{barcode}"
+
+    @staticmethod
+    def search_key(search_terms, target_brand=None):
+        return f"search:{' '.join(search_terms.lower().split())}|{(target_brand or '').lower()}"
+
+    def get(self, key):
+        """(found, product); product is None for a cached "not found". Expired entries are not found, except offline."""
+        with self._lock:
+            row = self._conn.execute("SELECT product, fetched_at FROM off_responses WHERE cache_key = ?", (key,)).fetchone()
+            if row is not None:
+                product_json, fetched_at = row
+                ttl = self.ttl if product_json is not None else self.negative_ttl
+                if self.offline or time.time() - fetched_at <= ttl:
+                    self.hits += 1
+                    return True, json.loads(product_json) if product_json is not None else None
+            self.misses += 1
+            return False, None
+
+    def put(self, key, product):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO off_responses (cache_key, product, fetched_at) VALUES (?, ?, ?)",
+                (key, json.dumps(product) if product is not None else None, time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+off_cache = None  # opened by open_off_cache() at the start of the run
+
+def open_off_cache():
+    """Open the local cache, first fetching the copy kept in GCS by the previous run"""
+    global off_cache
+    if OFF_CACHE_BLOB and not OFF_OFFLINE:
+        blob = storage_client.bucket(GCS_BUCKET_NAME).blob(OFF_CACHE_BLOB)
+        if blob.exists():
+            blob.download_to_filename(OFF_CACHE_PATH)
+            logger.info(f"Downloaded OpenFoodFacts cache from gs://{GCS_BUCKET_NAME}/{OFF_CACHE_BLOB}")
+    off_cache = OFFCache(OFF_CACHE_PATH)
+    return off_cache
+
+def upload_off_cache():
+    """Copy the cache to GCS for the next run (after every batch, so a run cut short keeps its lookups)"""
+    if off_cache is None or not OFF_CACHE_BLOB or OFF_OFFLINE:
+        return
+    # Every put() is committed; the lock keeps a lookup from writing during the upload
+    with off_cache._lock:
+        storage_client.bucket(GCS_BUCKET_NAME).blob(OFF_CACHE_BLOB).upload_from_filename(OFF_CACHE_PATH)
+    logger.info(f"Uploaded OpenFoodFacts cache to gs://{GCS_BUCKET_NAME}/{OFF_CACHE_BLOB}")
+
+def close_off_cache():
+    """Upload the cache to GCS for the next run and close it"""
+    global off_cache
+    if off_cache is None:
+        return
+    logger.info(f"OpenFoodFacts cache: {off_cache.hits} hits, {off_cache.misses} misses")
+    try:
+        upload_off_cache()
+    finally:
+        off_cache.close()
+        off_cache = None
+
+
+def create_http_session():
+    """requests.Session with a connection pool shared by the enrichment threads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(ENRICH_WORKERS, 10))
+    session.mount("https://", adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    return session
+
+http_session = create_http_session()
+
 
-# Initialize GCP clients
-storage_client = storage.Client(project=GCP_PROJECT)
-bq_client = bigquery.Client(project=GCP_PROJECT)
+class RetryableHTTPError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def off_get(url, params, limiter):
+    """
+    GET to OpenFoodFacts within the rate limit. 429, 5xx, timeouts and connection errors
+    are retried with exponential backoff and jitter (honouring Retry-After).
+    Raises DeadlineReached instead of starting a request that could end after the time budget.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(deadline=None if run_deadline is None else run_deadline - REQUEST_TIMEOUT)
+        try:
+            response = http_session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = response.headers.get('Retry-After')
+                raise RetryableHTTPError(f"HTTP {response.status_code}",
+                                         float(retry_after) if retry_after and retry_after.isdigit() else None)
+            response.raise_for_status()
+            return response.json()
+        except (RetryableHTTPError, requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)  # jitter
+            delay = max(delay, getattr(e, 'retry_after', None) or 0)
+            check_deadline(delay + REQUEST_TIMEOUT)
+            logger.warning(f"OpenFoodFacts request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
 
 def detect_encoding(file_content):
     result = chardet.detect(file_content)
     encoding = result['encoding']
     confidence = result['confidence']
     logger.info(f"Detected encoding: {encoding} with confidence: {confidence}")
+    if not encoding or encoding.lower() == 'ascii':
+        # An ASCII sample says nothing about the rest of the file
+        encoding = 'utf-8'
     return encoding
 
+def find_price_column(columns):
+    return next((col for col in columns if 'precio' in col.lower() or 'price' in col.lower()), None)
+
+# Packaging and size noise removed from product names before searching OpenFoodFacts,
+# precompiled into a single alternation (alternatives in the order they used to be applied)
+NAME_NOISE_PATTERN = re.compile('|'.join([
+    r'\b\d+\s*bricks?\s*x\s*\d+\s*g\b',
+    r'\bp(?:ie|aquete|ieza)\s*\d+\s*g\s*(?:aprox\.?)?\b',
+    r'\b(?:paquete|bolsa|tarrina|bandeja|brick)\b',
+    r'\b\d+\s*uds?\.?\b',
+    r'\b\d+x\d+\s*g\b',
+    r'\b\d+(?:\.\d+)?\s*(?:g|kg|l|ml)\b',
+    r'\baprox\.?\b',
+]), re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r'\s+')
+PRICE_PATTERN = re.compile(r'(\d+\.?\d*)')
+
 def clean_product_name_for_search(product_name, brand_to_remove=None):
     if not isinstance(product_name, str):
         return ""
@@ -50,40 +299,137 @@ def clean_product_name_for_search(product_name, brand_to_remove=None):
     if brand_to_remove:
         name = name.replace(brand_to_remove.lower(), "")
 
-    name = re.sub(r'\b\d+\s*bricks?\s*x\s*\d+\s*g\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\bp(ie|aquete|ieza)\s*\d+\s*g\s*(aprox\.?)?\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\b(paquete|bolsa|tarrina|bandeja|brick)\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\b\d+\s*ud(s)?\.?\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\b\d+x\d+\s*g\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\b\d+(\.\d+)?\s*(g|kg|l|ml)\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\baprox\.?\b', '', name, flags=re.IGNORECASE).strip()
-    name = re.sub(r'\s+', ' ', name).strip()
+    name = WHITESPACE_PATTERN.sub(' ', NAME_NOISE_PATTERN.sub('', name)).strip()
 
-    if not name or len(name.split()) < 1:
+    if not name:
         name = product_name.lower()
         if brand_to_remove:
              name = name.replace(brand_to_remove.lower(), "").strip()
         name = " ".join(name.split()[:3])
     return name
 
-def search_product_openfoodfacts(search_terms, target_brand=None, barcode=None):
-    headers = {'User-Agent': USER_AGENT}
-    common_fields = 'product_name,brands,nutriments,nutriscore_grade,ecoscore_grade,nova_group,ingredients_text,code,quantity'
+def detect_brands(names):
+    """First brand of MERCADONA_BRANDS contained in each name (None when there is none)"""
+    lower = names.where(names.map(lambda n: isinstance(n, str)), '').str.lower()
+    brands = pd.Series(None, index=names.index, dtype=object)
+    for brand in reversed(MERCADONA_BRANDS):
+        brands = brands.mask(lower.str.contains(brand, regex=False), brand)
+    return brands
+
+def clean_product_names(names, brands=None):
+    """Vectorised clean_product_name_for_search over a Series of names, removing each row's brand in `brands`"""
+    valid = names.map(lambda n: isinstance(n, str))
+    lower = names.where(valid, '').astype(object).str.lower()
+    if brands is not None:
+        for brand in brands.dropna().unique():
+            rows = brands == brand
+            lower[rows] = lower[rows].str.replace(brand.lower(), '', regex=False)
+
+    cleaned = (lower.str.replace(NAME_NOISE_PATTERN, '', regex=True)
+                    .str.replace(WHITESPACE_PATTERN, ' ', regex=True)
+                    .str.strip())
+
+    # Names that were only noise keep their first three words
+    empty = valid & cleaned.eq('')
+    if empty.any():
+        cleaned[empty] = lower[empty].str.split().str[:3].str.join(' ')
+    return cleaned.where(valid, '')
+
+def parse_prices(values):
+    """Vectorised price parsing: '1,35 €' -> 1.35 (NaN when there is no number)"""
+    values = values.astype(str).str.replace('€', '', regex=False).str.replace(',', '.', regex=False).str.strip()
+    return pd.to_numeric(values.str.extract(PRICE_PATTERN)[0], errors='coerce')
+
+def normalize_products(df, price_col_name=None):
+    """
+    One vectorised pass over the scraper frame: parses the price column and precomputes the
+    brand filter and the cleaned search name of every product (_brand and _search_name,
+    consumed by enrich_product_data).
+    """
+    if price_col_name:
+        try:
+            df[price_col_name] = parse_prices(df[price_col_name])
+            logger.info(f"Standardized price column '{price_col_name}'.")
+        except Exception as e:
+            logger.warning(f"Could not fully convert price column '{price_col_name}': {e}")
+
+    df['_brand'] = detect_brands(df['Nombre'])
+    df['_search_name'] = clean_product_names(df['Nombre'], df['_brand'])
+    return df
+
+OFF_FIELDS = 'product_name,brands,nutriments,nutriscore_grade,ecoscore_grade,nova_group,ingredients_text,code,quantity'
+
+def cached_lookup(key, fetch):
+    """
+    Answer an OpenFoodFacts lookup from the cache, or call fetch() and cache what it returns
+    (including None, "not found"). Request errors raised by fetch() are not cached.
+    """
+    if off_cache is not None:
+        found, product = off_cache.get(key)
+        if found:
+            return product
+    if OFF_OFFLINE:
+        logger.info(f"Offline mode: no cached OpenFoodFacts response for {key}")
+        return None
+    product = fetch()
+    if off_cache is not None:
+        off_cache.put(key, product)
+    return product
+
+def fetch_product_by_barcode(barcode):
+    url = OFF_API_PRODUCT_V2_URL_TEMPLATE.format(barcode=barcode)
+    data = off_get(url, {'fields': OFF_FIELDS}, product_limiter)
+    if data.get('status') == 1 and data.get('product'):
+        return data.get('product')
+    return None
 
+def fetch_product_by_search(search_terms, target_brand=None):
+    params_v1 = {
+        'action': 'process',
+        'search_terms': search_terms,
+        'search_simple': 1,
+        'json': 1,
+        'page_size': 5,
+        'fields': OFF_FIELDS
+    }
+
+    if target_brand:
+        params_v1['tagtype_0'] = 'brands'
+        params_v1['tag_contains_0'] = 'contains'
+        params_v1['tag_0'] = target_brand.lower()
+
+    data = off_get(OFF_API_SEARCH_V1_URL, params_v1, search_limiter)
+
+    if data.get('count', 0) > 0 and data.get('products'):
+        products_found = data.get('products')
+        logger.info(f"Found {len(products_found)} product(s) via v1 API")
+
+        if target_brand:
+            for product in products_found:
+                product_brands_str = product.get('brands', '').lower()
+                if any(b.strip() == target_brand.lower() for b in product_brands_str.split(',')):
+                    logger.info(f"Prioritized v1 match for brand '{target_brand}'")
+                    return product
+
+        return products_found[0]
+
+    return None
+
+def search_product_openfoodfacts(search_terms, target_brand=None, barcode=None):
     # 1. Try direct barcode lookup using v2 product endpoint
     if barcode and isinstance(barcode, str) and barcode.strip().isdigit():
         sanitized_barcode = barcode.strip()
         logger.info(f"Attempting barcode lookup for: {sanitized_barcode}")
         try:
-            url = OFF_API_PRODUCT_V2_URL_TEMPLATE.format(barcode=sanitized_barcode)
-            response = requests.get(url, headers=headers, params={'fields': common_fields})
-            response.raise_for_status()
-            data = response.json()
-            if data.get('status') == 1 and data.get('product'):
-                logger.info(f"Barcode match found: {data['product'].get('product_name', 'N/A')}")
-                return data.get('product')
+            product = cached_lookup(OFFCache.barcode_key(sanitized_barcode),
+                                    lambda: fetch_product_by_barcode(sanitized_barcode))
+            if product:
+                logger.info(f"Barcode match found: {product.get('product_name', 'N/A')}")
+                return product
             else:
                 logger.info(f"No product found for barcode {sanitized_barcode}")
+        except DeadlineReached:
+            raise
         except Exception as e:
             logger.warning(f"Error during barcode lookup for {sanitized_barcode}: {e}")
 
@@ -92,69 +438,49 @@ def search_product_openfoodfacts(search_terms, target_brand=None, barcode=None):
         logger.warning("Empty product name provided for search.")
         return None
 
-    params_v1 = {
-        'action': 'process',
-        'search_terms': search_terms,
-        'search_simple': 1,
-        'json': 1,
-        'page_size': 5,
-        'fields': common_fields
-    }
-
     if target_brand:
-        params_v1['tagtype_0'] = 'brands'
-        params_v1['tag_contains_0'] = 'contains'
-        params_v1['tag_0'] = target_brand.lower()
         logger.info(f"Attempting v1 API name search for '{search_terms}' with brand filter '{target_brand}'")
     else:
         logger.info(f"Attempting v1 API name search for '{search_terms}' (no brand filter)")
 
     try:
-        response = requests.get(OFF_API_SEARCH_V1_URL, params=params_v1, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-
-        if data.get('count', 0) > 0 and data.get('products'):
-            products_found = data.get('products')
-            logger.info(f"Found {len(products_found)} product(s) via v1 API")
-
-            if target_brand:
-                for product in products_found:
-                    product_brands_str = product.get('brands', '').lower()
-                    if any(b.strip() == target_brand.lower() for b in product_brands_str.split(',')):
-                        logger.info(f"Prioritized v1 match for brand '{target_brand}'")
-                        return product
-
-            if products_found:
-                return products_found[0]
-
+        return cached_lookup(OFFCache.search_key(search_terms, target_brand),
+                             lambda: fetch_product_by_search(search_terms, target_brand))
+    except DeadlineReached:
+        raise
     except Exception as e:
         logger.warning(f"Error during v1 API name search for '{search_terms}': {e}")
 
     return None
 
 def enrich_product_data(product_row):
+    product_row = dict(product_row)
+    precomputed = '_search_name' in product_row
+    search_name_cleaned = product_row.pop('_search_name', None)
+    detected_brand_for_filter = product_row.pop('_brand', None)
+    if not isinstance(detected_brand_for_filter, str):
+        detected_brand_for_filter = None  # NaN from the DataFrame
+
     full_product_name = product_row.get('Nombre', '')
     if not full_product_name:
         logger.warning("Skipping row due to empty product name.")
         return product_row
 
-    detected_brand_for_filter = None
-    for brand in MERCADONA_BRANDS:
-        if brand in full_product_name.lower():
-            detected_brand_for_filter = brand
-            break
-
-    search_name_cleaned = clean_product_name_for_search(full_product_name, brand_to_remove=detected_brand_for_filter)
+    if not precomputed:
+        # Rows that did not go through normalize_products
+        detected_brand_for_filter = None
+        for brand in MERCADONA_BRANDS:
+            if brand in full_product_name.lower():
+                detected_brand_for_filter = brand
+                break
+        search_name_cleaned = clean_product_name_for_search(full_product_name, brand_to_remove=detected_brand_for_filter)
     barcode = product_row.get('Barcode') or product_row.get('barcode') 
 
     logger.info(f"Processing: '{full_product_name}' with cleaned search: '{search_name_cleaned}'")
 
+    # The rate limiters pace the requests, no sleep needed between products
     off_product = search_product_openfoodfacts(search_name_cleaned, target_brand=detected_brand_for_filter, barcode=barcode)
 
-    logger.info(f"Sleeping for {SLEEP_TIME} seconds...")
-    time.sleep(SLEEP_TIME)
-
     enriched_product = product_row.copy()
     if off_product:
         nutriments = off_product.get('nutriments', {})
@@ -180,11 +506,7 @@ def enrich_product_data(product_row):
         })
     else:
         logger.warning(f"No match found for: '{search_name_cleaned}'")
-        keys_to_add = ['off_product_name', 'off_barcode', 'off_brands', 'off_quantity', 'nutriscore_grade', 
-                       'ecoscore_grade', 'nova_group', 'ingredients_text', 'energy_kcal_100g', 
-                       'fat_100g', 'saturated_fat_100g', 'carbohydrates_100g', 'sugars_100g', 
-                       'fiber_100g', 'proteins_100g', 'salt_100g', 'sodium_100g']
-        for key in keys_to_add:
+        for key in OFF_RESULT_COLUMNS:
             enriched_product[key] = None
     
     # Add processing timestamp
@@ -192,105 +514,264 @@ def enrich_product_data(product_row):
     
     return enriched_product
 
-def download_from_gcs():
-    """Download CSV from Google Cloud Storage"""
-    logger.info(f"Downloading file from GCS: gs://{GCS_BUCKET_NAME}/{GCS_FILE_NAME}")
-    bucket = storage_client.bucket(GCS_BUCKET_NAME)
-    blob = bucket.blob(GCS_FILE_NAME)
-    content = blob.download_as_bytes()
-    return content
+def enrich_within_deadline(product_row):
+    """enrich_product_data, or None if the time budget ran out before the product was looked up"""
+    try:
+        check_deadline()
+        return enrich_product_data(product_row)
+    except DeadlineReached:
+        return None
+
+def open_gcs_csv():
+    """Chunked reader over the scraper CSV in GCS, and the encoding detected on its first bytes"""
+    logger.info(f"Streaming file from GCS: gs://{GCS_BUCKET_NAME}/{GCS_FILE_NAME}")
+    blob = storage_client.bucket(GCS_BUCKET_NAME).blob(GCS_FILE_NAME)
+    sample = blob.download_as_bytes(start=0, end=ENCODING_SAMPLE_BYTES - 1)
+    return blob.open('rb', chunk_size=GCS_CHUNK_BYTES), detect_encoding(sample)
+
+def iter_product_chunks(binary_stream, encoding):
+    """Products of the CSV, CSV_CHUNK_ROWS at a time, normalised (see normalize_products)"""
+    text_stream = io.TextIOWrapper(binary_stream, encoding=encoding, errors='replace', newline='')
+    for chunk in pd.read_csv(text_stream, chunksize=CSV_CHUNK_ROWS):
+        # Check for required columns
+        if 'Nombre' not in chunk.columns:
+            logger.error(f"'Nombre' column not found. Available columns: {chunk.columns.tolist()}")
+            return
+        # Price, brand and search name of every product in one vectorised pass
+        yield normalize_products(chunk, find_price_column(chunk.columns)).to_dict('records')
+
+def _bq_string(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value in ('N/A', 'nan'):
+        return None
+    return str(value)
 
-def write_to_bigquery(df):
-    """Write DataFrame to BigQuery"""
+def _bq_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+class ParquetStagingWriter:
+    """
+    Streams enriched batches into one Parquet file in GCS. The schema is fixed on the first
+    batch: the price as FLOAT64 and everything else as STRING, whatever the values look like,
+    so the whole file loads into BigQuery with a single load job.
+    """
+
+    def __init__(self, blob_name):
+        self.blob = storage_client.bucket(GCS_BUCKET_NAME).blob(blob_name)
+        self.uri = f"gs://{GCS_BUCKET_NAME}/{blob_name}"
+        self.rows = 0
+        self._file = None
+        self._writer = None
+        self.columns = None
+        self.price_column = None
+        self.schema = None
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self._writer is None:
+            managed = OFF_RESULT_COLUMNS + ['processed_at', 'product_key', 'row_hash']
+            self.columns = [col for col in rows[0] if col not in managed] + managed
+            self.price_column = find_price_column(self.columns)
+            self.schema = pa.schema([(col, pa.float64() if col == self.price_column else pa.string())
+                                     for col in self.columns])
+            self._file = self.blob.open('wb', chunk_size=GCS_CHUNK_BYTES, ignore_flush=True)
+            self._writer = pq.ParquetWriter(self._file, self.schema, compression='zstd')
+
+        arrays = {
+            col: [(_bq_float if col == self.price_column else _bq_string)(row.get(col)) for row in rows]
+            for col in self.columns
+        }
+        self._writer.write_table(pa.Table.from_pydict(arrays, schema=self.schema))
+        self.rows += len(rows)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._file.close()
+            self._writer = None
+
+    def delete(self):
+        if self.rows:
+            self.blob.delete()
+
+def _hash_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return str(value).strip()
+
+def _digest(parts):
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def product_key(product_row):
+    """Identity of a product in the enriched table (name + description)"""
+    return _digest([_hash_value(product_row.get('Nombre')), _hash_value(product_row.get('Descripcion_del_producto'))])
+
+def row_hash(product_row):
+    """Hash of the input columns in HASH_COLUMNS; changes when the scraper sees a different version of the product"""
+    return _digest([_hash_value(product_row.get(col, product_row.get(col.lower()))) for col in HASH_COLUMNS])
+
+def load_existing_hashes():
+    """
+    product_key -> row_hash of the products already in the enriched table. Returns None if the
+    table does not exist or predates the hashes, in which case every product is enriched again.
+    """
     table_id = f"{GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLE}"
-    logger.info(f"Writing {len(df)} rows to BigQuery table: {table_id}")
-    
-    # Convert numpy types to Python native types for BigQuery compatibility
-    df = df.copy()
-    for col in df.columns:
-        if df[col].dtype == 'object':
-            df[col] = df[col].astype(str).replace('nan', None).replace('N/A', None)
-    
-    # Write to BigQuery using pandas_gbq with location specified
-    pandas_gbq.to_gbq(
-        df, 
-        table_id,
-        project_id=GCP_PROJECT,
-        if_exists='replace',
-        progress_bar=False,
-        location='europe-west1'  # Your dataset location
+    try:
+        table = bq_client.get_table(table_id)
+    except NotFound:
+        logger.info(f"Table {table_id} does not exist yet, enriching every product")
+        return None
+    if not {'product_key', 'row_hash'} <= {field.name for field in table.schema}:
+        logger.info(f"Table {table_id} has no row hashes, enriching every product")
+        return None
+    rows = bq_client.query(f"SELECT product_key, row_hash FROM `{table_id}`", location=BQ_LOCATION).result()
+    return {row.product_key: row.row_hash for row in rows}
+
+def load_and_merge(staging_uri, recreate_table=False):
+    """Load the staged Parquet file into the staging table with one load job and MERGE it into the enriched table"""
+    table_id = f"{GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLE}"
+    staging_id = f"{GCP_PROJECT}.{BQ_DATASET}.{BQ_STAGING_TABLE}"
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
-    logger.info(f"Successfully wrote data to BigQuery")
+    bq_client.load_table_from_uri(staging_uri, staging_id, job_config=job_config, location=BQ_LOCATION).result()
+
+    columns = [f"`{field.name}`" for field in bq_client.get_table(staging_id).schema]
+    create = "CREATE OR REPLACE TABLE" if recreate_table else "CREATE TABLE IF NOT EXISTS"
+    updates = ", ".join(f"{col} = S.{col}" for col in columns if col != "`product_key`")
+    bq_client.query(f"""
+        {create} `{table_id}` AS SELECT * FROM `{staging_id}` WHERE FALSE;
+        MERGE `{table_id}` T
+        USING `{staging_id}` S
+        ON T.product_key = S.product_key
+        WHEN MATCHED THEN UPDATE SET {updates}
+        WHEN NOT MATCHED THEN INSERT ({", ".join(columns)}) VALUES ({", ".join(f"S.{col}" for col in columns)})
+    """, location=BQ_LOCATION).result()
+
+def delete_missing_products(current_keys):
+    """Remove from the enriched table the products that are no longer in the scraper file"""
+    table_id = f"{GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLE}"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("keys", "STRING", sorted(current_keys))
+    ])
+    job = bq_client.query(f"DELETE FROM `{table_id}` WHERE product_key NOT IN UNNEST(@keys)",
+                          job_config=job_config, location=BQ_LOCATION)
+    job.result()
+    if job.num_dml_affected_rows:
+        logger.info(f"Removed {job.num_dml_affected_rows} products no longer in {GCS_FILE_NAME}")
+
+def process_products(product_chunks, batch_size=100):
+    """
+    Enrich only the products that are new or whose HASH_COLUMNS changed since the last run.
+    The CSV is consumed chunk by chunk; pending products are enriched concurrently
+    (ENRICH_WORKERS threads, paced by the OpenFoodFacts rate limiters) in batches of
+    batch_size and streamed to a Parquet file in GCS, which is loaded and MERGEd into BigQuery
+    in one go at the end. Only the keys of the products seen are kept in memory, and the
+    OpenFoodFacts cache is uploaded after every batch.
+    The time budget (MAX_RUNTIME_SECONDS) is checked before every lookup, not every batch: once
+    it runs out no more requests start, the products not looked up are dropped from the batch,
+    what was enriched is merged, and the next run picks up the rest. Returns the number of
+    products enriched.
+    """
+    global run_deadline
+    started = time.monotonic()
+    run_deadline = started + MAX_RUNTIME_SECONDS if MAX_RUNTIME_SECONDS else None
+    existing = load_existing_hashes()
+    seen = set()
+    duplicates = 0
+    enriched_count = 0
+    stopped = False
+    writer = ParquetStagingWriter(f"{GCS_STAGING_PREFIX}/{BQ_TABLE}_{datetime.utcnow():%Y%m%dT%H%M%S}.parquet")
 
-def process_batch(products, batch_size=100):
-    """Process products in batches and write to BigQuery"""
-    all_enriched = []
-    total_products = len(products)
-    
-    for i in range(0, total_products, batch_size):
-        batch = products[i:i+batch_size]
-        logger.info(f"Processing batch {i//batch_size + 1} of {(total_products + batch_size - 1)//batch_size}")
-        
-        enriched_batch = []
-        for product in batch:
-            enriched_product = enrich_product_data(product)
-            enriched_batch.append(enriched_product)
-        
-        # Convert to DataFrame
-        batch_df = pd.DataFrame(enriched_batch)
-        
-        # Write this batch to BigQuery
-        write_mode = 'replace' if i == 0 else 'append'
-        pandas_gbq.to_gbq(
-            batch_df,
-            f"{GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLE}",
-            project_id=GCP_PROJECT,
-            if_exists=write_mode,
-            progress_bar=False,
-            location='europe-west1'  # Your dataset location
-        )
-        
-        all_enriched.extend(enriched_batch)
-        logger.info(f"Batch {i//batch_size + 1} written to BigQuery")
-    
-    return pd.DataFrame(all_enriched)
+    try:
+        with ThreadPoolExecutor(max_workers=ENRICH_WORKERS, thread_name_prefix="off-enrich") as executor:
+            for products in product_chunks:
+                pending = []
+                for product in products:
+                    key = product_key(product)
+                    # The same product listed twice would make the MERGE ambiguous: keep the first row
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+                    digest = row_hash(product)
+                    if existing is None or existing.get(key) != digest:
+                        pending.append({**product, 'product_key': key, 'row_hash': digest})
+
+                for i in range(0, len(pending), batch_size):
+                    results = list(executor.map(enrich_within_deadline, pending[i:i+batch_size]))
+                    enriched_batch = [row for row in results if row is not None]
+                    writer.write(enriched_batch)
+                    enriched_count += len(enriched_batch)
+                    upload_off_cache()
+                    logger.info(f"Enriched {enriched_count} products ({len(seen)} read, "
+                                f"{time.monotonic() - started:.0f}s elapsed)")
+                    if len(enriched_batch) < len(results):
+                        logger.warning(f"Time budget of {MAX_RUNTIME_SECONDS:.0f}s used up after {enriched_count} products; "
+                                       f"the next run continues with the rest")
+                        stopped = True
+                        break
+                if stopped:
+                    break
+        writer.close()
+
+        logger.info(f"{enriched_count} new or changed products out of {len(seen)} read "
+                    f"({duplicates} duplicates skipped)")
+        if writer.rows:
+            load_and_merge(writer.uri, recreate_table=existing is None)
+            logger.info(f"Merged {writer.rows} products into {BQ_DATASET}.{BQ_TABLE}")
+    finally:
+        writer.close()
+        writer.delete()
+
+    if not stopped and existing is not None and set(existing) - seen:
+        delete_missing_products(seen)
+    return enriched_count
+
+def run_offline():
+    """Replay the enrichment of a local CSV using only the OpenFoodFacts cache (no network, no GCP)"""
+    logger.info(f"Offline mode: enriching {OFFLINE_INPUT_CSV} from cache {OFF_CACHE_PATH}")
+    open_off_cache()
+    written = 0
+    try:
+        with open(OFFLINE_INPUT_CSV, 'rb') as f, \
+                ThreadPoolExecutor(max_workers=ENRICH_WORKERS, thread_name_prefix="off-enrich") as executor:
+            encoding = detect_encoding(f.read(ENCODING_SAMPLE_BYTES))
+            f.seek(0)
+            columns = None
+            for products in iter_product_chunks(f, encoding):
+                batch_df = pd.DataFrame(list(executor.map(enrich_product_data, products)))
+                columns = columns or batch_df.columns.tolist()
+                batch_df.reindex(columns=columns).to_csv(OFFLINE_OUTPUT_CSV, mode='a' if written else 'w',
+                                                         header=not written, index=False)
+                written += len(batch_df)
+    finally:
+        close_off_cache()
+    logger.info(f"Wrote {written} products to {OFFLINE_OUTPUT_CSV}")
 
 def main():
+    if OFF_OFFLINE:
+        return run_offline()
+
     logger.info("Starting Mercadona Product Enrichment Cloud Run Job")
     logger.info(f"Project: {GCP_PROJECT}, Bucket: {GCS_BUCKET_NAME}, File: {GCS_FILE_NAME}")
     
     try:
-        # Download CSV from GCS
-        csv_content = download_from_gcs()
-        
-        # Detect encoding and read CSV
-        encoding = detect_encoding(csv_content)
-        df = pd.read_csv(StringIO(csv_content.decode(encoding)))
+        csv_stream, encoding = open_gcs_csv()
         
-        # Check for required columns
-        if 'Nombre' not in df.columns:
-            logger.error(f"'Nombre' column not found. Available columns: {df.columns.tolist()}")
-            return
-        
-        # Process price column if exists
-        price_col_name = next((col for col in df.columns if 'precio' in col.lower() or 'price' in col.lower()), None)
-        if price_col_name:
-            try:
-                df[price_col_name] = df[price_col_name].astype(str).str.replace('€','',regex=False).str.replace(',','.',regex=False).str.strip()
-                df[price_col_name] = df[price_col_name].str.extract(r'(\d+\.?\d*)')[0]
-                df[price_col_name] = pd.to_numeric(df[price_col_name], errors='coerce')
-                logger.info(f"Standardized price column '{price_col_name}'.")
-            except Exception as e:
-                logger.warning(f"Could not fully convert price column '{price_col_name}': {e}")
-        
-        # Process products in batches
-        products = df.to_dict('records')
-        logger.info(f"Starting enrichment of {len(products)} products")
-        
-        # Process in batches to avoid memory issues
-        enriched_df = process_batch(products, batch_size=50)
+        open_off_cache()
+        try:
+            with csv_stream:
+                enriched_count = process_products(iter_product_chunks(csv_stream, encoding), batch_size=50)
+        finally:
+            close_off_cache()
         
-        logger.info(f"Enrichment complete. Processed {len(enriched_df)} products.")
+        logger.info(f"Enrichment complete. Processed {enriched_count} products.")
         
     except Exception as e:
         logger.error(f"Error occurred: {e}")
@@ -93,11 +93,11 @@ def import_arquitecture():
         raise ImportError("Could not import arquitecture module")
 
 def import_langgraph():
-    """Import LangGraph modules."""
+    """Import the LangGraph checkpointer factory."""
     try:
-        from langgraph.checkpoint.memory import InMemorySaver
+        from firestore_checkpointer import create_checkpointer
         logger.info("Successfully imported LangGraph")
-        return InMemorySaver
+        return create_checkpointer
     except ImportError:
         logger.error("Failed to import LangGraph")
         raise
@@ -105,19 +105,25 @@ def import_langgraph():
 # Try to import all required modules
 try:
     workflow, FirestoreSaver, generate_session_id, validate_state = import_arquitecture()
-    InMemorySaver = import_langgraph()
+    create_checkpointer = import_langgraph()
+    from write_behind import WriteBehindQueue
+    from firestore_checkpointer import turn_input
+    from firestore_saver import session_record
+    from states import last_reply
     
     # Now we're sure these variables are defined in the global scope
     # Initialize Firebase/Firestore connection
-    memory_saver = InMemorySaver()
     firestore_saver = FirestoreSaver(
         collection_name="diet_conversations",
         project_id="diap3-458416",
         database_id="agente-context-prueba"
     )
+    # Session saves are written in the background, off the request path
+    write_behind = WriteBehindQueue(firestore_saver)
     
-    # Compile the graph
-    graph = workflow.compile(checkpointer=memory_saver)
+    # Compile the graph with the persistent checkpointer (keeps only the latest checkpoints per session)
+    checkpointer = create_checkpointer(db=firestore_saver.db)
+    graph = workflow.compile(checkpointer=checkpointer)
     
     logger.info("Successfully initialized LangGraph workflow and Firestore")
 except Exception as e:
@@ -158,53 +164,21 @@ def chat():
             session_id = generate_session_id()
             logger.info(f"Created new session: {session_id}")
         
-        # Get existing state or create new one
-        state = firestore_saver.get(session_id)
+        config = {"configurable": {"thread_id": session_id}}
         
-        # If no state exists, initialize a new one
-        if state is None:
-            state = {
-                "messages": [],
-                "intolerances": [],
-                "forbidden_foods": [],
-                "diet": {},
-                "budget": None,
-                "info_dietas": "",
-                "grocery_list": [],
-                "metadata": {
-                    "created_at": datetime.datetime.now().isoformat(),
-                    "last_active": datetime.datetime.now().isoformat(),
-                    "session_id": session_id
-                }
-            }
+        # The checkpointer restores the session, so only the new message is sent
+        graph_input = turn_input(session_id, user_message)
         
-        # Add the user message to the state
-        state["messages"].append({"role": "user", "content": user_message})
-        prev_len = len(state["messages"])
+        # Process the message through the graph; only the final checkpoint is stored
+        state = graph.invoke(graph_input, config=config, durability="exit")
         
-        # Process the message through the graph
-        result = graph.invoke(
-            state,
-            config={"configurable": {"thread_id": session_id}},
-        )
-        
-        # Update the state with the result
-        state = result
-        
-        # Update metadata
-        if "metadata" in state:
-            state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-        
-        # Extract new assistant messages
-        new_msgs = state["messages"][prev_len:]
-        assistant_msgs = [m for m in new_msgs if m.get("role") == "assistant"]
-        
-        # Get the latest assistant message
-        response = assistant_msgs[-1]["content"] if assistant_msgs else "No response generated."
+        # Get the assistant's reply to this message
+        response = last_reply(state["messages"]) or "No response generated."
         
-        # Save state to Firestore
+        # Save the session's messages and metadata to Firestore in the background
+        # (the graph state is already in the checkpoint)
         if validate_state(state):
-            firestore_saver.put(session_id, state)
+            write_behind.submit(session_id, session_record(state))
         
         # Return the response
         return jsonify({
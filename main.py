@@ -3,7 +3,7 @@ import sys
 import logging
 import traceback
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import json
 import datetime
 import uuid
@@ -32,18 +32,24 @@ app = Flask(__name__)
 try:
     # Import your LangGraph workflow
     from arquitecture import workflow, FirestoreSaver, generate_session_id, validate_state
-    from langgraph.checkpoint.memory import InMemorySaver
+    from write_behind import WriteBehindQueue
+    from firestore_saver import session_record
+    from firestore_checkpointer import create_checkpointer, turn_input
+    from states import last_reply
+    from exportar import exportar_lista_compra
 
     # Initialize Firebase/Firestore connection
-    memory_saver = InMemorySaver()
     firestore_saver = FirestoreSaver(
         collection_name="diet_conversations",
         project_id="diap3-458416",
         database_id="agente-context-prueba"
     )
+    # Session saves are written in the background, off the request path
+    write_behind = WriteBehindQueue(firestore_saver)
 
-    # Compile the graph
-    graph = workflow.compile(checkpointer=memory_saver)
+    # Compile the graph with the persistent checkpointer (keeps only the latest checkpoints per session)
+    checkpointer = create_checkpointer(db=firestore_saver.db)
+    graph = workflow.compile(checkpointer=checkpointer)
     
     logger.info("Successfully initialized LangGraph workflow")
 except Exception as e:
@@ -76,53 +82,21 @@ def chat():
             session_id = generate_session_id()
             logger.info(f"Created new session: {session_id}")
         
-        # Get existing state or create new one
-        state = firestore_saver.get(session_id)
+        config = {"configurable": {"thread_id": session_id}}
         
-        # If no state exists, initialize a new one
-        if state is None:
-            state = {
-                "messages": [],
-                "intolerances": [],
-                "forbidden_foods": [],
-                "diet": {},
-                "budget": None,
-                "info_dietas": "",
-                "grocery_list": [],
-                "metadata": {
-                    "created_at": datetime.datetime.now().isoformat(),
-                    "last_active": datetime.datetime.now().isoformat(),
-                    "session_id": session_id
-                }
-            }
+        # The checkpointer restores the session, so only the new message is sent
+        graph_input = turn_input(session_id, user_message)
         
-        # Add the user message to the state
-        state["messages"].append({"role": "user", "content": user_message})
-        prev_len = len(state["messages"])
+        # Process the message through the graph; only the final checkpoint is stored
+        state = graph.invoke(graph_input, config=config, durability="exit")
         
-        # Process the message through the graph
-        result = graph.invoke(
-            state,
-            config={"configurable": {"thread_id": session_id}},
-        )
+        # Get the assistant's reply to this message
+        response = last_reply(state["messages"]) or "No response generated."
         
-        # Update the state with the result
-        state = result
-        
-        # Update metadata
-        if "metadata" in state:
-            state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-        
-        # Extract new assistant messages
-        new_msgs = state["messages"][prev_len:]
-        assistant_msgs = [m for m in new_msgs if m.get("role") == "assistant"]
-        
-        # Get the latest assistant message
-        response = assistant_msgs[-1]["content"] if assistant_msgs else "No response generated."
-        
-        # Save state to Firestore
+        # Save the session's messages and metadata to Firestore in the background
+        # (the graph state is already in the checkpoint)
         if validate_state(state):
-            firestore_saver.put(session_id, state)
+            write_behind.submit(session_id, session_record(state))
         
         # Return the response
         return jsonify({
@@ -135,6 +109,44 @@ def chat():
         logger.error(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+@app.route('/sessions/<session_id>/messages', methods=['GET'])
+def session_messages(session_id):
+    """Older conversation history, one page at a time (pass next_before to get the previous page)."""
+    try:
+        before = request.args.get('before', type=int)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        page = firestore_saver.get_messages_page(session_id, before=before, page_size=limit)
+        return jsonify({"session_id": session_id, **page})
+    except Exception as e:
+        logger.error(f"Error loading messages for {session_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/sessions/<session_id>/grocery-list', methods=['GET'])
+def grocery_list_export(session_id):
+    """Grocery list of the session as a CSV or XLSX download (?format=csv|xlsx, ?prices=1 adds the priced columns)."""
+    try:
+        state = graph.get_state({"configurable": {"thread_id": session_id}}).values or {}
+        grocery_list = state.get("grocery_list") or []
+        if not grocery_list:
+            return jsonify({"error": f"Session {session_id} has no grocery list"}), 404
+
+        con_precio = request.args.get('prices', '0').lower() in ('1', 'true', 'yes')
+        content, mimetype, filename = exportar_lista_compra(grocery_list, request.args.get('format', 'csv'), con_precio)
+        return Response(content, mimetype=mimetype,
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error exporting grocery list for {session_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Saved-version cache counters (hits: saves that only sent the changed fields, stale: sessions written elsewhere, evictions, memory use) and queued saves."""
+    return jsonify({"session_cache": firestore_saver.cache_stats(), "write_behind": write_behind.stats()})
+
 @app.route('/', methods=['GET'])
 def root():
     """Root endpoint for basic health check."""
@@ -143,7 +155,8 @@ def root():
         "service": "diet-agent",
         "version": "1.0",
         "timestamp": datetime.datetime.now().isoformat(),
-        "endpoints": ["/health", "/chat"]
+        "endpoints": ["/health", "/chat", "/sessions/<session_id>/messages",
+                      "/sessions/<session_id>/grocery-list", "/stats"]
     })
 
 # Add better error handling
@@ -0,0 +1,73 @@
+"""
+Migra las sesiones guardadas en Firestore con los formatos antiguos al formato actual:
+  - estado del grafo dentro del documento de la sesión (dieta, lista de la compra,
+    state_packed, trozos en {collection}_chunks...): pasa al checkpointer
+  - pickle + base64 (pickled_data / is_pickled_chunked) y dieta en JSON (diet_serialized)
+  - mensajes dentro del documento de la sesión en vez de en la subcolección messages
+
+Cada sesión se lee con FirestoreSaver (que entiende los formatos antiguos), su estado se
+guarda como checkpoint del hilo si aún no tiene ninguno y el documento se reescribe solo
+con los mensajes y metadata. Hay que ejecutarlo antes de desplegar la versión en la que
+el grafo ya no lee las sesiones de Firestore, o esas sesiones empiezan de cero.
+
+Uso:
+    python migrate_session_encoding.py --dry-run
+    python migrate_session_encoding.py --collection diet_conversations
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodes"))
+from firestore_saver import ENCODED_DOCUMENT_MARKERS, SESSION_FIELDS, FirestoreSaver
+from firestore_checkpointer import create_checkpointer, seed_thread
+from states import DietState
+
+LEGACY_MARKERS = ENCODED_DOCUMENT_MARKERS + ("diet_serialized", "messages") + tuple(
+    field for field in DietState.__dataclass_fields__ if field not in SESSION_FIELDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--collection", default="diet_conversations")
+    parser.add_argument("--project", default="diap3-458416")
+    parser.add_argument("--database", default="agente-context-prueba")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the sessions that need migrating")
+    args = parser.parse_args()
+
+    saver = FirestoreSaver(collection_name=args.collection, project_id=args.project, database_id=args.database)
+    checkpointer = create_checkpointer(db=saver.db)
+    collection = saver.db.collection(args.collection)
+
+    migrated, failed, total = 0, 0, 0
+    for doc in collection.select(list(dict.fromkeys(LEGACY_MARKERS))).stream():
+        total += 1
+        legacy_fields = [field for field in LEGACY_MARKERS if field in (doc.to_dict() or {})]
+        if not legacy_fields:
+            continue
+
+        print(f"🔄 {doc.id}: {', '.join(legacy_fields)}")
+        if args.dry_run:
+            migrated += 1
+            continue
+        try:
+            state = saver.get(doc.id)
+            if state is None:
+                continue
+            # Number the messages first, so the checkpoint and the subcollection agree on seq
+            saver.assign_message_numbers(doc.id, state)
+            if checkpointer.get_tuple({"configurable": {"thread_id": doc.id, "checkpoint_ns": ""}}) is None:
+                seed_thread(checkpointer, doc.id, state)
+            # Only now drop the graph state from the session document
+            saver.put(doc.id, state)
+            migrated += 1
+        except Exception as e:
+            failed += 1
+            print(f"❌ Could not migrate {doc.id}: {e}")
+
+    action = "need migrating" if args.dry_run else "migrated"
+    print(f"✅ {migrated} of {total} sessions {action} ({failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import InMemorySaver
-from states import DietState
+from states import DietState, last_reply
 from intolerancias import intolerance_search
 from mensaje_intolerancias import mensaje_intolerancias
 from intolerancias_router import intolerancias_router
@@ -13,157 +12,14 @@ from otros import otros
 from typing import List, Dict, Annotated, Any, Optional
 from langchain_core.messages import BaseMessage
 import operator
-from google.cloud import firestore
-import json
-import pickle
-import base64
 import traceback
 import datetime
 import uuid
-import copy
 
-# Implementación personalizada del saver para Firestore
-class FirestoreSaver:
-    """Implementación de guardado de estado en Firestore para LangGraph."""
-    
-    def __init__(self, 
-                 collection_name: str = "conversations", 
-                 project_id: str = "diap3-458416",
-                 database_id: str = "agente-context-prueba"
-                ):
-        """
-        Inicializa el saver de Firestore.
-        
-        Args:
-            collection_name: Nombre de la colección en Firestore
-            project_id: ID del proyecto de Google Cloud
-            database_id: ID de la base de datos de Firestore
-        """
-        self.collection_name = collection_name
-        self.db = firestore.Client(project=project_id, database=database_id)
-        # Diccionario para cache en memoria
-        self._cache = {}
-        print(f"🔌 Conectado a Firestore (base de datos: {database_id}, colección: {collection_name})")
-    
-    def get(self, key: str) -> Optional[Dict]:
-        """
-        Recupera un estado guardado por su clave.
-        
-        Args:
-            key: Clave del estado (normalmente thread_id o session_id)
-            
-        Returns:
-            El estado guardado o None si no existe
-        """
-        # Primero intenta obtenerlo de la caché
-        if key in self._cache:
-            return self._cache[key]
-        
-        # Si no está en caché, intenta obtenerlo de Firestore
-        doc_ref = self.db.collection(self.collection_name).document(key)
-        doc = doc_ref.get()
-        
-        if not doc.exists:
-            return None
-        
-        data = doc.to_dict()
-        
-        # Si hay campos serializados como binarios, deserializarlos
-        if "pickled_data" in data:
-            pickled_data = base64.b64decode(data["pickled_data"])
-            state = pickle.loads(pickled_data)
-        else:
-            state = data
-            
-            # Restaurar claves numéricas en la estructura de datos
-            if "diet" in state and "diet_serialized" in state:
-                try:
-                    state["diet"] = json.loads(state["diet_serialized"])
-                    del state["diet_serialized"]
-                except:
-                    print("⚠️ Error al deserializar diet")
-        
-        # Actualiza la caché
-        self._cache[key] = state
-        return state
-    
-    def put(self, key: str, value: Dict) -> None:
-        """
-        Guarda un estado.
-        
-        Args:
-            key: Clave del estado (normalmente thread_id o session_id)
-            value: Estado a guardar
-        """
-        # Guarda en caché
-        self._cache[key] = value
-        
-        # Crea una copia para no modificar el original
-        firestore_value = copy.deepcopy(value)
-        
-        # Preprocesa los datos para que sean compatibles con Firestore
-        # Firestore no acepta claves numéricas en mapas
-        if "diet" in firestore_value and isinstance(firestore_value["diet"], dict):
-            # Convierte y guarda la dieta como JSON
-            try:
-                firestore_value["diet_serialized"] = json.dumps(firestore_value["diet"])
-                # Guarda una versión simplificada en el objeto diet para visualización
-                diet_simple = {}
-                for day, meals in firestore_value["diet"].items():
-                    # Convierte los días a strings
-                    day_str = f"día_{day}" if isinstance(day, int) else str(day)
-                    diet_simple[day_str] = {}
-                    for meal_name, items in meals.items():
-                        # Guarda sólo los nombres de los alimentos
-                        diet_simple[day_str][meal_name] = list(items.keys()) if isinstance(items, dict) else "Info no disponible"
-                
-                firestore_value["diet"] = diet_simple
-            except Exception as e:
-                print(f"⚠️ Error al serializar diet: {e}")
-                # Si falla, guardamos un diccionario vacío
-                firestore_value["diet"] = {}
-                firestore_value["diet_serialized"] = "{}"
-        
-        # Guarda en Firestore
-        doc_ref = self.db.collection(self.collection_name).document(key)
-        
-        try:
-            # Intenta guardar directamente
-            doc_ref.set(firestore_value)
-        except TypeError as e:
-            print(f"⚠️ Error al guardar en Firestore: {e}")
-            print("Intentando serializar todo con pickle...")
-            # Si hay objetos que no son JSON serializables, usa pickle
-            pickled_data = pickle.dumps(value)
-            encoded_data = base64.b64encode(pickled_data).decode('utf-8')
-            doc_ref.set({"pickled_data": encoded_data})
-    
-    def delete(self, key: str) -> None:
-        """
-        Elimina un estado guardado.
-        
-        Args:
-            key: Clave del estado a eliminar
-        """
-        # Elimina de la caché
-        if key in self._cache:
-            del self._cache[key]
-        
-        # Elimina de Firestore
-        self.db.collection(self.collection_name).document(key).delete()
-    
-    def list_sessions(self):
-        """
-        Lista todas las sesiones existentes en la colección.
-        
-        Returns:
-            Lista de IDs de sesiones
-        """
-        try:
-            return [doc.id for doc in self.db.collection(self.collection_name).list_documents()]
-        except Exception as e:
-            print(f"Error al listar sesiones: {e}")
-            return []
+# El saver de Firestore (escrituras por diferencias) se comparte con api.py
+from firestore_saver import FirestoreSaver, session_record
+from write_behind import WriteBehindQueue
+from firestore_checkpointer import create_checkpointer, turn_input
 
 # Función para validar el estado antes de guardarlo
 def validate_state(state):
@@ -284,47 +140,34 @@ workflow.add_edge("hacer_lista_compra", "poner_precio")
 workflow.add_edge("poner_precio", END)
 workflow.add_edge("otros", END)
 
-# Usar InMemorySaver para LangGraph (mantiene la compatibilidad)
-# y nuestro FirestoreSaver personalizado para persistencia
-memory_saver = InMemorySaver()
+# El estado del grafo se guarda solo con el checkpointer persistente (los últimos
+# checkpoints de cada sesión); FirestoreSaver guarda los mensajes y metadata de la sesión
 firestore_saver = FirestoreSaver(
     collection_name="diet_conversations",
     project_id="diap3-458416",
     database_id="agente-context-prueba"
 )
+# Los guardados de cada turno se escriben en segundo plano
+write_behind = WriteBehindQueue(firestore_saver)
 
-# Compila el grafo con el guardado en memoria que usa LangGraph
-graph = workflow.compile(checkpointer=memory_saver)
+# Compila el grafo con el checkpointer configurado en CHECKPOINT_BACKEND
+checkpointer = create_checkpointer(db=firestore_saver.db)
+graph = workflow.compile(checkpointer=checkpointer)
 
 def generate_session_id():
     """
-    Genera un ID de sesión único basado en los IDs existentes.
+    Genera un ID de sesión único con el contador atómico de Firestore (sin listar la colección).
     
     Returns:
         ID de sesión generado
     """
     try:
-        # Obtener sesiones existentes
-        existing_sessions = firestore_saver.list_sessions()
-        
-        # Extraer números de las sesiones existentes con formato "usuario_X"
-        user_numbers = []
-        for session in existing_sessions:
-            try:
-                if session.startswith("usuario_"):
-                    num = int(session.split("_")[1])
-                    user_numbers.append(num)
-            except (ValueError, IndexError):
-                continue
-        
-        # Generar siguiente ID secuencial
-        next_number = max(user_numbers, default=0) + 1
-        return f"usuario_{next_number}"
+        return firestore_saver.allocate_session_id()
     except Exception as e:
         print(f"Error al generar ID de sesión: {e}")
         # Fallback a ID basado en timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        return f"usuario_{timestamp}"
+        return f"usuario_{timestamp}_{uuid.uuid4().hex[:6]}"
 
 def list_active_sessions():
     """
@@ -380,95 +223,51 @@ if __name__ == "__main__":
     
     print("\nBienvenido al asistente de dietas. Escribe 'salir' para terminar.")
     
-    # Intentar recuperar el estado de una conversación existente de Firestore
-    state = firestore_saver.get(session_id)
-    
-    # Si no hay estado previo, crear uno nuevo
-    if state is None:
-        state = {
-            "messages": [],
-            "intolerances": [],
-            "forbidden_foods": [],
-            "diet": {},
-            "budget": None,
-            "info_dietas": "",
-            "grocery_list": []
-        }
-    
-    # Añadir metadatos de la sesión si es nueva
-    if "metadata" not in state:
-        state["metadata"] = {
-            "created_at": datetime.datetime.now().isoformat(),
-            "last_active": datetime.datetime.now().isoformat(),
-            "session_id": session_id
-        }
-    else:
-        # Actualizar timestamp de última actividad
-        state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
+    config = {"configurable": {"thread_id": session_id}}
     
     while True:
         user_input = input("\nTú: ")
         if user_input.lower() in ["salir", "exit"]:
             print("Asistente: ¡Hasta pronto!")
-            # Actualizar timestamp de última actividad
-            if "metadata" in state:
-                state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-            # Guardar estado final explícitamente
-            if validate_state(state):
-                firestore_saver.put(session_id, state)
+            # Esperar a que se escriban todos los guardados pendientes
+            write_behind.close()
             break
-            
-        # Añade el mensaje del usuario al historial
-        state["messages"].append({"role": "user", "content": user_input})
-        prev_len = len(state["messages"])
+        
+        # El checkpointer recupera el estado de la sesión: solo se envía el mensaje nuevo
+        graph_input = turn_input(session_id, user_input)
         
         try:
-            result = graph.invoke(
-                state,
-                config={"configurable": {"thread_id": session_id}},
-            )
-            state = result  # Mantén el estado actualizado
-            
-            # Actualizar timestamp de última actividad
-            if "metadata" in state:
-                state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
+            state = graph.invoke(graph_input, config=config, durability="exit")
             
-            # Imprime SOLO los mensajes nuevos del asistente generados en este turno
-            new_msgs = state["messages"][prev_len:]
-            assistant_msgs = [m for m in new_msgs if m.get("role") == "assistant"]
-            if assistant_msgs:
-                print(f"Asistente: {assistant_msgs[-1]['content']}")
+            # Imprime SOLO la respuesta del asistente generada en este turno
+            respuesta = last_reply(state["messages"])
+            if respuesta:
+                print(f"Asistente: {respuesta}")
             else:
                 print("Asistente: (No hay respuesta del asistente en este turno)")
             
-            # Validar y guardar explícitamente en Firestore después de cada interacción
+            # Validar y guardar los mensajes y metadata en Firestore (en segundo plano)
             if validate_state(state):
-                firestore_saver.put(session_id, state)
+                write_behind.submit(session_id, session_record(state))
             
         except Exception as e:
             print(f" Hubo un problema ejecutando el asistente: {str(e)}")
             print("Detalles del error:")
             traceback.print_exc()
             
-            # Intenta guardar el estado actual, incluso si hubo un error
-            if "metadata" in state:
-                state["metadata"]["last_active"] = datetime.datetime.now().isoformat()
-                state["metadata"]["last_error"] = str(e)
+            # Registra el error en el último estado guardado de la sesión
+            state = dict(graph.get_state(config).values)
+            if state:
+                state["metadata"] = {
+                    **state.get("metadata", {}),
+                    "last_active": datetime.datetime.now().isoformat(),
+                    "last_error": str(e),
+                }
             
-            if validate_state(state):
-                print("Guardando el estado actual a pesar del error...")
+            if state and validate_state(state):
+                print("Registrando el error en la sesión...")
                 try:
-                    firestore_saver.put(session_id, state)
+                    firestore_saver.put(session_id, session_record(state))
                 except Exception as save_error:
-                    print(f"Error al guardar el estado: {save_error}")
-                    # Último recurso: serializar todo con pickle
-                    try:
-                        print("Intentando serializar todo con pickle...")
-                        pickled_data = pickle.dumps(state)
-                        encoded_data = base64.b64encode(pickled_data).decode('utf-8')
-                        doc_ref = firestore_saver.db.collection(firestore_saver.collection_name).document(session_id)
-                        doc_ref.set({"pickled_data": encoded_data})
-                        print("Estado guardado con pickle")
-                    except Exception as pickle_error:
-                        print(f"Error al serializar con pickle: {pickle_error}")
-            continue
\ No newline at end of file
+                    print(f"Error al guardar la sesión: {save_error}")
+            continue
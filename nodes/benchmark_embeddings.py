@@ -0,0 +1,143 @@
+"""
+Benchmark de backends de embeddings frente al modelo de referencia (e5-large, torch fp32).
+
+Para cada configuración mide, en un proceso aislado:
+  - tiempo de carga y memoria residente (pico de RSS) tras cargar y codificar
+  - latencia de codificación de consultas (una a una) y de pasajes (en batch)
+  - concordancia de recuperación: solapamiento del top-k de productos frente a la referencia
+    y, si la dimensión coincide, coseno medio entre los embeddings de ambos modelos
+
+Uso:
+    python nodes/benchmark_embeddings.py
+    python nodes/benchmark_embeddings.py --configs torch onnx onnx-int8 small:onnx-int8 --top-k 5
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from embeddings import DEFAULT_MODEL_NAME, SMALL_MODEL_NAME, load_embedding_backend
+
+DEFAULT_QUERIES = [
+    "leche entera", "leche sin lactosa", "pan integral", "pan de molde sin gluten", "manzanas",
+    "plátano", "tomate", "tomate frito", "cebolla", "ajo", "patatas", "zanahoria", "lechuga",
+    "espinacas", "brócoli", "pechuga de pollo", "carne picada de ternera", "salmón", "merluza",
+    "atún en lata", "huevos", "yogur natural", "queso fresco", "mantequilla", "aceite de oliva virgen extra",
+    "arroz", "pasta integral", "lentejas", "garbanzos cocidos", "avena", "almendras", "nueces",
+    "bebida de soja", "tofu", "jamón cocido", "pimiento rojo", "calabacín", "fresas", "naranjas", "miel",
+]
+
+
+def _run_config(model_name, backend, queries, passages, result_queue):
+    """Se ejecuta en un proceso hijo para que la memoria de cada backend no se mezcle."""
+    start = time.perf_counter()
+    model = load_embedding_backend(model_name, backend)
+    load_seconds = time.perf_counter() - start
+
+    model.encode(["query: calentamiento"])
+
+    start = time.perf_counter()
+    passage_embeddings = model.encode([f"passage: {p}" for p in passages], batch_size=32)
+    passages_seconds = time.perf_counter() - start
+
+    query_latencies = []
+    query_embeddings = []
+    for query in queries:
+        start = time.perf_counter()
+        query_embeddings.append(model.encode(f"query: {query}"))
+        query_latencies.append(time.perf_counter() - start)
+
+    result_queue.put({
+        "load_s": load_seconds,
+        "passages_s": passages_seconds,
+        "query_p50_ms": float(np.percentile(query_latencies, 50) * 1000),
+        "query_p95_ms": float(np.percentile(query_latencies, 95) * 1000),
+        # ru_maxrss está en KB en Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "query_embeddings": np.vstack(query_embeddings),
+        "passage_embeddings": passage_embeddings,
+    })
+
+
+def run_config(model_name, backend, queries, passages):
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=_run_config, args=(model_name, backend, queries, passages, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def top_k_indices(query_embeddings, passage_embeddings, k):
+    scores = query_embeddings @ passage_embeddings.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def parse_config(config):
+    """'onnx-int8' usa el modelo por defecto; 'small:onnx-int8' usa la variante pequeña."""
+    if ":" in config:
+        model_alias, backend = config.split(":", 1)
+        model_name = SMALL_MODEL_NAME if model_alias == "small" else model_alias
+    else:
+        model_name, backend = DEFAULT_MODEL_NAME, config
+    return model_name, backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", nargs="+", default=["onnx", "onnx-int8", "small:torch", "small:onnx-int8"])
+    parser.add_argument("--catalog", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "precios.csv"))
+    parser.add_argument("--max-passages", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    catalog = pd.read_csv(args.catalog).fillna("")
+    passages = (catalog["Nombre"] + " " + catalog["Descripcion_del_producto"]).head(args.max_passages).tolist()
+    queries = DEFAULT_QUERIES
+
+    print(f"📊 {len(queries)} consultas contra {len(passages)} productos de {args.catalog}")
+    print(f"⏱️ Referencia: {DEFAULT_MODEL_NAME} (torch fp32)")
+    reference = run_config(DEFAULT_MODEL_NAME, "torch", queries, passages)
+    reference_top = top_k_indices(reference["query_embeddings"], reference["passage_embeddings"], args.top_k)
+
+    rows = [{
+        "config": "e5-large:torch (ref)", "load_s": reference["load_s"], "passages_s": reference["passages_s"],
+        "query_p50_ms": reference["query_p50_ms"], "query_p95_ms": reference["query_p95_ms"],
+        "peak_rss_mb": reference["peak_rss_mb"], f"top{args.top_k}_overlap": 1.0, "top1_agree": 1.0, "cosine_vs_ref": 1.0,
+    }]
+
+    for config in args.configs:
+        model_name, backend = parse_config(config)
+        print(f"⏱️ {config} ({model_name}, {backend})")
+        result = run_config(model_name, backend, queries, passages)
+        candidate_top = top_k_indices(result["query_embeddings"], result["passage_embeddings"], args.top_k)
+
+        overlap = np.mean([
+            len(set(ref_row) & set(cand_row)) / args.top_k
+            for ref_row, cand_row in zip(reference_top, candidate_top)
+        ])
+        top1_agree = float(np.mean(reference_top[:, 0] == candidate_top[:, 0]))
+        if result["passage_embeddings"].shape[1] == reference["passage_embeddings"].shape[1]:
+            cosine = float(np.mean(np.sum(result["passage_embeddings"] * reference["passage_embeddings"], axis=1)))
+        else:
+            cosine = float("nan")
+
+        rows.append({
+            "config": config, "load_s": result["load_s"], "passages_s": result["passages_s"],
+            "query_p50_ms": result["query_p50_ms"], "query_p95_ms": result["query_p95_ms"],
+            "peak_rss_mb": result["peak_rss_mb"], f"top{args.top_k}_overlap": overlap,
+            "top1_agree": top1_agree, "cosine_vs_ref": cosine,
+        })
+
+    print("\n" + pd.DataFrame(rows).to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+
+
+if __name__ == "__main__":
+    main()
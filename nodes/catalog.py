@@ -0,0 +1,256 @@
+"""
+Catálogo de productos de varios supermercados para poner precio a la lista de la compra.
+
+Cada supermercado es una tabla de BigQuery con el mismo esquema que
+food_data.mercadona_enriched_products_clean (Nombre, Precio, Descripcion_del_producto,
+off_product_name). Todos los productos van a un único DataFrame (store_id, product_id, name,
+description, unit_price, pack_size, pack_amount, pack_unit) con una sola matriz de embeddings
+compartida; la búsqueda codifica todos los artículos de la lista de una vez, hace un único
+producto de matrices contra el catálogo entero y saca el top-k de cada tienda filtrando
+columnas, así que añadir tiendas no multiplica el coste por artículo.
+
+El tamaño del envase se parsea una vez al cargar ("Bote 400 g", "3 bricks x 400 g",
+"Pieza 220 g aprox.", "Caja 12 ud.") a una cantidad normalizada en g, ml o ud, para que
+poner_precio calcule cuántos envases hacen falta y el coste real de cada artículo.
+
+Configuración:
+    CATALOG_STORES     tiendas y tablas, "mercadona=food_data.mercadona_enriched_products_clean,lidl=food_data.lidl_products"
+                       (por defecto solo Mercadona)
+    CATALOG_CACHE_DIR  carpeta donde se guardan los embeddings del catálogo (.catalog_cache)
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from embeddings import get_embedding_service
+from grocery import UNIT_FACTORS, WEIGHT_OR_VOLUME
+
+DEFAULT_PROJECT_ID = "diap3-458416"
+DEFAULT_STORE = "mercadona"
+DEFAULT_TABLE = "food_data.mercadona_enriched_products_clean"
+CATALOG_COLUMNS = ["store_id", "product_id", "name", "description", "unit_price", "pack_size", "pack_amount", "pack_unit"]
+
+_NUMBER = r"(\d+(?:[.,]\d+)?)"
+_MEASURE_UNIT = r"(kg|g|ml|cl|l)\b"
+# En orden de prioridad: peso escurrido, multipack "N <envases> x Q", primera medida, número de unidades
+PACK_DRAINED_PATTERN = re.compile(_NUMBER + r"\s*(kg|g)\s+escurrido", re.IGNORECASE)
+PACK_MULTI_PATTERN = re.compile(r"(\d+)\s*[^\d(]*?\bx\s*" + _NUMBER + r"\s*" + _MEASURE_UNIT, re.IGNORECASE)
+PACK_MEASURE_PATTERN = re.compile(_NUMBER + r"\s*" + _MEASURE_UNIT, re.IGNORECASE)
+PACK_COUNT_PATTERN = re.compile(r"(\d+)\s*(?:ud|uds|unidades)\b", re.IGNORECASE)
+
+
+def parse_stores(spec: Optional[str] = None, default_table: str = DEFAULT_TABLE) -> Dict[str, str]:
+    """'tienda=dataset.tabla,...' -> {tienda: tabla}"""
+    spec = spec if spec is not None else os.getenv("CATALOG_STORES", "")
+    stores = {}
+    for entry in spec.split(","):
+        if "=" in entry:
+            store, table = entry.split("=", 1)
+            stores[store.strip()] = table.strip()
+    return stores or {DEFAULT_STORE: default_table}
+
+
+class Catalog:
+    """Productos de todas las tiendas con una matriz de embeddings compartida (filas alineadas con products)"""
+
+    def __init__(self, products: pd.DataFrame, embeddings: np.ndarray, model=None):
+        self.products = products.reset_index(drop=True)
+        self.embeddings = embeddings
+        self.model = model or get_embedding_service()
+        self.stores = list(dict.fromkeys(self.products["store_id"]))
+        store_ids = self.products["store_id"].to_numpy()
+        self._store_rows = {store: np.flatnonzero(store_ids == store) for store in self.stores}
+
+    def __len__(self):
+        return len(self.products)
+
+    def search(self, queries: List[str], top_k: int = 1, stores: Optional[List[str]] = None,
+               min_score: float = 0.0) -> pd.DataFrame:
+        """
+        Top-k productos de cada tienda para cada consulta, en formato largo: una fila por
+        (item, store_id, rank) con las columnas del catálogo y el score (coseno).
+        item es la posición de la consulta en `queries`.
+        """
+        columns = ["item", "rank", "score"] + CATALOG_COLUMNS
+        if not queries or self.embeddings is None or not len(self.products):
+            return pd.DataFrame(columns=columns)
+
+        # Una sola codificación para toda la lista y un solo producto de matrices para todas las tiendas
+        query_embeddings = self.model.encode_queries(list(queries))
+        scores = query_embeddings @ self.embeddings.T
+
+        frames = []
+        for store in stores or self.stores:
+            rows = self._store_rows.get(store)
+            if rows is None or not len(rows):
+                continue
+            store_scores = scores[:, rows]
+            k = min(top_k, len(rows))
+            top = np.argpartition(-store_scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(store_scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            frame = self.products.iloc[rows[top].ravel()][CATALOG_COLUMNS].reset_index(drop=True)
+            frame.insert(0, "item", np.repeat(np.arange(len(queries)), k))
+            frame.insert(1, "rank", np.tile(np.arange(k), len(queries)))
+            frame.insert(2, "score", top_scores.ravel())
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        result = pd.concat(frames, ignore_index=True)
+        return result[result["score"] >= min_score].reset_index(drop=True)
+
+
+def _to_number(values: pd.Series) -> pd.Series:
+    return pd.to_numeric(values.str.replace(",", ".", regex=False), errors="coerce")
+
+
+def _unit_factors(units: pd.Series):
+    """Serie de unidades -> (unidad base, factor), NaN/None si la unidad no es de medida"""
+    normalized = units.fillna("").astype(str).str.lower().str.strip().str.rstrip(".")
+    base = normalized.map(lambda u: UNIT_FACTORS.get(u, (None, np.nan))[0])
+    factor = normalized.map(lambda u: UNIT_FACTORS.get(u, (None, np.nan))[1])
+    return base, factor.astype(float)
+
+
+def parse_pack_sizes(descriptions: pd.Series) -> pd.DataFrame:
+    """
+    Cantidad por envase de cada descripción, normalizada: pack_amount en g, ml o ud y
+    pack_unit ('g', 'ml', 'ud' o None si no se reconoce).
+        "Bote 400 g" -> 400 g, "3 bricks x 1 L" -> 3000 ml, "Pieza 220 g aprox." -> 220 g,
+        "Tarro 345 g (220 g escurrido)" -> 220 g, "Caja 12 ud." -> 12 ud
+    """
+    text = descriptions.fillna("").astype(str)
+    amount = pd.Series(np.nan, index=text.index)
+    unit = pd.Series(None, index=text.index, dtype=object)
+
+    drained = text.str.extract(PACK_DRAINED_PATTERN)
+    multi = text.str.extract(PACK_MULTI_PATTERN)
+    measure = text.str.extract(PACK_MEASURE_PATTERN)
+    count = text.str.extract(PACK_COUNT_PATTERN)
+
+    candidates = [
+        (_to_number(drained[0]), drained[1]),
+        (_to_number(multi[0]) * _to_number(multi[1]), multi[2]),
+        (_to_number(measure[0]), measure[1]),
+        (_to_number(count[0]), pd.Series("ud", index=text.index).where(count[0].notna())),
+    ]
+    for value, value_unit in candidates:
+        base, factor = _unit_factors(value_unit)
+        found = amount.isna() & value.notna() & base.notna()
+        amount[found] = value[found] * factor[found]
+        unit[found] = base[found]
+    return pd.DataFrame({"pack_amount": amount, "pack_unit": unit})
+
+
+def packs_needed(quantities, units, pack_amounts, pack_units) -> np.ndarray:
+    """
+    Envases necesarios para cubrir cada cantidad (vectorizado). g y ml se tratan como
+    equivalentes (densidad 1); si la unidad del artículo y la del envase no casan, o el
+    envase no tiene tamaño, se cuenta un envase.
+    """
+    quantities = pd.to_numeric(pd.Series(quantities), errors="coerce").to_numpy(dtype=float)
+    base, factor = _unit_factors(pd.Series(units).reset_index(drop=True))
+    needed = quantities * factor.to_numpy()
+    pack_amounts = pd.to_numeric(pd.Series(pack_amounts), errors="coerce").to_numpy(dtype=float)
+    pack_units = pd.Series(pack_units).reset_index(drop=True)
+
+    compatible = ((base == pack_units) | (base.isin(WEIGHT_OR_VOLUME) & pack_units.isin(WEIGHT_OR_VOLUME))).to_numpy()
+    valid = compatible & (pack_amounts > 0) & (needed > 0)
+    packs = np.ones(len(quantities))
+    # Tolerancia para que 1000 g en envases de 1 kg no salgan 2 envases por redondeo
+    packs[valid] = np.ceil(needed[valid] / pack_amounts[valid] - 1e-9)
+    return np.maximum(packs, 1.0)
+
+
+def _product_id(store: str, name: str, description: str) -> str:
+    return hashlib.sha1(f"{store}|{name}|{description}".encode("utf-8")).hexdigest()[:16]
+
+
+def load_store_products(client: bigquery.Client, store: str, table: str, project_id: str) -> pd.DataFrame:
+    """Productos con precio de una tienda, con las columnas del catálogo y el texto para los embeddings"""
+    table_ref = table if table.count(".") == 2 else f"{project_id}.{table}"
+    query = f"""
+        SELECT Nombre, Precio, Descripcion_del_producto, off_product_name
+        FROM `{table_ref}`
+        WHERE Nombre IS NOT NULL AND Precio IS NOT NULL
+    """
+    df = client.query(query).to_dataframe()
+    for col in ("Nombre", "Descripcion_del_producto", "off_product_name"):
+        df[col] = df[col].fillna("").astype(str)
+
+    products = pd.DataFrame({
+        "store_id": store,
+        "product_id": [_product_id(store, n, d) for n, d in zip(df["Nombre"], df["Descripcion_del_producto"])],
+        "name": df["Nombre"],
+        "description": df["Descripcion_del_producto"],
+        "unit_price": pd.to_numeric(df["Precio"], errors="coerce"),
+        "pack_size": df["Descripcion_del_producto"],
+        "search_text": df["Nombre"] + " " + df["Descripcion_del_producto"] + " " + df["off_product_name"],
+    })
+    products = pd.concat([products, parse_pack_sizes(products["pack_size"])], axis=1)
+    return products.dropna(subset=["unit_price"])
+
+
+def embed_products(texts: List[str], model) -> np.ndarray:
+    """Embeddings de los productos, guardados en disco por modelo y contenido para no recalcularlos en cada arranque"""
+    cache_dir = os.getenv("CATALOG_CACHE_DIR", ".catalog_cache")
+    key = hashlib.sha256(f"{model.model_name}|{model.backend.name}\n".encode("utf-8") +
+                         "\n".join(texts).encode("utf-8")).hexdigest()[:24]
+    path = os.path.join(cache_dir, f"embeddings_{key}.npy")
+    if os.path.exists(path):
+        return np.load(path)
+
+    # Textos repetidos (el mismo producto en varias tiendas) se codifican una sola vez
+    unique_texts, inverse = np.unique(np.asarray(texts, dtype=object), return_inverse=True)
+    embeddings = model.encode_passages(list(unique_texts))[inverse]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(path, embeddings)
+    except OSError as e:
+        print(f"⚠️ Could not cache catalog embeddings in {path}: {e}")
+    return embeddings
+
+
+def load_catalog(stores: Optional[Dict[str, str]] = None, project_id: str = DEFAULT_PROJECT_ID) -> Catalog:
+    stores = stores or parse_stores()
+    client = bigquery.Client(project=project_id)
+    model = get_embedding_service()
+
+    start = time.perf_counter()
+    frames = []
+    for store, table in stores.items():
+        try:
+            frames.append(load_store_products(client, store, table, project_id))
+        except Exception as e:
+            print(f"❌ Could not load catalog of {store} from {table}: {e}")
+    products = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=CATALOG_COLUMNS + ["search_text"])
+
+    embeddings = embed_products(products["search_text"].tolist(), model) if len(products) else None
+    counts = ", ".join(f"{store}: {n}" for store, n in products["store_id"].value_counts().items())
+    print(f"🛒 Catalog loaded in {time.perf_counter() - start:.1f}s ({counts or 'empty'})")
+    return Catalog(products, embeddings, model)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(project_id: str = DEFAULT_PROJECT_ID, default_table: str = DEFAULT_TABLE, refresh: bool = False) -> Catalog:
+    """Catálogo único del proceso: se carga de BigQuery en la primera llamada (o con refresh=True)"""
+    global _catalog
+    if _catalog is None or refresh:
+        with _catalog_lock:
+            if _catalog is None or refresh:
+                _catalog = load_catalog(parse_stores(default_table=default_table), project_id)
+    return _catalog
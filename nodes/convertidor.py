@@ -1,10 +1,11 @@
 import pandas as pd
+import numpy as np
 import math
 from typing import List, Dict, Tuple, Optional, Any
 from states import DietState
-from sentence_transformers import SentenceTransformer, util
-from google.cloud import bigquery
-import re
+from catalog import get_catalog, packs_needed
+from grocery import GroceryItem, ingredient_key
+from presupuesto import optimizar_cesta
 import logging
 import traceback
 import os
@@ -13,247 +14,51 @@ import os
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('convertidor')
 
-class BigQueryProductMatcher:
-    def __init__(
-        self, 
-        project_id: str = "diap3-458416",
-        dataset_id: str = "food_data", 
-        table_id: str = "mercadona_enriched_products_clean"
-    ):
-        """Initialize the product matcher with BigQuery connection details."""
-        self.project_id = project_id
-        self.dataset_id = dataset_id
-        self.table_id = table_id
-        
-        logger.info(f"Initializing BigQuery connection to {project_id}.{dataset_id}.{table_id}")
-        # Try to initialize the client with explicit project and more error handling
-        try:
-            # Ensure we have the project ID in environment variables
-            os.environ['GOOGLE_CLOUD_PROJECT'] = project_id
-            
-            # Initialize BigQuery client with explicit project ID
-            self.client = bigquery.Client(project=project_id)
-            
-            # Test the connection immediately
-            self.client.list_datasets(max_results=1)
-            logger.info("✅ Successfully connected to BigQuery")
-        except Exception as e:
-            logger.error(f"❌ Failed to connect to BigQuery: {e}")
-            logger.error(f"Error details: {traceback.format_exc()}")
-            # Continue initialization, we'll check for client before queries
-            self.client = None
-        
-        logger.info("Loading sentence transformer model")
-        self.model = SentenceTransformer('intfloat/multilingual-e5-large')
-        
-        self.precios_df = None
-        self.productos_embeddings = None
-        self.productos = None
-        
-        # Load data from BigQuery if client was initialized successfully
-        if self.client:
-            self.load_data()
-        else:
-            logger.error("BigQuery client initialization failed. Cannot load data.")
-    
-    def load_data(self) -> None:
-        """Load product data from BigQuery and prepare embeddings."""
-        try:
-            # First check if the table exists
-            try:
-                dataset_ref = self.client.dataset(self.dataset_id)
-                table_ref = dataset_ref.table(self.table_id)
-                self.client.get_table(table_ref)
-                logger.info(f"✅ Table {self.project_id}.{self.dataset_id}.{self.table_id} exists")
-            except Exception as e:
-                logger.error(f"❌ Table {self.project_id}.{self.dataset_id}.{self.table_id} does not exist: {e}")
-                logger.error(f"Error details: {traceback.format_exc()}")
-                return
-                
-            logger.info("Executing BigQuery query to retrieve product data...")
-            query = f"""
-                SELECT
-                    Nombre,
-                    Precio,
-                    Descripcion_del_producto,
-                    off_product_name
-                FROM
-                    `{self.project_id}.{self.dataset_id}.{self.table_id}`
-                WHERE
-                    Nombre IS NOT NULL AND Precio IS NOT NULL 
-                LIMIT 1000  /* Limiting to 1000 rows for faster processing */
-            """
-            
-            # Execute query with timeout (FIXED: changed timeout_ms to timeout)
-            job_config = bigquery.QueryJobConfig()
-            # Set timeout as a property (60 seconds)
-            job_config.timeout = 60  # Timeout in seconds
-            
-            query_job = self.client.query(query, job_config=job_config)
-            logger.info(f"BigQuery job {query_job.job_id} started")
-            
-            self.precios_df = query_job.to_dataframe()
-            logger.info(f"Query complete. Retrieved {len(self.precios_df)} rows")
-            
-            if self.precios_df.empty:
-                logger.warning("No products found in the BigQuery table")
-                return
-            
-            # Fill missing values with defaults
-            text_columns = ['Nombre', 'Descripcion_del_producto', 'off_product_name']
-            for col in text_columns:
-                if col in self.precios_df.columns:
-                    self.precios_df[col] = self.precios_df[col].fillna('').astype(str)
-                
-            # Combine product information for better semantic matching
-            logger.info("Creating combined product descriptions for semantic matching...")
-            self.productos = (
-                self.precios_df['Nombre'] + " " +
-                self.precios_df['Descripcion_del_producto'] + " " +
-                self.precios_df['off_product_name']
-            ).tolist()
-            
-            # Pre-compute embeddings for all products
-            logger.info("Computing embeddings for all products (this may take a moment)...")
-            self.productos_embeddings = self.model.encode(self.productos, convert_to_tensor=True)
-            logger.info(f"✅ Successfully loaded {len(self.productos)} products from BigQuery")
-            
-        except Exception as e:
-            logger.error(f"Error loading data from BigQuery: {e}")
-            logger.error(f"Error details: {traceback.format_exc()}")
-            logger.warning("Could not load product data from BigQuery. Product matching will not work.")
-    
-    def buscar_producto(self, prompt_usuario: str, unidad_requerida: str = None, top_k: int = 5) -> List[Dict[str, Any]]:
-        """
-        Find the top_k most similar products to the user prompt.
-        Optionally filter by unit of measurement.
-        Returns a list of dictionaries with product details and similarity scores.
-        """
-        if self.precios_df is None or self.productos_embeddings is None:
-            logger.warning("No product data available. BigQuery query may have failed.")
-            return []
-            
-        try:
-            # Standardize unit names if provided
-            if unidad_requerida:
-                unidad_requerida = self._normalizar_unidad(unidad_requerida)
-                
-            # Encode the user prompt
-            prompt_emb = self.model.encode(prompt_usuario, convert_to_tensor=True)
-            
-            # Calculate similarity scores
-            similitudes = util.cos_sim(prompt_emb, self.productos_embeddings)[0]
-            
-            # Get top_k indices
-            top_valores, top_indices = similitudes.topk(min(top_k * 3, len(similitudes)))
-            
-            resultados = []
-            for i, idx in enumerate(top_indices.cpu().numpy()):
-                score = similitudes[idx].item()
-                fila = self.precios_df.iloc[idx]
-                
-                resultados.append({
-                    'Nombre': fila['Nombre'],
-                    'Precio': fila['Precio'],
-                    'Descripcion': fila.get('Descripcion_del_producto', ''),
-                    'Score': score,
-                })
-                
-                # Stop once we have enough results
-                if len(resultados) >= top_k:
-                    break
-                
-            return resultados
-            
-        except Exception as e:
-            logger.error(f"Error searching for products: {e}")
-            logger.error(f"Error details: {traceback.format_exc()}")
-            return []
-    
-    def _normalizar_unidad(self, unidad: str) -> str:
-        """Normalize unit names for better matching."""
-        unidad = unidad.lower().strip()
-        
-        # Mapping of common unit variations
-        unidades_map = {
-            # Weight units
-            'g': 'gramos', 'gr': 'gramos', 'gram': 'gramos', 'gramo': 'gramos', 'grs': 'gramos',
-            'kg': 'kilogramos', 'kilo': 'kilogramos', 'kilos': 'kilogramos', 'kilogramo': 'kilogramos',
-            
-            # Volume units
-            'l': 'litros', 'lt': 'litros', 'ltr': 'litros', 'litro': 'litros',
-            'ml': 'mililitros', 'mililitro': 'mililitros',
-            
-            # Count units
-            'ud': 'unidad', 'und': 'unidad', 'unid': 'unidad', 'u': 'unidad',
-            'uds': 'unidades', 'unds': 'unidades', 'unids': 'unidades',
-            'pza': 'unidad', 'pzas': 'unidades', 'pieza': 'unidad', 'piezas': 'unidades',
-        }
-        
-        # Return mapped unit or original if not in map
-        return unidades_map.get(unidad, unidad)
-    
-    def parse_grocery_item(self, item: str) -> Optional[Dict[str, Any]]:
-        """
-        Parse a grocery list item in format "product: quantity unit".
-        Returns a dictionary with parsed information or None if format is invalid.
-        """
-        match = re.match(r"^(.+?):\s*([\d\.]+)\s*(\w+)$", item)
-        if not match:
-            logger.warning(f"Unrecognized format: '{item}'")
-            return None
-            
-        articulo = match.group(1).strip()
-        cantidad = float(match.group(2).replace(",", "."))
-        unidad = match.group(3).strip()
-        
-        return {
-            'Producto': articulo,
-            'Cantidad': cantidad,
-            'Unidades': unidad
-        }
+# Minimum cosine similarity for a catalog product to count as a match
+SIMILARITY_THRESHOLD = float(os.getenv("PRICE_SIMILARITY_THRESHOLD", "0.3"))
+# Candidate products per item and store, alternatives for fitting the basket to the budget
+PRICE_CANDIDATES = int(os.getenv("PRICE_CANDIDATES", "5"))
 
 
-def buscar_precio_bigquery(lista_compra_row, matcher):
+def coste_real(matches: pd.DataFrame, lista_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Find price information for a product in the grocery list using the matcher.
-    Returns the exact price from BigQuery without any multiplication.
+    Packs needed to cover each item's quantity and their real cost, for every matched product
+    at once: adds `packs` (from the pack size parsed in the catalog) and `cost` = packs * price.
     """
-    try:
-        producto_lc = str(lista_compra_row['Producto'])
-        cantidad_lc = float(lista_compra_row['Cantidad'])
-        unidad_lc = str(lista_compra_row['Unidades'])
-        
-        logger.info(f"Buscando precio para: {cantidad_lc} {unidad_lc} de '{producto_lc}'")
-        
-        # Get the best match using semantic search
-        matches = matcher.buscar_producto(producto_lc, top_k=1)
-        
-        if not matches:
-            logger.info(f"No matching products found for '{producto_lc}'")
-            return None, None
-            
-        match = matches[0]
-        
-        # Skip if score is too low
-        similarity_threshold = 0.3  # Adjust as needed
-        if match['Score'] < similarity_threshold:
-            logger.info(f"Match found for '{producto_lc}' but score too low: {match['Score']:.2f}")
-            return None, None
-            
-        precio = match['Precio']
-        nombre_producto = match['Nombre']
-        
-        # No multiplication, return the exact price from BigQuery
-        logger.info(f"Producto encontrado: {nombre_producto} (score: {match['Score']:.2f})")
-        logger.info(f"Precio: €{precio:.2f}")
-        
-        return precio, nombre_producto
-        
-    except Exception as e:
-        logger.error(f"Error al buscar precio para {lista_compra_row.get('Producto', 'unknown')}: {e}")
-        logger.error(f"Error details: {traceback.format_exc()}")
-        return None, None
+    items = lista_df.reindex(matches['item'].to_numpy())
+    matches = matches.copy()
+    matches['packs'] = packs_needed(items.get('Cantidad', pd.Series(dtype=float)).to_numpy(),
+                                    items.get('Unidades', pd.Series(dtype=object)).to_numpy(),
+                                    matches['pack_amount'].to_numpy(), matches['pack_unit'].to_numpy())
+    matches['cost'] = matches['packs'] * matches['unit_price'].astype(float)
+    return matches
+
+
+def precios_por_tienda(lista_df: pd.DataFrame, catalog, top_k: int = PRICE_CANDIDATES) -> pd.DataFrame:
+    """
+    Top-k catalog matches of every grocery item in every store, in a single batched search.
+    Returns one row per (item, store_id, rank) with the product, its shelf price and the
+    real cost of the packs needed; rank 0 is the best match.
+    """
+    matches = catalog.search(lista_df['Producto'].astype(str).tolist(), top_k=top_k, min_score=SIMILARITY_THRESHOLD)
+    return coste_real(matches, lista_df)
+
+
+def resumen_cesta(matches: pd.DataFrame, total_items: int) -> Dict[str, Any]:
+    """
+    Basket total per store and the cheapest one. Stores that cover more items of the list
+    win first, so a store is not cheaper just because it has fewer of the products.
+    """
+    if matches.empty:
+        return {"stores": {}, "cheapest_store": None, "items": total_items}
+    totals = matches.groupby('store_id').agg(total=('cost', 'sum'), matched=('item', 'nunique'))
+    ranking = totals.sort_values(['matched', 'total'], ascending=[False, True])
+    return {
+        "stores": {store: {"total": round(float(row.total), 2), "matched": int(row.matched)}
+                   for store, row in ranking.iterrows()},
+        "cheapest_store": ranking.index[0],
+        "items": total_items,
+    }
 
 
 # ✅ NODO: función para el workflow
@@ -262,89 +67,85 @@ def poner_precio(state: DietState,
                  dataset_id: str = "food_data",
                  table_id: str = "mercadona_enriched_products_clean") -> DietState:
     """
-    Process the grocery list in the state, find product matches and prices using BigQuery.
-    This function is designed to work with LangGraph workflows.
+    Price the grocery list in the state against every store of the catalog in one batched
+    pass, keep per-item prices of each store and pick the store with the cheapest basket.
+    The given table is the default catalog when CATALOG_STORES is not set.
     """
-    logger.info("Starting price estimation process with BigQuery")
+    logger.info("Starting price estimation process with the product catalog")
     
     try:
-        # Initialize the product matcher with BigQuery
-        matcher = BigQueryProductMatcher(
-            project_id=project_id,
-            dataset_id=dataset_id,
-            table_id=table_id
-        )
-        
-        # Check if the client was initialized successfully
-        if matcher.client is None:
-            logger.error("BigQuery client initialization failed. Cannot continue with price estimation.")
-            return state
-        
-        # Check if we have product data
-        if matcher.precios_df is None or matcher.productos_embeddings is None:
-            logger.error("Product data not loaded from BigQuery. Cannot continue with price estimation.")
-            return state
-        
         # Check if we have a grocery list in the state
         if not state.grocery_list:
             logger.warning("La lista de la compra está vacía en el estado.")
             return state
+
+        catalog = get_catalog(project_id=project_id, default_table=f"{dataset_id}.{table_id}")
+        if not len(catalog):
+            logger.error("Product catalog is empty. Cannot continue with price estimation.")
+            return state
         
-        # Process grocery list items
-        items_to_process = []
-        
-        # Check if the grocery list contains strings or dictionaries
-        if all(isinstance(item, str) for item in state.grocery_list):
-            # Parse string items (format: "product: quantity unit")
-            for item in state.grocery_list:
-                parsed = matcher.parse_grocery_item(item)
-                if parsed:
-                    items_to_process.append(parsed)
-                else:
-                    logger.warning(f"Could not parse item: '{item}'")
-        else:
-            # Assume already parsed items
-            items_to_process = state.grocery_list
+        # Structured rows from generar_lista_compra_csv (Producto, Cantidad, Unidades)
+        items_to_process = [GroceryItem.from_row(row).to_row() for row in state.grocery_list if isinstance(row, dict)]
         
         if not items_to_process:
             logger.warning("No valid items to process in the grocery list.")
             return state
         
         # Create DataFrame from items
-        lista_df = pd.DataFrame(items_to_process)
-        
-        # Apply price search to each row
-        results = []
-        for _, row in lista_df.iterrows():
-            precio, producto_coincidente = buscar_precio_bigquery(row, matcher)
-            
-            result_row = row.to_dict()
-            result_row.update({
-                'Precio_Unitario': precio,
-                'Producto_Coincidente': producto_coincidente
-            })
-            
-            results.append(result_row)
+        lista_df = pd.DataFrame(items_to_process).reset_index(drop=True)
         
-        # Convert results to DataFrame
-        result_df = pd.DataFrame(results)
+        candidatos = precios_por_tienda(lista_df, catalog)
+        matches = candidatos[candidatos['rank'] == 0]
+        cesta = resumen_cesta(matches, len(lista_df))
+        tienda = cesta["cheapest_store"]
+
+        # Items priced at the chosen store, plus what every store offers for them
+        elegidos = matches[matches['store_id'] == tienda].set_index('item')
+        if state.budget is not None and tienda is not None:
+            ajuste = optimizar_cesta(candidatos[candidatos['store_id'] == tienda], float(state.budget),
+                                     state.forbidden_foods, claves=lista_df['Producto'].map(ingredient_key).to_dict())
+            elegidos = ajuste["elegidos"].combine_first(elegidos)
+            cesta["budget"] = {k: v for k, v in ajuste.items() if k != "elegidos"}
+            cesta["budget"]["budget"] = float(state.budget)
+            for swap in ajuste["swaps"]:
+                logger.info(f"💶 {lista_df.at[swap['item'], 'Producto']}: {swap['de']} -> {swap['a']} (-€{swap['ahorro']:.2f})")
+            for cambio in ajuste["cambios_sugeridos"]:
+                logger.info(f"💡 {lista_df.at[cambio['item'], 'Producto']}: could switch {cambio['de']} -> {cambio['a']} "
+                            f"(-€{cambio['ahorro']:.2f}, not applied)")
+            logger.info(f"💶 Budget €{float(state.budget):.2f}: basket €{ajuste['total']:.2f} "
+                        f"({'fits' if ajuste['fits'] else 'does not fit'}, {ajuste['method']}, {ajuste['ms']} ms)")
+        por_tienda = {
+            item: {row.store_id: {'Precio': float(row.unit_price), 'Precio_Estimado': round(float(row.cost), 2),
+                                  'Unidades_Necesarias': float(row.packs), 'Producto': row.name,
+                                  'Score': round(float(row.score), 3)}
+                   for row in grupo.itertuples()}
+            for item, grupo in matches.groupby('item')
+        }
+        result_df = lista_df.copy()
+        result_df['Precio_Unitario'] = elegidos['unit_price'].reindex(result_df.index)
+        result_df['Producto_Coincidente'] = elegidos['name'].reindex(result_df.index)
+        # Best match that the budget swapped for a cheaper substitute, so the change is visible
+        swaps = (cesta.get("budget") or {}).get("swaps", [])
+        originales = pd.Series({swap['item']: swap['de'] for swap in swaps}, dtype=object)
+        result_df['Producto_Original'] = originales.reindex(result_df.index)
+        result_df['Tamano_Envase'] = elegidos['pack_size'].reindex(result_df.index)
+        result_df['Unidades_Necesarias'] = elegidos['packs'].reindex(result_df.index)
+        result_df['Precio_Estimado'] = elegidos['cost'].round(2).reindex(result_df.index)
+        result_df['Tienda'] = tienda
+        result_df['Precios_Por_Tienda'] = [por_tienda.get(i, {}) for i in result_df.index]
+        result_df = result_df.astype(object).where(result_df.notna(), None)
         
         # Log match statistics
         matched_count = result_df['Precio_Unitario'].notna().sum()
         total_count = len(result_df)
         match_percentage = (matched_count/total_count*100) if total_count > 0 else 0
-        logger.info(f"Matched {matched_count} of {total_count} products ({match_percentage:.1f}%)")
-        
-        # Save results to CSV
-        try:
-            result_df.to_csv('lista_compra_con_precio.csv', index=False, encoding='utf-8')
-            logger.info("✅ Se ha generado el archivo lista_compra_con_precio.csv con precios unitarios.")
-        except Exception as e:
-            logger.error(f"Error saving results to CSV: {e}")
-            logger.error(f"Error details: {traceback.format_exc()}")
+        logger.info(f"Matched {matched_count} of {total_count} products at {tienda} ({match_percentage:.1f}%)")
+        for store, resumen in cesta["stores"].items():
+            logger.info(f"🛒 {store}: €{resumen['total']:.2f} ({resumen['matched']}/{total_count} products)")
         
         # Update the state with the results
         state.grocery_list = result_df.to_dict(orient='records')
+        state.basket = cesta
         
         return state
         
@@ -360,13 +161,16 @@ if __name__ == "__main__":
     class MockDietState:
         def __init__(self):
             self.grocery_list = [
-                "Leche: 2 litros",
-                "Pan: 1 unidad", 
-                "Manzanas: 1.5 kg",
-                "Yogur natural: 6 unidades"
+                {"Producto": "Leche", "Cantidad": 2, "Unidades": "litros"},
+                {"Producto": "Pan", "Cantidad": 1, "Unidades": "unidad"},
+                {"Producto": "Manzanas", "Cantidad": 1.5, "Unidades": "kg"},
+                {"Producto": "Yogur natural", "Cantidad": 6, "Unidades": "unidades"}
             ]
+            self.budget = None
+            self.forbidden_foods = []
+            self.basket = {}
     
-    print("BigQuery Product Matcher Test")
+    print("Catalog Price Estimation Test")
     print("-----------------------------")
     
     # Create a mock state
@@ -380,11 +184,11 @@ if __name__ == "__main__":
         print("\nProcessed grocery list with prices:")
         for item in updated_state.grocery_list:
             producto = item.get('Producto', '?')
-            precio = item.get('Precio_Unitario', None)
+            precio = item.get('Precio_Estimado', None)
             coincidente = item.get('Producto_Coincidente', 'No encontrado')
             
             if precio:
-                print(f"✅ {producto}: €{precio:.2f} ({coincidente})")
+                print(f"✅ {producto}: €{precio:.2f} ({item.get('Unidades_Necesarias'):.0f} x {coincidente})")
             else:
                 print(f"❌ {producto}: No encontrado")
     else:
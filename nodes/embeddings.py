@@ -0,0 +1,247 @@
+"""
+Backends de embeddings para el modelo e5 usado en el RAG de dietas y en el matching de precios.
+
+El backend y el modelo se eligen por configuración (variables de entorno o .env):
+
+    EMBEDDING_MODEL             intfloat/multilingual-e5-large (por defecto) o una variante
+                                más pequeña como intfloat/multilingual-e5-small
+    EMBEDDING_BACKEND           torch (fp32, por defecto) | onnx | onnx-int8
+    EMBEDDING_ONNX_QUANTIZATION avx512_vnni (por defecto) | avx2 | arm64
+    EMBEDDING_CACHE_DIR         carpeta donde se guarda la exportación cuantizada
+    EMBEDDING_MAX_BATCH         tamaño máximo de cada micro-batch del servicio compartido (64)
+    EMBEDDING_MAX_WAIT_MS       espera máxima para agrupar peticiones concurrentes (5 ms)
+
+Los nodos no deben cargar el modelo por su cuenta: get_embedding_service() devuelve el servicio
+único del proceso, con encode_queries()/encode_passages() que ya añaden los prefijos de e5.
+
+Ojo: e5-small/base tienen otra dimensión (384/768) que e5-large (1024), así que cambiar
+de modelo obliga a re-indexar la colección de Weaviate con rag/loaderRag.py.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_MODEL_NAME = "intfloat/multilingual-e5-large"
+SMALL_MODEL_NAME = "intfloat/multilingual-e5-small"
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+class EmbeddingBackend:
+    """Interfaz común: encode() devuelve siempre un np.ndarray float32 normalizado (L2)."""
+
+    name = "base"
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.model = None
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(texts, str)
+        embeddings = self.model.encode(
+            [texts] if single else list(texts),
+            batch_size=batch_size,
+            show_progress_bar=show_progress_bar,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        ).astype(np.float32, copy=False)
+        return embeddings[0] if single else embeddings
+
+    @property
+    def dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    @property
+    def max_seq_length(self) -> int:
+        return self.model.max_seq_length
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def __repr__(self):
+        return f"{type(self).__name__}(model={self.model_name!r}, backend={self.name!r})"
+
+
+class TorchBackend(EmbeddingBackend):
+    """SentenceTransformer en PyTorch fp32 (comportamiento original)."""
+
+    name = "torch"
+
+    def __init__(self, model_name: str, device: str = None):
+        super().__init__(model_name)
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = SentenceTransformer(model_name, device=device)
+
+
+class OnnxBackend(EmbeddingBackend):
+    """SentenceTransformer sobre ONNX Runtime (CPU), fp32."""
+
+    name = "onnx"
+
+    def __init__(self, model_name: str):
+        super().__init__(model_name)
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+
+
+class QuantizedOnnxBackend(EmbeddingBackend):
+    """
+    Mismo modelo exportado a ONNX con cuantización dinámica int8.
+    La primera vez se exporta y se guarda en EMBEDDING_CACHE_DIR; después se carga directamente.
+    """
+
+    name = "onnx-int8"
+
+    def __init__(self, model_name: str, quantization: str = None, cache_dir: str = None):
+        super().__init__(model_name)
+        from sentence_transformers import SentenceTransformer
+
+        quantization = quantization or os.getenv("EMBEDDING_ONNX_QUANTIZATION", "avx512_vnni")
+        cache_dir = cache_dir or os.getenv(
+            "EMBEDDING_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nutribot-embeddings")
+        )
+        export_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        file_name = f"onnx/model_qint8_{quantization}.onnx"
+
+        if not os.path.exists(os.path.join(export_dir, file_name)):
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+
+            print(f"🧮 Exportando {model_name} a ONNX int8 ({quantization}) en {export_dir}...")
+            fp32_model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+            fp32_model.save(export_dir)
+            export_dynamic_quantized_onnx_model(fp32_model, quantization, export_dir)
+            del fp32_model
+
+        self.model = SentenceTransformer(
+            export_dir, backend="onnx", device="cpu", model_kwargs={"file_name": file_name}
+        )
+
+
+def load_embedding_backend(model_name: str = None, backend: str = None, **kwargs) -> EmbeddingBackend:
+    """
+    Crea el backend de embeddings indicado (o el configurado en EMBEDDING_MODEL / EMBEDDING_BACKEND).
+    """
+    model_name = model_name or os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL_NAME)
+    backend = (backend or os.getenv("EMBEDDING_BACKEND", "torch")).lower()
+
+    if backend == "torch":
+        instance = TorchBackend(model_name, **kwargs)
+    elif backend == "onnx":
+        instance = OnnxBackend(model_name, **kwargs)
+    elif backend == "onnx-int8":
+        instance = QuantizedOnnxBackend(model_name, **kwargs)
+    else:
+        raise ValueError(f"EMBEDDING_BACKEND desconocido: '{backend}'. Opciones: {', '.join(BACKENDS)}")
+
+    print(f"✅ Embeddings: {instance}")
+    return instance
+
+
+class EmbeddingService:
+    """
+    Servicio de embeddings compartido por todo el proceso.
+
+    Las peticiones pequeñas (consultas de distintas sesiones) se encolan y un hilo las agrupa
+    en un único forward pass: espera como mucho max_wait_ms a que lleguen más o hasta juntar
+    max_batch_size textos. Las peticiones grandes (p. ej. el catálogo completo) ya van en batch
+    y se codifican directamente.
+    """
+
+    def __init__(self, backend: EmbeddingBackend, max_batch_size: int = 64, max_wait_ms: float = 5):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        is_e5 = "e5" in backend.model_name.lower()
+        self.query_prefix = "query: " if is_e5 else ""
+        self.passage_prefix = "passage: " if is_e5 else ""
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    @property
+    def model_name(self) -> str:
+        return self.backend.model_name
+
+    @property
+    def dimension(self) -> int:
+        return self.backend.dimension
+
+    def encode_queries(self, texts) -> np.ndarray:
+        """Embeddings de consultas de usuario (prefijo 'query: '). Devuelve una fila por texto."""
+        return self._encode([self.query_prefix + t for t in texts])
+
+    def encode_passages(self, texts, batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Embeddings de documentos/productos (prefijo 'passage: '). Devuelve una fila por texto."""
+        texts = [self.passage_prefix + t for t in texts]
+        if len(texts) >= self.max_batch_size:
+            return self.backend.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+        return self._encode(texts)
+
+    def _encode(self, texts) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        future = Future()
+        self._requests.put((texts, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._requests.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            # Agrupa las peticiones que lleguen durante la ventana de espera
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request[0])
+
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                embeddings = self.backend.encode(texts, batch_size=self.max_batch_size)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for request_texts, future in pending:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Devuelve el servicio de embeddings del proceso, cargando el modelo la primera vez."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService(
+                    load_embedding_backend(),
+                    max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH", "64")),
+                    max_wait_ms=float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5")),
+                )
+    return _service
@@ -1,9 +1,9 @@
 import weaviate
 from weaviate.classes.query import Filter
 from weaviate.classes.init import Auth
-import torch
-from sentence_transformers import SentenceTransformer
+from embeddings import get_embedding_service
 import os
+import threading
 from dotenv import load_dotenv
 from states import DietState
 from langchain.tools import tool
@@ -19,16 +19,28 @@ load_dotenv()
 WEAVIATE_URL = os.getenv("WEAVIATE_URL")
 WEAVIATE_API_KEY = os.getenv("WEAVIATE_API_KEY")
 CLASS_NAME = "InfoDietasAplanado"
-MODEL_NAME = "intfloat/multilingual-e5-large"
 
-# --- Inicialización de cliente y modelo de embeddings ---
-client = weaviate.connect_to_wcs(
-    cluster_url=WEAVIATE_URL,
-    auth_credentials=weaviate.auth.AuthApiKey(api_key=WEAVIATE_API_KEY),
-)
+# --- Cliente de Weaviate: se conecta en el primer uso y se reutiliza entre llamadas ---
+# (el modelo de embeddings es el servicio compartido del proceso, también perezoso)
+client = None
+_client_lock = threading.Lock()
+
+def get_weaviate_client():
+    """Devuelve el cliente de Weaviate, conectando (o reconectando) solo si hace falta."""
+    global client
+    with _client_lock:
+        if client is None or not client.is_connected():
+            client = weaviate.connect_to_wcs(
+                cluster_url=WEAVIATE_URL,
+                auth_credentials=weaviate.auth.AuthApiKey(api_key=WEAVIATE_API_KEY),
+            )
+        return client
+
+def warmup():
+    """Precarga el cliente de Weaviate y el modelo de embeddings (para el warm-up de la API)."""
+    get_weaviate_client()
+    get_embedding_service()
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-embedding_model = SentenceTransformer(MODEL_NAME, device=device)
 
 def buscar_info_dietas(state: DietState, k: int = 5) -> DietState:
     print("[NODE] experto_dietas")
@@ -43,10 +55,9 @@ def buscar_info_dietas(state: DietState, k: int = 5) -> DietState:
             query = last_msg.get("content", "")
         else:
             query = str(last_msg)
-        query_with_prefix = f"query: {query}" if "e5" in MODEL_NAME.lower() else query
-        query_embedding = embedding_model.encode(query_with_prefix).tolist()
+        query_embedding = get_embedding_service().encode_queries([query])[0].tolist()
 
-        collection = client.collections.get(CLASS_NAME)
+        collection = get_weaviate_client().collections.get(CLASS_NAME)
 
         results = collection.query.near_vector(
             near_vector=query_embedding,
@@ -76,11 +87,6 @@ def buscar_info_dietas(state: DietState, k: int = 5) -> DietState:
         state.info_dietas = f"[ERROR] No se encontró información relevante en la base de conocimiento. Detalles: {e}\nTraceback:\n{tb}"
         state.messages.append({"role": "assistant", "content": state.info_dietas})
         return state
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
     
 """
 PARA EL QUE LO QUIERA PROBAR QUE DESCOMENTE EL CODIGO DE ABAJO:
@@ -99,7 +105,5 @@ PARA EL QUE LO QUIERA PROBAR QUE DESCOMENTE EL CODIGO DE ABAJO:
 #         result = buscar_info_dietas(state)
 #         print(result)
 #     finally:
-#         try:
-#             client.close()
-#         except Exception:
-#             pass
\ No newline at end of file
+#         if client is not None:
+#             client.close()
\ No newline at end of file
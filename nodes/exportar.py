@@ -0,0 +1,49 @@
+"""
+Exportación de la lista de la compra de una sesión (CSV o XLSX), generada en memoria.
+
+Los nodos ya no escriben lista_compra.csv ni lista_compra_con_precio.csv en el directorio
+de trabajo: la lista vive en DietState.grocery_list (una fila por artículo, con los precios
+que añade poner_precio) y las APIs la convierten aquí solo cuando el usuario la descarga.
+Así no hay disco en cada turno ni sesiones que se pisen el archivo.
+"""
+import io
+from typing import Any, Dict, Iterable, Tuple
+
+import pandas as pd
+
+COLUMNAS_LISTA = ["Producto", "Cantidad", "Unidades"]
+COLUMNAS_PRECIO = COLUMNAS_LISTA + ["Producto_Coincidente", "Producto_Original", "Tamano_Envase",
+                                    "Unidades_Necesarias", "Precio_Unitario", "Precio_Estimado", "Tienda"]
+FORMATOS = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def lista_compra_df(grocery_list: Iterable[Dict[str, Any]], con_precio: bool = False) -> pd.DataFrame:
+    """Tabla de la lista de la compra; con_precio añade el producto elegido y su coste"""
+    columnas = COLUMNAS_PRECIO if con_precio else COLUMNAS_LISTA
+    filas = [item for item in grocery_list or [] if isinstance(item, dict)]
+    return pd.DataFrame(filas).reindex(columns=columnas)
+
+
+def exportar_lista_compra(grocery_list: Iterable[Dict[str, Any]], formato: str = "csv",
+                          con_precio: bool = False) -> Tuple[bytes, str, str]:
+    """
+    Contenido, tipo MIME y nombre de archivo de la lista exportada.
+    Lanza ValueError si el formato no es csv ni xlsx (o si falta openpyxl para xlsx).
+    """
+    formato = (formato or "csv").lower()
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato no soportado: {formato} (usa csv o xlsx)")
+    df = lista_compra_df(grocery_list, con_precio)
+    nombre = f"lista_compra{'_con_precio' if con_precio else ''}.{formato}"
+
+    if formato == "csv":
+        return df.to_csv(index=False).encode("utf-8"), FORMATOS[formato], nombre
+    buffer = io.BytesIO()
+    try:
+        df.to_excel(buffer, index=False, sheet_name="Lista de la compra", engine="openpyxl")
+    except ImportError as e:
+        raise ValueError("La exportación a xlsx necesita openpyxl") from e
+    return buffer.getvalue(), FORMATOS[formato], nombre
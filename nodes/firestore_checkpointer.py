@@ -0,0 +1,598 @@
+"""
+Checkpointer de LangGraph persistente, en Firestore (producción) o SQLite (local y pruebas).
+
+Sustituye a InMemorySaver, que guardaba en memoria todos los checkpoints de todas las
+conversaciones mientras viviera el proceso. Aquí cada hilo (session_id) conserva solo
+sus últimos CHECKPOINT_HISTORY checkpoints: al guardar uno nuevo se borran los más
+antiguos, junto con sus escrituras pendientes y los valores de canal que ya no usa
+ninguno de los que quedan. El estado sobrevive a los reinicios de la instancia y
+cualquier instancia de Cloud Run puede continuar cualquier conversación, así que cada
+turno solo tiene que enviar al grafo el mensaje nuevo (turn_input), sin leer nada antes.
+
+El estado del grafo solo vive en este checkpointer; FirestoreSaver guarda en
+diet_conversations los mensajes (historial completo para la UI) y metadata.
+
+Estructura en Firestore (colección CHECKPOINT_COLLECTION, por defecto diet_checkpoints):
+    {thread_id}                              updated_at
+    {thread_id}/checkpoints/{ns}#{id}        checkpoint sin valores + metadata + versiones
+    {thread_id}/blobs/{ns}#{canal}#{versión} valor de un canal en una versión
+    {thread_id}/writes/{ns}#{id}#{task}#{i}  escrituras pendientes de un checkpoint
+
+Configuración: CHECKPOINT_BACKEND (firestore | sqlite | memory), CHECKPOINT_HISTORY (3),
+CHECKPOINT_COLLECTION (diet_checkpoints), CHECKPOINT_SQLITE_PATH (checkpoints.sqlite).
+"""
+import asyncio
+import datetime
+import json
+import os
+import random
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+    writes_sort_key,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+import state_codec
+
+DEFAULT_HISTORY = 3
+
+# Los valores de canal y las escrituras se comprimen por encima de este tamaño; ninguno
+# puede superar el límite de 1 MiB por documento de Firestore
+COMPRESS_MIN_BYTES = 4096
+MAX_VALUE_BYTES = 1_000_000
+MAX_BATCH_WRITES = 500
+# Firestore rejects commits over 10 MiB; this leaves room for field names and paths
+MAX_BATCH_BYTES = 9_000_000
+
+
+class StateCodecSerializer:
+    """
+    Checkpoint serializer that keeps the state exactly as the nodes left it: plain data (the
+    diet with its (cantidad, unidad) tuples and int day keys) goes through state_codec, and
+    anything it cannot encode (LangChain messages, Send...) through LangGraph's serializer,
+    which turns tuples into lists.
+    """
+
+    TYPE = "state_codec"
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or JsonPlusSerializer()
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        try:
+            # The backends already compress large values
+            return self.TYPE, state_codec.encode(obj, compress=False)
+        except (TypeError, ValueError):
+            return self.fallback.dumps_typed(obj)
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_ == self.TYPE:
+            return state_codec.decode(payload)
+        return self.fallback.loads_typed(data)
+
+
+class _BoundedCheckpointSaver(BaseCheckpointSaver[str], ABC):
+    """
+    Common logic of the persistent checkpointers: keeps the last `history` checkpoints of
+    each thread and namespace. Subclasses only implement the storage operations (abstract,
+    so a backend that misses one fails when it is created).
+    """
+
+    def __init__(self, history: int = None, serde=None):
+        super().__init__(serde=serde or StateCodecSerializer())
+        self.history = max(1, history or int(os.getenv("CHECKPOINT_HISTORY", str(DEFAULT_HISTORY))))
+
+    # Storage operations ---------------------------------------------------------------
+
+    @abstractmethod
+    def _load_rows(self, thread_id, checkpoint_ns=None, checkpoint_id=None) -> List[Dict]:
+        """Checkpoints of a thread (all namespaces if checkpoint_ns is None), in any order"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _load_index(self, thread_id, checkpoint_ns) -> Dict[str, Dict]:
+        """checkpoint_id -> channel_versions of the stored checkpoints of a namespace"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _load_blobs(self, thread_id, checkpoint_ns, versions) -> Dict[str, Tuple[str, bytes]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _load_writes(self, thread_id, checkpoint_ns, checkpoint_id) -> List[Tuple]:
+        """Pending writes as (task_id, idx, channel, (type, bytes), task_path)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _save_checkpoint(self, thread_id, checkpoint_ns, row, blobs, drop_ids, drop_blobs) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _thread_ids(self) -> List[str]:
+        raise NotImplementedError
+
+    # BaseCheckpointSaver ----------------------------------------------------------------
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        rows = self._load_rows(thread_id, checkpoint_ns, get_checkpoint_id(config))
+        if not rows:
+            return None
+        return self._to_tuple(max(rows, key=lambda row: row["checkpoint_id"]))
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        thread_ids = [config["configurable"]["thread_id"]] if config else self._thread_ids()
+        checkpoint_ns = config["configurable"].get("checkpoint_ns") if config else None
+        checkpoint_id = get_checkpoint_id(config) if config else None
+        before_id = get_checkpoint_id(before) if before else None
+
+        for thread_id in thread_ids:
+            rows = self._load_rows(thread_id, checkpoint_ns, checkpoint_id)
+            for row in sorted(rows, key=lambda row: row["checkpoint_id"], reverse=True):
+                if before_id and row["checkpoint_id"] >= before_id:
+                    continue
+                metadata = self.serde.loads_typed(row["metadata"])
+                if filter and not all(metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield self._to_tuple(row, metadata)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        stored = checkpoint.copy()
+        values = stored.pop("channel_values")
+
+        # Only the channels that changed in this step get a new value
+        blobs = {
+            (channel, version): self.serde.dumps_typed(values[channel]) if channel in values else ("empty", b"")
+            for channel, version in new_versions.items()
+        }
+        row = {
+            "checkpoint_id": checkpoint["id"],
+            "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
+            "checkpoint": self.serde.dumps_typed(stored),
+            "metadata": self.serde.dumps_typed(get_checkpoint_metadata(config, metadata)),
+            "channel_versions": dict(checkpoint["channel_versions"]),
+        }
+
+        # Keep the newest `history` checkpoints and the values any of them still uses
+        index = self._load_index(thread_id, checkpoint_ns)
+        index[checkpoint["id"]] = row["channel_versions"]
+        keep = sorted(index, reverse=True)[:self.history]
+        drop_ids = [checkpoint_id for checkpoint_id in index if checkpoint_id not in keep]
+        used = {item for checkpoint_id in keep for item in index[checkpoint_id].items()}
+        drop_blobs = {item for checkpoint_id in drop_ids for item in index[checkpoint_id].items()} - used
+
+        self._save_checkpoint(thread_id, checkpoint_ns, row, blobs, drop_ids, drop_blobs)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        self._save_writes(thread_id, checkpoint_ns, checkpoint_id, [
+            (task_id, WRITES_IDX_MAP.get(channel, idx), channel, self.serde.dumps_typed(value), task_path)
+            for idx, (channel, value) in enumerate(writes)
+        ])
+
+    def get_next_version(self, current: Optional[str], channel=None) -> str:
+        # Same format as InMemorySaver: increasing number plus a random suffix
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # The graph runs synchronously in this project; the async API just runs the same code
+    # in a worker thread
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for item in await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def _to_tuple(self, row, metadata=None) -> CheckpointTuple:
+        thread_id, checkpoint_ns = row["thread_id"], row["checkpoint_ns"]
+        checkpoint = self.serde.loads_typed(row["checkpoint"])
+        values = {
+            channel: self.serde.loads_typed(blob)
+            for channel, blob in self._load_blobs(thread_id, checkpoint_ns, checkpoint["channel_versions"]).items()
+            if blob[0] != "empty"
+        }
+        writes = sorted(self._load_writes(thread_id, checkpoint_ns, row["checkpoint_id"]),
+                        key=lambda w: writes_sort_key(w[4], w[0], w[1]))
+        parent_id = row["parent_checkpoint_id"]
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": row["checkpoint_id"]}},
+            checkpoint={**checkpoint, "channel_values": values},
+            metadata=metadata if metadata is not None else self.serde.loads_typed(row["metadata"]),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                  "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed(value))
+                            for task_id, _, channel, value, _ in writes],
+        )
+
+
+class FirestoreCheckpointSaver(_BoundedCheckpointSaver):
+    """LangGraph checkpointer stored in Firestore, keeping only the latest checkpoints per thread."""
+
+    def __init__(self,
+                 collection_name: str = None,
+                 project_id: str = "diap3-458416",
+                 database_id: str = "agente-context-prueba",
+                 history: int = None,
+                 db=None,
+                 serde=None):
+        super().__init__(history=history, serde=serde)
+        from google.cloud import firestore
+        import zstandard
+        self._firestore = firestore
+        self._zstd = zstandard
+        self.collection_name = collection_name or os.getenv("CHECKPOINT_COLLECTION", "diet_checkpoints")
+        self.db = db or firestore.Client(project=project_id, database=database_id)
+        print(f"🔌 Checkpoints in Firestore (collection: {self.collection_name}, history: {self.history})")
+
+    def delete_thread(self, thread_id: str) -> None:
+        thread_ref = self._thread_ref(thread_id)
+        refs = [doc.reference
+                for name in ("checkpoints", "blobs", "writes")
+                for doc in thread_ref.collection(name).select([]).stream()]
+        refs.append(thread_ref)
+        for start in range(0, len(refs), MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for ref in refs[start:start + MAX_BATCH_WRITES]:
+                batch.delete(ref)
+            batch.commit()
+
+    def _thread_ref(self, thread_id):
+        return self.db.collection(self.collection_name).document(thread_id)
+
+    @staticmethod
+    def _doc_id(*parts):
+        # "/" is not allowed in document IDs and "#" separates the parts
+        return "#".join(quote(str(part), safe="") for part in parts)
+
+    def _load_rows(self, thread_id, checkpoint_ns=None, checkpoint_id=None):
+        checkpoints = self._thread_ref(thread_id).collection("checkpoints")
+        if checkpoint_id is not None and checkpoint_ns is not None:
+            doc = checkpoints.document(self._doc_id(checkpoint_ns, checkpoint_id)).get()
+            docs = [doc] if doc.exists else []
+        else:
+            query = checkpoints
+            if checkpoint_ns is not None:
+                query = query.where("checkpoint_ns", "==", checkpoint_ns)
+            if checkpoint_id is not None:
+                query = query.where("checkpoint_id", "==", checkpoint_id)
+            docs = query.stream()
+
+        rows = []
+        for doc in docs:
+            data = doc.to_dict()
+            rows.append({
+                "thread_id": thread_id,
+                "checkpoint_ns": data["checkpoint_ns"],
+                "checkpoint_id": data["checkpoint_id"],
+                "parent_checkpoint_id": data.get("parent_checkpoint_id"),
+                "checkpoint": (data["type"], self._unpack(data["checkpoint"], data.get("zstd"))),
+                "metadata": (data["metadata_type"], data["metadata"]),
+            })
+        return rows
+
+    def _load_index(self, thread_id, checkpoint_ns):
+        query = (self._thread_ref(thread_id).collection("checkpoints")
+                 .where("checkpoint_ns", "==", checkpoint_ns)
+                 .select(["checkpoint_id", "channel_versions"]))
+        return {doc.get("checkpoint_id"): json.loads(doc.get("channel_versions")) for doc in query.stream()}
+
+    def _load_blobs(self, thread_id, checkpoint_ns, versions):
+        blobs = self._thread_ref(thread_id).collection("blobs")
+        refs = [blobs.document(self._doc_id(checkpoint_ns, channel, version)) for channel, version in versions.items()]
+        result = {}
+        if refs:
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    data = doc.to_dict()
+                    result[data["channel"]] = (data["type"], self._unpack(data["data"], data.get("zstd")))
+        return result
+
+    def _load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        query = (self._thread_ref(thread_id).collection("writes")
+                 .where("checkpoint_ns", "==", checkpoint_ns)
+                 .where("checkpoint_id", "==", checkpoint_id))
+        writes = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            writes.append((data["task_id"], data["idx"], data["channel"],
+                           (data["type"], self._unpack(data["value"], data.get("zstd"))), data.get("task_path", "")))
+        return writes
+
+    def _save_checkpoint(self, thread_id, checkpoint_ns, row, blobs, drop_ids, drop_blobs):
+        thread_ref = self._thread_ref(thread_id)
+        checkpoint_data, checkpoint_zstd = self._pack(row["checkpoint"][1])
+        writes = [
+            ("set", thread_ref.collection("checkpoints").document(self._doc_id(checkpoint_ns, row["checkpoint_id"])), {
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": row["checkpoint_id"],
+                "parent_checkpoint_id": row["parent_checkpoint_id"],
+                "type": row["checkpoint"][0],
+                "checkpoint": checkpoint_data,
+                "zstd": checkpoint_zstd,
+                "metadata_type": row["metadata"][0],
+                "metadata": row["metadata"][1],
+                # As JSON: channel names such as __start__ are reserved field names in Firestore
+                "channel_versions": json.dumps(row["channel_versions"]),
+            }),
+        ]
+        for (channel, version), (type_, value) in blobs.items():
+            data, compressed = self._pack(value)
+            writes.append(("set", thread_ref.collection("blobs").document(self._doc_id(checkpoint_ns, channel, version)), {
+                "checkpoint_ns": checkpoint_ns, "channel": channel, "version": version,
+                "type": type_, "data": data, "zstd": compressed,
+            }))
+
+        # Old checkpoints, their pending writes and the values nobody uses any more
+        for checkpoint_id in drop_ids:
+            writes.append(("delete", thread_ref.collection("checkpoints").document(self._doc_id(checkpoint_ns, checkpoint_id)), None))
+            stale_writes = (thread_ref.collection("writes")
+                            .where("checkpoint_ns", "==", checkpoint_ns)
+                            .where("checkpoint_id", "==", checkpoint_id)
+                            .select([]))
+            writes.extend(("delete", doc.reference, None) for doc in stale_writes.stream())
+        for channel, version in drop_blobs:
+            writes.append(("delete", thread_ref.collection("blobs").document(self._doc_id(checkpoint_ns, channel, version)), None))
+
+        self._commit(writes)
+        # The thread document is written after every batch has committed, so its updated_at is only
+        # set once the checkpoint is complete
+        thread_ref.set({"updated_at": self._firestore.SERVER_TIMESTAMP})
+
+    def _save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes):
+        collection = self._thread_ref(thread_id).collection("writes")
+        operations = []
+        for task_id, idx, channel, (type_, value), task_path in writes:
+            data, compressed = self._pack(value)
+            # Retried tasks write the same document again, so there is nothing to deduplicate
+            operations.append(("set", collection.document(self._doc_id(checkpoint_ns, checkpoint_id, task_id, idx)), {
+                "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id,
+                "task_id": task_id, "idx": idx, "channel": channel,
+                "type": type_, "value": data, "zstd": compressed, "task_path": task_path,
+            }))
+        self._commit(operations)
+
+    def _thread_ids(self):
+        return [doc.id for doc in self.db.collection(self.collection_name).select([]).stream()]
+
+    def _commit(self, operations):
+        """Commits the operations in order, in batches under both the write and the byte limits."""
+        batch, count, size = self.db.batch(), 0, 0
+        for action, ref, data in operations:
+            op_size = self._write_size(ref, data)
+            if count and (count == MAX_BATCH_WRITES or size + op_size > MAX_BATCH_BYTES):
+                batch.commit()
+                batch, count, size = self.db.batch(), 0, 0
+            if action == "set":
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+            count, size = count + 1, size + op_size
+        if count:
+            batch.commit()
+
+    @staticmethod
+    def _write_size(ref, data):
+        """Rough size of one write: the document path plus its field names and values."""
+        size = len(ref.path) + 32
+        for field, value in (data or {}).items():
+            size += len(field) + (len(value) if isinstance(value, (bytes, str)) else 16)
+        return size
+
+    def _pack(self, data: bytes):
+        compressed = len(data) >= COMPRESS_MIN_BYTES
+        if compressed:
+            data = self._zstd.ZstdCompressor(level=3).compress(data)
+        if len(data) > MAX_VALUE_BYTES:
+            raise ValueError(f"Checkpoint value of {len(data)} bytes exceeds the Firestore document limit")
+        return data, compressed
+
+    def _unpack(self, data, compressed):
+        data = bytes(data)
+        return self._zstd.ZstdDecompressor().decompress(data) if compressed else data
+
+
+class SQLiteCheckpointSaver(_BoundedCheckpointSaver):
+    """Same checkpointer on a local SQLite file (":memory:" for tests), for development without Firestore."""
+
+    def __init__(self, path: str = None, history: int = None, serde=None):
+        super().__init__(history=history, serde=serde)
+        self.path = path or os.getenv("CHECKPOINT_SQLITE_PATH", "checkpoints.sqlite")
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, parent_checkpoint_id TEXT,
+                    type TEXT, checkpoint BLOB, metadata_type TEXT, metadata BLOB, channel_versions TEXT,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id));
+                CREATE TABLE IF NOT EXISTS blobs (
+                    thread_id TEXT, checkpoint_ns TEXT, channel TEXT, version TEXT, type TEXT, data BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, channel, version));
+                CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT, checkpoint_ns TEXT, checkpoint_id TEXT, task_id TEXT, idx INTEGER,
+                    channel TEXT, type TEXT, value BLOB, task_path TEXT,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx));
+            """)
+        print(f"🗄️ Checkpoints in SQLite ({self.path}, history: {self.history})")
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock, self._conn:
+            for table in ("checkpoints", "blobs", "writes"):
+                self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _load_rows(self, thread_id, checkpoint_ns=None, checkpoint_id=None):
+        sql = ("SELECT checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+               "FROM checkpoints WHERE thread_id = ?")
+        params = [thread_id]
+        if checkpoint_ns is not None:
+            sql += " AND checkpoint_ns = ?"
+            params.append(checkpoint_ns)
+        if checkpoint_id is not None:
+            sql += " AND checkpoint_id = ?"
+            params.append(checkpoint_id)
+        return [
+            {"thread_id": thread_id, "checkpoint_ns": ns, "checkpoint_id": cid, "parent_checkpoint_id": parent,
+             "checkpoint": (type_, checkpoint), "metadata": (metadata_type, metadata)}
+            for ns, cid, parent, type_, checkpoint, metadata_type, metadata in self._query(sql, params)
+        ]
+
+    def _load_index(self, thread_id, checkpoint_ns):
+        rows = self._query("SELECT checkpoint_id, channel_versions FROM checkpoints "
+                           "WHERE thread_id = ? AND checkpoint_ns = ?", (thread_id, checkpoint_ns))
+        return {checkpoint_id: json.loads(versions) for checkpoint_id, versions in rows}
+
+    def _load_blobs(self, thread_id, checkpoint_ns, versions):
+        result = {}
+        for channel, version in versions.items():
+            rows = self._query("SELECT type, data FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? "
+                               "AND channel = ? AND version = ?", (thread_id, checkpoint_ns, channel, version))
+            if rows:
+                result[channel] = (rows[0][0], rows[0][1])
+        return result
+
+    def _load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        rows = self._query("SELECT task_id, idx, channel, type, value, task_path FROM writes "
+                           "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                           (thread_id, checkpoint_ns, checkpoint_id))
+        return [(task_id, idx, channel, (type_, value), task_path)
+                for task_id, idx, channel, type_, value, task_path in rows]
+
+    def _save_checkpoint(self, thread_id, checkpoint_ns, row, blobs, drop_ids, drop_blobs):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, row["checkpoint_id"], row["parent_checkpoint_id"],
+                 row["checkpoint"][0], row["checkpoint"][1], row["metadata"][0], row["metadata"][1],
+                 json.dumps(row["channel_versions"])))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                [(thread_id, checkpoint_ns, channel, version, type_, data)
+                 for (channel, version), (type_, data) in blobs.items()])
+            for checkpoint_id in drop_ids:
+                for table in ("checkpoints", "writes"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? "
+                                       "AND checkpoint_id = ?", (thread_id, checkpoint_ns, checkpoint_id))
+            self._conn.executemany(
+                "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                [(thread_id, checkpoint_ns, channel, version) for channel, version in drop_blobs])
+
+    def _save_writes(self, thread_id, checkpoint_ns, checkpoint_id, writes):
+        with self._lock, self._conn:
+            for task_id, idx, channel, (type_, value), task_path in writes:
+                # Like InMemorySaver: regular writes are kept once, special ones (errors, interrupts) replaced
+                verb = "INSERT OR IGNORE" if idx >= 0 else "INSERT OR REPLACE"
+                self._conn.execute(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel,
+                                    type_, value, task_path))
+
+    def _thread_ids(self):
+        return [thread_id for (thread_id,) in self._query("SELECT DISTINCT thread_id FROM checkpoints", ())]
+
+
+def create_checkpointer(backend: str = None, db=None):
+    """
+    Checkpointer for `backend`, by default CHECKPOINT_BACKEND: "firestore" (default), "sqlite"
+    or "memory" (InMemorySaver, only for debugging). `db` reuses an existing Firestore client.
+    """
+    backend = (backend or os.getenv("CHECKPOINT_BACKEND", "firestore")).lower()
+    if backend == "sqlite":
+        return SQLiteCheckpointSaver()
+    if backend == "memory":
+        from langgraph.checkpoint.memory import InMemorySaver
+        print("⚠️ Using InMemorySaver: checkpoints are lost on restart and never pruned")
+        return InMemorySaver()
+    return FirestoreCheckpointSaver(db=db)
+
+
+def turn_input(session_id: str, message: str) -> Dict:
+    """
+    Input for graph.invoke for one user turn: only the new message and the session metadata.
+    The graph restores the rest of the state from the thread's checkpoint (or starts from
+    scratch), and merge_metadata keeps the original created_at, so nothing is read here.
+    """
+    now = datetime.datetime.now().isoformat()
+    return {
+        "messages": [{"role": "user", "content": message}],
+        "metadata": {"created_at": now, "last_active": now, "session_id": session_id},
+    }
+
+
+def seed_thread(checkpointer, thread_id: str, values: Dict, state_schema=None) -> None:
+    """
+    Store `values` as the latest checkpoint of a thread that has none, so the graph continues
+    from them (sessions saved before the checkpointer, see migrate_session_encoding.py). A
+    one-node graph over the same state schema is enough: checkpoints hold channel values by name.
+    """
+    from langgraph.graph import END, START, StateGraph
+    if state_schema is None:
+        from states import DietState as state_schema
+    seed = StateGraph(state_schema)
+    seed.add_node("seed", lambda state: {})
+    seed.add_edge(START, "seed")
+    seed.add_edge("seed", END)
+    # Keys that are not fields of the state (message_count...) are dropped
+    fields = getattr(state_schema, "__dataclass_fields__", None) or getattr(state_schema, "__annotations__", {})
+    values = {k: v for k, v in values.items() if k in fields}
+    seed.compile(checkpointer=checkpointer).update_state(
+        {"configurable": {"thread_id": thread_id}}, values, as_node="seed")
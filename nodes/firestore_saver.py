@@ -0,0 +1,802 @@
+"""
+Persistencia de las sesiones de conversación en Firestore (diet_conversations).
+
+Compartido por api.py y arquitecture.py (y, a través de este último, main.py).
+El estado del grafo (dieta, lista de la compra, intolerancias...) vive solo en el
+checkpointer (firestore_checkpointer.py); aquí se guardan los campos de la sesión
+(SESSION_FIELDS): los mensajes, para la UI, y metadata (created_at, last_active, errores),
+que usa la exportación a BigQuery para encontrar las sesiones modificadas.
+Tras la primera escritura de una sesión, put() solo envía los campos que han cambiado
+respecto a la última versión persistida, de modo que el coste de cada turno no crece
+con la longitud de la conversación.
+
+Los mensajes no se guardan en el documento de la sesión sino en la subcolección
+{collection}/{session_id}/messages, un documento por mensaje con su número de orden
+("seq"). get_messages_page() pagina el historial para la UI.
+
+La última versión guardada de cada sesión (tal como está en Firestore, con el tamaño de
+cada campo) se guarda en una caché LRU con TTL y límite de memoria (SessionCache): es la
+base con la que put() calcula el diff. La actualización lleva como precondición el
+update_time de esa versión, de modo que si otra instancia de Cloud Run ha escrito la sesión
+después, falla y se reescribe el documento entero.
+Configuración: SESSION_CACHE_MAX_ENTRIES, SESSION_CACHE_TTL_SECONDS y SESSION_CACHE_MAX_MB.
+
+Los documentos escritos antes del checkpointer guardan también el estado del grafo (la dieta
+como bytes de state_codec, "state_packed", trozos en {collection}_chunks, o los formatos
+antiguos diet_serialized en JSON y pickle + base64). get() los sigue leyendo para que
+migrate_session_encoding.py pase su estado al checkpointer antes de reescribirlos.
+"""
+from typing import Dict, Optional
+from google.cloud import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
+import copy
+import datetime
+import os
+import time
+import json
+import math
+import re
+import threading
+import base64
+import state_codec
+from session_cache import SessionCache
+
+# Campos que indican que el documento no guarda el estado campo a campo
+ENCODED_DOCUMENT_MARKERS = ("is_chunked", "is_packed_chunked", "state_packed", "is_pickled_chunked", "pickled_data")
+
+# Campos del estado que se guardan en la sesión; el resto solo está en el checkpointer
+SESSION_FIELDS = ("messages", "metadata")
+
+# Campos tipo mapa que se actualizan clave a clave (p. ej. metadata.last_active)
+NESTED_DIFF_FIELDS = ("metadata",)
+
+# Mensajes que se cargan con el estado (utils.append_message conserva los últimos 10)
+MESSAGE_WINDOW = 10
+MESSAGES_SUBCOLLECTION = "messages"
+
+# Contador atómico para los IDs usuario_N (en {collection}_meta)
+SESSION_COUNTER_DOC = "session_counter"
+SESSION_ID_PREFIX = "usuario_"
+
+# Firestore rejects commits above 10 MiB, so chunk writes are grouped in batches below that
+MAX_BATCH_BYTES = 9_000_000
+MAX_BATCH_WRITES = 500
+
+# Locks guarding the message numbering, shared by sessions with the same hash
+SEQ_LOCK_STRIPES = 64
+
+
+def session_record(state: Dict) -> Dict:
+    """Campos de la sesión de un estado del grafo (comparte las listas, no copia los mensajes)"""
+    return {field: state[field] for field in SESSION_FIELDS if field in state}
+
+
+class FirestoreSaver:
+    """State persistence in Firestore, chunking documents that exceed the 1 MB limit."""
+
+    def __init__(self,
+                 collection_name: str = "diet_conversations",
+                 project_id: str = "diap3-458416",
+                 database_id: str = "agente-context-prueba",
+                 max_chunk_size: int = 900000,  # Leave margin below 1MB limit
+                 cache_max_entries: int = None,
+                 cache_ttl_seconds: float = None,
+                 cache_max_mb: float = None,
+                 db=None
+                ):
+        self.collection_name = collection_name
+        self.project_id = project_id
+        self.database_id = database_id
+        self.max_chunk_size = max_chunk_size
+        self.db = db or firestore.Client(project=project_id, database=database_id)
+        # Last version of each session stored in Firestore, as stored (after serialization),
+        # with the estimated size of each field and its update_time: the base put() diffs
+        # against. Only kept for regular (non-chunked) documents, which are the ones that
+        # can be updated field by field.
+        self._cache = SessionCache(
+            max_entries=cache_max_entries or int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "1000")),
+            ttl_seconds=cache_ttl_seconds or float(os.getenv("SESSION_CACHE_TTL_SECONDS", "1800")),
+            max_bytes=int((cache_max_mb or float(os.getenv("SESSION_CACHE_MAX_MB", "256"))) * 1024 * 1024),
+            on_evict=self._forget_session,
+        )
+        # Number of messages stored in each session's messages subcollection, and next
+        # number to hand out (higher while saves are still queued, see write_behind.py)
+        self._message_counts = {}
+        self._next_seq = {}
+        # Request threads and the write-behind worker number and store messages of the same
+        # session at once: the read-modify-write of both dicts happens under the key's lock
+        self._seq_locks = [threading.RLock() for _ in range(SEQ_LOCK_STRIPES)]
+        # Chunk set currently referenced by each chunked session: (chunk_version, chunk_count)
+        self._chunk_layouts = {}
+        print(f"🔌 Connected to Firestore (database: {database_id}, collection: {collection_name})")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Read a session from Firestore, handling chunked, packed and legacy documents. Used by
+        migrate_session_encoding.py; the agent reads its state from the checkpointer.
+        """
+        doc_ref = self.db.collection(self.collection_name).document(key)
+        doc = doc_ref.get()
+
+        if not doc.exists:
+            with self._seq_lock(key):
+                self._message_counts[key] = 0
+                self._next_seq.pop(key, None)
+            return None
+
+        data = self.decode_document(key, doc.to_dict())
+
+        # Documents written before the messages subcollection keep their messages inline;
+        # they are moved to the subcollection on the next put()
+        with self._seq_lock(key):
+            self._message_counts[key] = data.pop("message_count", 0)
+            self._next_seq.pop(key, None)
+        if "messages" not in data:
+            data["messages"] = self._load_recent_messages(key)
+        return data
+
+    def decode_document(self, key: str, data: Dict) -> Dict:
+        """
+        State stored in a session document (as returned by to_dict()), reading its chunks and
+        decoding the diet or the packed/legacy formats. Messages are not loaded.
+        """
+        # Check if the document is chunked
+        if data.get("is_chunked", False):
+            # This is a chunked document, we need to retrieve all chunks
+            print(f"Document {key} is chunked. Retrieving chunks...")
+
+            # Initialize the full state
+            full_state = {}
+
+            # Add the main document data (excluding chunk metadata)
+            for k, v in data.items():
+                if k not in ["is_chunked", "chunk_count", "chunk_version"]:
+                    full_state[k] = v
+
+            # Retrieve all chunks in one round trip and merge them
+            for chunk_data in self._read_chunks(key, data):
+                # Merge chunk data into full state
+                for k, v in chunk_data.items():
+                    if k == "chunk_id":
+                        continue  # Skip metadata
+
+                    if k in full_state and isinstance(v, dict) and isinstance(full_state[k], dict):
+                        # Merge dictionaries
+                        full_state[k].update(v)
+                    elif k in full_state and isinstance(v, list) and isinstance(full_state[k], list):
+                        # Lists are split across chunks in order
+                        full_state[k].extend(v)
+                    else:
+                        # Override or add
+                        full_state[k] = v
+
+            data = full_state
+            data = self._restore_diet(data)
+
+        # Whole state encoded with state_codec, split across chunks
+        elif data.get("is_packed_chunked", False):
+            print(f"Document {key} is a packed chunked document. Reassembling...")
+            packed = b"".join(chunk.get("packed_chunk", b"") for chunk in self._read_chunks(key, data))
+            data = self._decode_packed_state(key, packed, data)
+
+        # Whole state encoded with state_codec in a single document
+        elif "state_packed" in data:
+            data = self._decode_packed_state(key, data["state_packed"], data)
+
+        # Legacy pickled chunked document
+        elif data.get("is_pickled_chunked", False):
+            print(f"Document {key} is a legacy pickled chunked document. Reassembling...")
+            encoded_data = "".join(chunk.get("pickled_data_chunk", "") for chunk in self._read_chunks(key, data))
+            data = self._decode_legacy_pickle(key, encoded_data, data)
+
+        # Legacy pickled document
+        elif "pickled_data" in data:
+            data = self._decode_legacy_pickle(key, data["pickled_data"], data)
+
+        # Regular document
+        else:
+            data = self._restore_diet(dict(data))
+
+        return data
+
+    def put(self, key: str, value: Dict) -> None:
+        """Save the session fields of a state, writing only the fields that changed since the last save"""
+        value = session_record(value)
+
+        # Messages not yet stored in the subcollection
+        new_messages, stored = self._pending_messages(key, value)
+
+        # Preprocess data to be compatible with Firestore (no deep copy: only diet is rebuilt)
+        firestore_value = self._to_firestore(value)
+        firestore_value["message_count"] = max([stored] + [m["seq"] + 1 for m in new_messages])
+
+        try:
+            # Last version stored and its field sizes, read together in one cache lookup
+            cached = self._cache.get(key)
+            if cached is not None:
+                (previous, field_sizes), version = cached
+                changes, changed_fields = self._diff(previous, firestore_value)
+                if not changes:
+                    return
+                sizes = dict(field_sizes)
+                for field in changed_fields:
+                    if field in firestore_value:
+                        sizes[field] = self._estimate_document_size(firestore_value[field])
+                    else:
+                        sizes.pop(field, None)
+
+                if sum(sizes.values()) <= self.max_chunk_size:
+                    doc_ref = self.db.collection(self.collection_name).document(key)
+                    batch = self._messages_batch(key, new_messages)
+                    # Only applies on top of the version the diff was computed against
+                    batch.update(doc_ref, changes, option=self.db.write_option(last_update_time=version))
+                    try:
+                        results = batch.commit()
+                        self._mark_messages_stored(key, new_messages)
+                        self._remember_persisted(key, firestore_value, results[-1].update_time,
+                                                 previous, changed_fields, sizes)
+                        return
+                    except (NotFound, FailedPrecondition):
+                        # Deleted or written by another instance since: fall back to a full write
+                        self._cache.invalidate(key, stale=True)
+
+            # First save of this session (in this process), or the document outgrew the
+            # size limit: full write
+            self._write_full(key, firestore_value, new_messages)
+        except TypeError as e:
+            print(f"⚠️ Error saving to Firestore: {e}")
+            # Fall back to encoding the whole state
+            self.put_packed(key, value)
+
+    def put_packed(self, key: str, value: Dict) -> None:
+        """Save the session fields encoded with state_codec, for values Firestore cannot store as fields"""
+        value = session_record(value)
+        self._cache.invalidate(key)
+        self._store_packed_document(key, value)
+
+    def cache_stats(self) -> Dict:
+        """Hits (saves that only sent the changed fields), stale versions, evictions and memory use"""
+        return self._cache.stats()
+
+    def get_messages_page(self, key: str, before: Optional[int] = None, page_size: int = 20) -> Dict:
+        """
+        One page of the conversation history, oldest first, ending right before message
+        number `before` (or at the latest message). `next_before` is the value to pass to
+        get the previous page, or None when there is nothing older.
+        """
+        query = self._messages_collection(key).order_by("seq", direction=firestore.Query.DESCENDING)
+        if before is not None:
+            query = query.where("seq", "<", before)
+        messages = [doc.to_dict() for doc in query.limit(page_size).stream()]
+        messages.reverse()
+
+        next_before = None
+        if len(messages) == page_size and messages[0]["seq"] > 0:
+            next_before = messages[0]["seq"]
+        return {"messages": messages, "next_before": next_before}
+
+    def delete(self, key: str) -> None:
+        """Delete a saved state and its messages"""
+        # Look up the chunk set before the cache eviction forgets it
+        chunk_layout = self._chunk_layouts.get(key)
+        self._cache.invalidate(key)
+        self._forget_session(key)
+        if chunk_layout:
+            self._chunk_layouts[key] = chunk_layout
+            self._delete_old_chunks(key)
+
+        message_refs = list(self._messages_collection(key).list_documents())
+        for start in range(0, len(message_refs), 500):  # Firestore batch limit
+            batch = self.db.batch()
+            for ref in message_refs[start:start + 500]:
+                batch.delete(ref)
+            batch.commit()
+        self.db.collection(self.collection_name).document(key).delete()
+
+    def _write_full(self, key, firestore_value, new_messages=()):
+        """Write the whole document, chunking it if it is too large"""
+        sizes = {field: self._estimate_document_size(v) for field, v in firestore_value.items()}
+        doc_size = sum(sizes.values())
+
+        if doc_size > self.max_chunk_size:
+            # Document is too large, we need to chunk it
+            print(f"Document {key} is too large ({doc_size} bytes). Chunking...")
+            self._cache.invalidate(key)
+            if new_messages:
+                self._messages_batch(key, new_messages).commit()
+                self._mark_messages_stored(key, new_messages)
+            return self._store_chunked_document(key, dict(firestore_value))
+        else:
+            # Document fits in one piece, store it together with the new messages
+            doc_ref = self.db.collection(self.collection_name).document(key)
+            batch = self._messages_batch(key, new_messages)
+            batch.set(doc_ref, firestore_value)
+            results = batch.commit()
+            self._mark_messages_stored(key, new_messages)
+            self._delete_old_chunks(key)
+            self._remember_persisted(key, firestore_value, results[-1].update_time, sizes=sizes)
+            return results[-1].update_time
+
+    def _forget_session(self, key):
+        """
+        Drop the rest of what is kept in memory for a session (called when it leaves the cache).
+        SessionCache calls it after releasing its lock, so it can run in the middle of a put()
+        of the same session: the pops are atomic, and the numbering reads each dict once and
+        reloads the count when it is gone.
+        """
+        self._message_counts.pop(key, None)
+        self._next_seq.pop(key, None)
+        self._chunk_layouts.pop(key, None)
+
+    def _messages_collection(self, key):
+        return self.db.collection(self.collection_name).document(key).collection(MESSAGES_SUBCOLLECTION)
+
+    def _load_recent_messages(self, key):
+        """Last MESSAGE_WINDOW messages of the session, oldest first"""
+        query = (self._messages_collection(key)
+                 .order_by("seq", direction=firestore.Query.DESCENDING)
+                 .limit(MESSAGE_WINDOW))
+        messages = [doc.to_dict() for doc in query.stream()]
+        messages.reverse()
+        return messages
+
+    def assign_message_numbers(self, key: str, value: Dict) -> None:
+        """
+        Number the state's new messages ("seq") in place. put() does it too; callers that
+        save a copy of the state later (write-behind) call it first so the live state keeps
+        the numbers and the next save does not store the same messages again.
+        """
+        messages = [m for m in value.get("messages") or [] if isinstance(m, dict)]
+        with self._seq_lock(key):
+            seq = self._next_seq.get(key)
+            if seq is None:
+                stored = self._message_counts.get(key)
+                if stored is None:
+                    stored = self._message_counts[key] = self._stored_message_count(key)
+                seq = max([stored] + [m["seq"] + 1 for m in messages if "seq" in m])
+            for message in messages:
+                if "seq" not in message:
+                    message["seq"] = seq
+                    seq += 1
+            self._next_seq[key] = seq
+
+    def _pending_messages(self, key, value):
+        """Messages of the state that are not in the subcollection yet, and how many are stored"""
+        with self._seq_lock(key):
+            self.assign_message_numbers(key, value)
+            stored = self._message_counts.get(key, 0)
+        return [m for m in value.get("messages") or [] if isinstance(m, dict) and m["seq"] >= stored], stored
+
+    def _seq_lock(self, key):
+        return self._seq_locks[hash(key) % SEQ_LOCK_STRIPES]
+
+    def _stored_message_count(self, key):
+        """Messages already stored for a session whose count is not in memory (e.g. evicted)"""
+        doc = self.db.collection(self.collection_name).document(key).get(field_paths=["message_count"])
+        return (doc.to_dict() or {}).get("message_count", 0) if doc.exists else 0
+
+    def _messages_batch(self, key, new_messages):
+        """Write batch with one document per new message, named after its number"""
+        batch = self.db.batch()
+        messages_ref = self._messages_collection(key)
+        for message in new_messages:
+            batch.set(messages_ref.document(f"{message['seq']:06d}"), message)
+        return batch
+
+    def _mark_messages_stored(self, key, new_messages):
+        """Remember how many messages are stored so later puts skip them"""
+        if new_messages:
+            with self._seq_lock(key):
+                self._message_counts[key] = max(self._message_counts.get(key, 0),
+                                                max(m["seq"] for m in new_messages) + 1)
+
+    def _diff(self, previous, current):
+        """
+        Firestore update payload that turns `previous` into `current`.
+        Returns (changes, changed top-level fields).
+        """
+        changes = {}
+        changed_fields = []
+        for field, value in current.items():
+            if field not in previous:
+                changes[field] = value
+            elif previous[field] == value:
+                continue
+            elif field in NESTED_DIFF_FIELDS and isinstance(value, dict) and isinstance(previous[field], dict):
+                old = previous[field]
+                for k, v in value.items():
+                    if k not in old or old[k] != v:
+                        changes[f"{field}.{k}"] = v
+                for k in old.keys() - value.keys():
+                    changes[f"{field}.{k}"] = firestore.DELETE_FIELD
+            else:
+                changes[field] = value
+            changed_fields.append(field)
+
+        for field in previous.keys() - current.keys():
+            changes[field] = firestore.DELETE_FIELD
+            changed_fields.append(field)
+        return changes, changed_fields
+
+    def _remember_persisted(self, key, firestore_value, version, previous=None, changed_fields=None, sizes=None):
+        """Cache what is now stored in Firestore for this session: the previous version plus the changed fields"""
+        snapshot = dict(previous or {})
+        fields = firestore_value.keys() if changed_fields is None else changed_fields
+        for field in fields:
+            if field not in firestore_value:
+                snapshot.pop(field, None)
+            else:
+                snapshot[field] = copy.deepcopy(firestore_value[field])
+        if sizes is None:
+            sizes = {field: self._estimate_document_size(v) for field, v in snapshot.items()}
+        self._cache.put(key, (snapshot, sizes), version, sum(sizes.values()))
+
+    def _chunk_ref(self, key, index, version=None):
+        """Chunk document; chunks written before versioning are named without the version"""
+        chunk_key = f"{key}_chunk_{index}" if version is None else f"{key}_v{version}_chunk_{index}"
+        return self.db.collection(f"{self.collection_name}_chunks").document(chunk_key)
+
+    def _read_chunks(self, key, main_doc):
+        """Fetch every chunk referenced by the main document with a single get_all() call"""
+        version = main_doc.get("chunk_version")
+        chunk_count = main_doc.get("chunk_count", 0)
+        self._chunk_layouts[key] = (version, chunk_count)
+
+        refs = [self._chunk_ref(key, i, version) for i in range(chunk_count)]
+        snapshots = {snapshot.id: snapshot for snapshot in self.db.get_all(refs)}
+
+        chunks = []
+        for ref in refs:
+            snapshot = snapshots.get(ref.id)
+            if snapshot is None or not snapshot.exists:
+                print(f"Warning: Chunk {ref.id} is missing")
+                continue
+            chunks.append(snapshot.to_dict())
+        return chunks
+
+    def _commit_chunked(self, key, main_doc, chunks):
+        """
+        Write a new chunk set under a fresh version and then flip the main document to it.
+        Chunks go first (in as few batches as the commit size limit allows) and the main
+        document last, so readers always see either the old complete set or the new one.
+        A commit that fails halfway leaves chunks nothing references: they are deleted right
+        away if possible, and otherwise by the sweep after the next chunked write.
+        """
+        version = str(time.time_ns())
+        main_doc["chunk_count"] = len(chunks)
+        main_doc["chunk_version"] = version
+
+        writes = [(self._chunk_ref(key, i, version), {"chunk_id": i, **chunk}) for i, chunk in enumerate(chunks)]
+        writes.append((self.db.collection(self.collection_name).document(key), main_doc))
+
+        committed = []
+        try:
+            batch, batch_refs, batch_bytes = self.db.batch(), [], 0
+            for ref, data in writes:
+                size = self._estimate_document_size(data)
+                if len(batch) and (batch_bytes + size > MAX_BATCH_BYTES or len(batch) >= MAX_BATCH_WRITES):
+                    batch.commit()
+                    committed.extend(batch_refs)
+                    batch, batch_refs, batch_bytes = self.db.batch(), [], 0
+                batch.set(ref, data)
+                batch_refs.append(ref)
+                batch_bytes += size
+            results = batch.commit()
+        except Exception:
+            self._delete_refs(committed)
+            raise
+
+        self._chunk_layouts[key] = (version, len(chunks))
+        try:
+            self._delete_unreferenced_chunks(key, version)
+        except Exception as e:
+            # The new set is already in place; leftovers go with the next chunked write
+            print(f"⚠️ Could not delete old chunks of {key}: {e}")
+        return results[-1].update_time
+
+    def _delete_unreferenced_chunks(self, key, current_version):
+        """
+        Remove every chunk of the session outside the current set: the previous set and any
+        set left behind by a chunked write that failed halfway, here or in another instance.
+        """
+        pattern = re.compile(rf"^{re.escape(key)}_(?:v(\d+)_)?chunk_\d+$")
+        query = (self.db.collection(f"{self.collection_name}_chunks")
+                 .order_by("__name__")
+                 .start_at({"__name__": f"{key}_"})
+                 .end_before({"__name__": f"{key}`"})  # "`" sorts right after "_"
+                 .select([]))  # IDs only, no document data
+        stale = []
+        for doc in query.stream():
+            match = pattern.match(doc.id)
+            if match and match.group(1) != current_version:
+                stale.append(doc.reference)
+        self._delete_refs(stale)
+
+    def _delete_refs(self, refs):
+        """Best-effort delete of the given documents"""
+        try:
+            for start in range(0, len(refs), MAX_BATCH_WRITES):
+                batch = self.db.batch()
+                for ref in refs[start:start + MAX_BATCH_WRITES]:
+                    batch.delete(ref)
+                batch.commit()
+        except Exception as e:
+            print(f"⚠️ Could not delete {len(refs)} chunk documents: {e}")
+
+    def _delete_old_chunks(self, key):
+        """Remove the chunk set the session used before its last write, if any"""
+        layout = self._chunk_layouts.pop(key, None)
+        if not layout:
+            return
+        version, chunk_count = layout
+        batch = self.db.batch()
+        for i in range(chunk_count):
+            batch.delete(self._chunk_ref(key, i, version))
+            if len(batch) >= MAX_BATCH_WRITES:
+                batch.commit()
+                batch = self.db.batch()
+        if len(batch):
+            batch.commit()
+
+    @staticmethod
+    def _to_firestore(value):
+        """Session document of a state (messages live in their own subcollection)"""
+        firestore_value = session_record(value)
+        firestore_value.pop("messages", None)
+        return firestore_value
+
+    @staticmethod
+    def _restore_diet(data):
+        """Decode the diet, or convert the legacy diet_serialized JSON copy"""
+        if state_codec.is_encoded(data.get("diet")):
+            data["diet"] = state_codec.decode(data["diet"])
+        elif "diet_serialized" in data:
+            try:
+                data["diet"] = _legacy_diet(json.loads(data.pop("diet_serialized")))
+            except Exception:
+                print("⚠️ Error deserializing diet")
+        return data
+
+    def _decode_packed_state(self, key, packed, main_doc):
+        try:
+            return state_codec.decode(packed)
+        except Exception as e:
+            print(f"⚠️ Could not decode packed state for {key}: {e}")
+            return {"metadata": main_doc.get("metadata", {})}
+
+    def _decode_legacy_pickle(self, key, encoded_data, main_doc):
+        """Read a state saved with the old pickle + base64 fallback (rewritten on the next put)"""
+        try:
+            return state_codec.legacy_unpickle(base64.b64decode(encoded_data))
+        except Exception as e:
+            print(f"⚠️ Could not read legacy pickled state for {key}: {e}")
+            return {"metadata": main_doc.get("metadata", {})}
+
+    def _estimate_document_size(self, data):
+        """Roughly estimate the JSON size of a document"""
+        if isinstance(data, (bytes, bytearray)):
+            return len(data)
+        try:
+            # Convert to JSON and measure the byte length
+            return len(json.dumps(data).encode('utf-8'))
+        except Exception:
+            # Not JSON serializable (bytes inside, int keys mixed with str...): use the binary encoding
+            try:
+                return len(state_codec.encode(data, compress=False))
+            except Exception:
+                return len(str(data).encode('utf-8'))
+
+    def _store_chunked_document(self, key, data):
+        """Store a large document by splitting it into chunks"""
+        # Extract messages array, since it's likely the largest part
+        messages = data.pop("messages", [])
+
+        # Create main document with metadata
+        main_doc = {
+            "is_chunked": True,
+            "chunk_count": 0,  # We'll update this later
+            "metadata": data.get("metadata", {
+                "created_at": datetime.datetime.now().isoformat(),
+                "last_active": datetime.datetime.now().isoformat(),
+                "session_id": key
+            })
+        }
+
+        # Add other small fields to main document
+        for k, v in data.items():
+            if k != "metadata" and self._estimate_document_size(v) < 100000:  # Only add small fields
+                main_doc[k] = v
+
+        # Create chunks for large data
+        chunks = []
+        current_chunk = {}
+        current_chunk_size = 0
+        chunk_fields = {}  # Fields that need to be chunked
+
+        # Identify fields that need chunking
+        for k, v in data.items():
+            if k != "metadata" and self._estimate_document_size(v) >= 100000:
+                chunk_fields[k] = v
+
+        # Add messages to chunk fields if they exist
+        if messages:
+            chunk_fields["messages"] = messages
+
+        # Process all chunk fields
+        for field_name, field_data in chunk_fields.items():
+            if isinstance(field_data, list):
+                # For lists (like messages), split by items
+                items_in_current_chunk = []
+
+                for item in field_data:
+                    item_size = self._estimate_document_size(item)
+
+                    if current_chunk_size + item_size > self.max_chunk_size:
+                        # This item would make the chunk too large
+                        if items_in_current_chunk:
+                            # Store current items and start a new chunk
+                            current_chunk[field_name] = items_in_current_chunk
+                            chunks.append(current_chunk)
+                            current_chunk = {}
+                            items_in_current_chunk = [item]
+                            current_chunk_size = item_size
+                        else:
+                            # Single item is too large, we need to split it somehow
+                            # For now, we'll just store it in a separate chunk
+                            chunks.append({field_name: [item]})
+                    else:
+                        # Add item to current chunk
+                        items_in_current_chunk.append(item)
+                        current_chunk_size += item_size
+
+                # Don't forget the last chunk
+                if items_in_current_chunk:
+                    current_chunk[field_name] = items_in_current_chunk
+
+            elif isinstance(field_data, dict):
+                # For dictionaries, split by key-value pairs
+                pairs_in_current_chunk = {}
+
+                for k, v in field_data.items():
+                    pair_size = self._estimate_document_size({k: v})
+
+                    if current_chunk_size + pair_size > self.max_chunk_size:
+                        # This pair would make the chunk too large
+                        if pairs_in_current_chunk:
+                            # Store current pairs and start a new chunk
+                            current_chunk[field_name] = pairs_in_current_chunk
+                            chunks.append(current_chunk)
+                            current_chunk = {}
+                            pairs_in_current_chunk = {k: v}
+                            current_chunk_size = pair_size
+                        else:
+                            # Single pair is too large
+                            chunks.append({field_name: {k: v}})
+                    else:
+                        # Add pair to current chunk
+                        pairs_in_current_chunk[k] = v
+                        current_chunk_size += pair_size
+
+                # Don't forget the last chunk
+                if pairs_in_current_chunk:
+                    current_chunk[field_name] = pairs_in_current_chunk
+
+            else:
+                # For other types, store as is
+                current_chunk[field_name] = field_data
+
+        # Add the last chunk if it's not empty
+        if current_chunk and current_chunk not in chunks:
+            chunks.append(current_chunk)
+
+        # Store the chunks and then the main document that points to them
+        update_time = self._commit_chunked(key, main_doc, chunks)
+
+        print(f"Successfully stored document {key} in {len(chunks)} chunks")
+        return update_time
+
+    def _store_packed_document(self, key, value):
+        """Store the whole state encoded with state_codec (binary, compressed)"""
+        packed = state_codec.encode(value)
+
+        # Check if even the encoded state is too large
+        if len(packed) > self.max_chunk_size:
+            # We need to split the encoded state into chunks
+            total_size = len(packed)
+            chunk_size = self.max_chunk_size
+            num_chunks = math.ceil(total_size / chunk_size)
+
+            # Create main document with metadata
+            main_doc = {
+                "is_packed_chunked": True,
+                "chunk_count": num_chunks,
+                "total_size": total_size,
+                "metadata": value.get("metadata", {
+                    "created_at": datetime.datetime.now().isoformat(),
+                    "last_active": datetime.datetime.now().isoformat(),
+                    "session_id": key
+                })
+            }
+
+            # Store the chunks and then the main document that points to them
+            chunks = [
+                {"packed_chunk": packed[i * chunk_size:(i + 1) * chunk_size]}
+                for i in range(num_chunks)
+            ]
+            update_time = self._commit_chunked(key, main_doc, chunks)
+
+            print(f"Successfully stored packed document {key} in {num_chunks} chunks")
+            return update_time
+        else:
+            # Store the encoded state in a single document
+            doc_ref = self.db.collection(self.collection_name).document(key)
+            result = doc_ref.set({"state_packed": packed, "metadata": value.get("metadata", {})})
+            self._delete_old_chunks(key)
+            return result.update_time
+
+    def list_sessions(self):
+        try:
+            return [doc.id for doc in self.db.collection(self.collection_name).list_documents()]
+        except Exception as e:
+            print(f"Error listing sessions: {e}")
+            return []
+
+    def list_sessions_page(self, page_size: int = 50, start_after: Optional[str] = None) -> Dict:
+        """
+        One page of session IDs ordered by ID. `next_page_token` is the `start_after`
+        for the following page, or None on the last page.
+        """
+        query = (self.db.collection(self.collection_name)
+                 .order_by("__name__")
+                 .select([])  # IDs only, no document data
+                 .limit(page_size))
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        sessions = [doc.id for doc in query.stream()]
+        next_page_token = sessions[-1] if len(sessions) == page_size else None
+        return {"sessions": sessions, "next_page_token": next_page_token}
+
+    def allocate_session_id(self, prefix: str = SESSION_ID_PREFIX) -> str:
+        """
+        Next usuario_N ID from a counter document incremented in a transaction, so
+        concurrent requests never get the same ID and no listing of the collection is needed.
+        The counter is seeded once from the highest existing usuario_N.
+        """
+        counter_ref = self.db.collection(f"{self.collection_name}_meta").document(SESSION_COUNTER_DOC)
+
+        @firestore.transactional
+        def increment(transaction):
+            snapshot = counter_ref.get(transaction=transaction)
+            if snapshot.exists:
+                last_id = snapshot.get("last_id")
+            else:
+                last_id = self._highest_session_number(prefix)
+            transaction.set(counter_ref, {"last_id": last_id + 1, "updated_at": firestore.SERVER_TIMESTAMP})
+            return last_id + 1
+
+        return f"{prefix}{increment(self.db.transaction())}"
+
+    def _highest_session_number(self, prefix):
+        """Highest N among existing <prefix>N sessions (only used to seed the counter)"""
+        print(f"🔢 Seeding session counter from existing {prefix}N sessions...")
+        highest = 0
+        for doc in self.db.collection(self.collection_name).select([]).stream():
+            suffix = doc.id[len(prefix):] if doc.id.startswith(prefix) else ""
+            if suffix.isdigit():
+                highest = max(highest, int(suffix))
+        return highest
+
+
+def _legacy_diet(diet):
+    """
+    Diet read from the old diet_serialized JSON copy: JSON turned the day keys into
+    strings and the (quantity, unit) tuples into lists, so both are restored here.
+    """
+    if isinstance(diet, dict):
+        return {
+            (int(k) if isinstance(k, str) and k.isdigit() else k): _legacy_diet(v)
+            for k, v in diet.items()
+        }
+    if isinstance(diet, list) and len(diet) == 2 and isinstance(diet[0], (int, float)) and isinstance(diet[1], str):
+        return tuple(diet)
+    return diet
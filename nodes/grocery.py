@@ -0,0 +1,159 @@
+"""
+Modelo de los artículos de la lista de la compra y consolidación de cantidades.
+
+Cada alimento de la dieta pasa a un GroceryItem con la cantidad en una unidad base (g, ml o ud,
+según UNIT_FACTORS) y una clave de ingrediente normalizada: minúsculas, sin acentos, sin
+artículos ni preposiciones, en singular y con los sinónimos más comunes unificados, de modo que
+"Tomates" (2 ud) y "tomate" (1 ud), o "Patatas" (0,5 kg) y "papa" (300 g), acaban en una sola
+línea con la cantidad bien sumada.
+
+g y ml se suman entre sí (densidad 1, igual que al calcular envases en catalog.packs_needed);
+las unidades y las medidas desconocidas ("cucharada", "pizca") se quedan en líneas aparte porque
+no se pueden convertir sin saber cuánto pesa cada una.
+
+La lista se guarda en DietState.grocery_list como filas (Producto, Cantidad, Unidades) y
+poner_precio las vuelve a leer con GroceryItem.from_row, sin pasar por texto.
+"""
+import re
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple
+
+# Unidades de medida -> (unidad base, factor): todo se normaliza a g, ml o ud
+UNIT_FACTORS = {
+    "g": ("g", 1.0), "gr": ("g", 1.0), "grs": ("g", 1.0), "gramo": ("g", 1.0), "gramos": ("g", 1.0),
+    "kg": ("g", 1000.0), "kilo": ("g", 1000.0), "kilos": ("g", 1000.0), "kilogramo": ("g", 1000.0), "kilogramos": ("g", 1000.0),
+    "ml": ("ml", 1.0), "mililitro": ("ml", 1.0), "mililitros": ("ml", 1.0),
+    "cl": ("ml", 10.0), "centilitro": ("ml", 10.0), "centilitros": ("ml", 10.0),
+    "l": ("ml", 1000.0), "lt": ("ml", 1000.0), "ltr": ("ml", 1000.0), "litro": ("ml", 1000.0), "litros": ("ml", 1000.0),
+    "ud": ("ud", 1.0), "uds": ("ud", 1.0), "u": ("ud", 1.0), "und": ("ud", 1.0), "unds": ("ud", 1.0),
+    "unid": ("ud", 1.0), "unids": ("ud", 1.0), "unidad": ("ud", 1.0), "unidades": ("ud", 1.0),
+    "pieza": ("ud", 1.0), "piezas": ("ud", 1.0), "pza": ("ud", 1.0), "pzas": ("ud", 1.0),
+}
+# Unidades base que se pueden sumar entre sí
+WEIGHT_OR_VOLUME = {"g", "ml"}
+
+# Palabras que no distinguen un ingrediente de otro
+KEY_STOPWORDS = {"de", "del", "la", "el", "los", "las", "en", "con", "y", "al", "fresco", "fresca", "crudo", "cruda"}
+# Sinónimos (ya en singular y sin acentos) -> nombre común en la clave
+INGREDIENT_SYNONYMS = {
+    "papa": "patata",
+    "jitomate": "tomate",
+    "palta": "aguacate",
+    "banana": "platano", "banano": "platano",
+    "durazno": "melocoton",
+    "jugo": "zumo",
+    "camaron": "gamba",
+    "arveja": "guisante", "chicharo": "guisante",
+    "ejote": "judia verde", "habichuela": "judia verde", "vainita": "judia verde",
+    "frijol": "alubia", "poroto": "alubia", "judion": "alubia",
+    "choclo": "maiz", "elote": "maiz",
+    "zucchini": "calabacin", "zapallito": "calabacin",
+    "betabel": "remolacha",
+    "frutilla": "fresa",
+    "cacahuate": "cacahuete", "mani": "cacahuete",
+}
+# Palabras acabadas en s que no son plurales
+SINGULAR_EXCEPTIONS = {"anis", "cuscus", "cous", "tres", "seis", "lunes", "pies"}
+# Plurales en -ces de singulares en -z; el resto de -ces son -ce + s ("dulces" -> "dulce")
+Z_PLURALS = {"nueces", "peces", "arroces", "raices", "codornices", "perdices", "regalices",
+             "avestruces", "maices", "lombrices", "cruces"}
+
+_NON_WORD = re.compile(r"[^a-z0-9ñ ]+")
+
+
+def normalize_unit(unit: Any) -> Tuple[str, float]:
+    """Unidad base y factor de conversión; una unidad desconocida se queda como está (factor 1)"""
+    unit = str(unit or "").strip().lower().rstrip(".")
+    return UNIT_FACTORS.get(unit, (unit, 1.0))
+
+
+def _strip_accents(text: str) -> str:
+    # La ñ se conserva (NFKD la separaría en n + tilde): "piña" no es "pina"
+    text = unicodedata.normalize("NFKD", text.replace("ñ", "\0"))
+    return "".join(c for c in text if not unicodedata.combining(c)).replace("\0", "ñ")
+
+
+def _singular(word: str) -> str:
+    """Singular aproximado de una palabra en español (reglas, sin modelo de lenguaje)"""
+    if len(word) <= 3 or word in SINGULAR_EXCEPTIONS:
+        return word
+    if word in Z_PLURALS:
+        return word[:-3] + "z"  # nueces -> nuez
+    if word.endswith("es") and word[-3] in "lnrdj" and word[-4] in "aeiou":
+        return word[:-2]  # limones -> limon, melones -> melon
+    if word.endswith("s") and word[-2] in "aeiou":
+        return word[:-1]  # tomates -> tomate, huevos -> huevo
+    return word
+
+
+@lru_cache(maxsize=4096)
+def ingredient_key(name: str) -> str:
+    """Clave de agrupación de un ingrediente: "Tomates frescos" -> "tomate", "Papas" -> "patata" """
+    text = _NON_WORD.sub(" ", _strip_accents(str(name).lower()))
+    words = [w for w in map(_singular, text.split()) if w not in KEY_STOPWORDS]
+    key = " ".join(words) or str(name).strip().lower()
+    if key in INGREDIENT_SYNONYMS:
+        return INGREDIENT_SYNONYMS[key]
+    return " ".join(INGREDIENT_SYNONYMS.get(w, w) for w in key.split())
+
+
+@dataclass
+class GroceryItem:
+    """Artículo de la lista de la compra, con la cantidad ya en la unidad base"""
+    name: str
+    quantity: float
+    unit: str
+    key: str = ""
+
+    def __post_init__(self):
+        base, factor = normalize_unit(self.unit)
+        try:
+            quantity = float(str(self.quantity).replace(",", "."))
+        except (TypeError, ValueError):
+            quantity = 0.0
+        self.name = str(self.name).strip()
+        self.quantity = quantity * factor
+        self.unit = base
+        self.key = self.key or ingredient_key(self.name)
+
+    @property
+    def group(self) -> Tuple[str, str]:
+        """Artículos con el mismo grupo se suman (g y ml comparten grupo)"""
+        return self.key, "g/ml" if self.unit in WEIGHT_OR_VOLUME else self.unit
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "GroceryItem":
+        """Fila de DietState.grocery_list (Producto, Cantidad, Unidades)"""
+        return cls(row.get("Producto", ""), row.get("Cantidad", 0), row.get("Unidades", ""))
+
+    def to_row(self) -> Dict[str, Any]:
+        return {"Producto": self.name, "Cantidad": round(self.quantity, 2), "Unidades": self.unit}
+
+
+def consolidate(items: Iterable[GroceryItem]) -> List[GroceryItem]:
+    """
+    Suma las cantidades de los artículos que son el mismo ingrediente en unidades compatibles.
+    Se quedan el nombre y la unidad del primero que aparece, en el orden de aparición.
+    """
+    grouped: Dict[Tuple[str, str], GroceryItem] = {}
+    for item in items:
+        if not item.name:
+            continue
+        if item.group in grouped:
+            grouped[item.group].quantity += item.quantity
+        else:
+            grouped[item.group] = GroceryItem(item.name, item.quantity, item.unit, item.key)
+    return list(grouped.values())
+
+
+def diet_grocery_items(diet: Dict[str, Dict[str, Dict[str, Any]]]) -> List[GroceryItem]:
+    """Lista consolidada a partir de la dieta {día: {comida: {alimento: (cantidad, unidad)}}}"""
+    items = []
+    for dia in diet.values():
+        for comida in (dia or {}).values():
+            for alimento, medida in (comida or {}).items():
+                cantidad, unidad = (list(medida) + [0, ""])[:2] if isinstance(medida, (list, tuple)) else (medida, "")
+                items.append(GroceryItem(alimento, cantidad, unidad))
+    return consolidate(items)
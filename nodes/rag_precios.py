@@ -1,7 +1,8 @@
 import pandas as pd
+import numpy as np
 import re
 from typing import List, Dict, Tuple, Optional, Any
-from sentence_transformers import SentenceTransformer, util
+from embeddings import get_embedding_service
 from google.cloud import bigquery
 
 class ProductMatcher:
@@ -16,7 +17,7 @@ class ProductMatcher:
         self.dataset_id = dataset_id
         self.table_id = table_id
         self.client = bigquery.Client(project=project_id)
-        self.model = SentenceTransformer('intfloat/multilingual-e5-large')
+        self.model = get_embedding_service()
         self.precios_df = None
         self.productos_embeddings = None
         self.productos = None
@@ -54,7 +55,7 @@ class ProductMatcher:
             ).tolist()
             
             # Pre-compute embeddings for all products (this improves performance for multiple searches)
-            self.productos_embeddings = self.model.encode(self.productos, convert_to_tensor=True)
+            self.productos_embeddings = self.model.encode_passages(self.productos)
             print(f"Loaded {len(self.productos)} products from BigQuery")
             
         except Exception as e:
@@ -71,17 +72,17 @@ class ProductMatcher:
             
         try:
             # Encode the user prompt
-            prompt_emb = self.model.encode(prompt_usuario, convert_to_tensor=True)
+            prompt_emb = self.model.encode_queries([prompt_usuario])[0]
             
-            # Calculate similarity scores
-            similitudes = util.cos_sim(prompt_emb, self.productos_embeddings)[0]
+            # Calculate similarity scores (normalised embeddings: dot product = cosine)
+            similitudes = self.productos_embeddings @ prompt_emb
             
             # Get top_k indices
-            top_valores, top_indices = similitudes.topk(top_k)
+            top_indices = np.argsort(-similitudes)[:top_k]
             
             resultados = []
-            for i, idx in enumerate(top_indices.cpu().numpy()):
-                score = similitudes[idx].item()
+            for i, idx in enumerate(top_indices):
+                score = float(similitudes[idx])
                 fila = self.precios_df.iloc[idx]
                 
                 resultados.append({
@@ -0,0 +1,106 @@
+"""
+Caché en memoria de FirestoreSaver con la última versión guardada de cada sesión.
+
+LRU con caducidad (TTL) y presupuesto de memoria: al superar max_entries o max_bytes se
+expulsan las sesiones menos usadas. Cada entrada guarda la versión del documento en
+Firestore (update_time), que el saver usa como precondición al actualizarlo.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """Thread-safe LRU + TTL cache with a memory budget and hit/eviction counters."""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 1800,
+                 max_bytes: int = 256 * 1024 * 1024, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        # Called with the key of every entry that leaves the cache (evicted, expired or invalidated)
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> [value, version, size, expires_at]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key):
+        """Returns (value, version) or None if the key is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            if entry[3] <= time.monotonic():
+                self._counters["expirations"] += 1
+                self._counters["misses"] += 1
+                evicted = self._pop(key)
+            else:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry[0], entry[1]
+        self._notify(evicted)
+        return None
+
+    def put(self, key, value, version=None, size: int = None):
+        """
+        Store a session (or refresh it) and evict the least recently used ones if needed.
+        Without version/size, those of the existing entry are kept.
+        """
+        now = time.monotonic()
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._bytes -= previous[2]
+                if version is None:
+                    version = previous[1]
+                if size is None:
+                    size = previous[2]
+            size = size or 0
+            self._entries[key] = [value, version, size, now + self.ttl_seconds]
+            self._entries.move_to_end(key)
+            self._bytes += size
+
+            evicted = []
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._counters["evictions"] += 1
+                evicted.extend(self._pop(oldest))
+        self._notify(evicted)
+
+    def invalidate(self, key, stale: bool = False):
+        with self._lock:
+            if stale:
+                self._counters["stale"] += 1
+            evicted = self._pop(key)
+        self._notify(evicted)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return []
+        self._bytes -= entry[2]
+        return [key]
+
+    def _notify(self, keys):
+        if self.on_evict:
+            for key in keys:
+                self.on_evict(key)
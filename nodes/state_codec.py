@@ -0,0 +1,126 @@
+"""
+Codificación binaria del estado de las conversaciones (DietState) para Firestore.
+
+msgpack con un esquema versionado y compresión zstd. A diferencia de JSON conserva las
+claves enteras de la dieta ({1: {"desayuno": ...}}) y las tuplas (cantidad, unidad), y a
+diferencia de pickle no ejecuta código al decodificar ni depende de la versión de Python.
+
+Formato: b"DS" + versión del esquema (1 byte) + flags (1 byte) + payload msgpack,
+comprimido con zstd si el flag FLAG_ZSTD está activo.
+"""
+import datetime
+import io
+import pickle
+import msgpack
+import zstandard
+
+MAGIC = b"DS"
+SCHEMA_VERSION = 1
+FLAG_ZSTD = 0x01
+HEADER_SIZE = len(MAGIC) + 2
+
+# Por debajo de este tamaño la compresión no compensa
+COMPRESS_MIN_BYTES = 256
+ZSTD_LEVEL = 3
+
+# Tipos que msgpack no distingue de forma nativa
+EXT_TUPLE = 1
+EXT_SET = 2
+EXT_DATETIME = 3
+
+
+class StateCodecError(ValueError):
+    """Datos que no son un estado codificado o con un esquema desconocido."""
+
+
+def _default(obj):
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(EXT_TUPLE, _pack(list(obj)))
+    if isinstance(obj, (set, frozenset)):
+        return msgpack.ExtType(EXT_SET, _pack(list(obj)))
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode("utf-8"))
+    # Subclases de tipos básicos (p. ej. los datetime de Firestore o numpy.float64)
+    for base in (bool, int, float, str, bytes):
+        if isinstance(obj, base):
+            return base(obj)
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, list):
+        return list(obj)
+    # Escalares de numpy y similares
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def _ext_hook(code, data):
+    if code == EXT_TUPLE:
+        return tuple(_unpack(data))
+    if code == EXT_SET:
+        return set(_unpack(data))
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode("utf-8"))
+    return msgpack.ExtType(code, data)
+
+
+def _pack(obj) -> bytes:
+    # strict_types hace que las tuplas pasen por _default en vez de convertirse en listas
+    return msgpack.packb(obj, default=_default, strict_types=True, use_bin_type=True)
+
+
+def _unpack(data: bytes):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+def encode(obj, compress: bool = True) -> bytes:
+    """Codifica un estado (o parte de él, p. ej. la dieta) en bytes."""
+    payload = _pack(obj)
+    flags = 0
+    if compress and len(payload) >= COMPRESS_MIN_BYTES:
+        # Los compresores de zstandard no se pueden compartir entre hilos
+        payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+        flags |= FLAG_ZSTD
+    return MAGIC + bytes([SCHEMA_VERSION, flags]) + payload
+
+
+def decode(data: bytes):
+    """Decodifica bytes producidos por encode()."""
+    if not is_encoded(data):
+        raise StateCodecError("Not an encoded state")
+    version, flags = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version > SCHEMA_VERSION:
+        raise StateCodecError(f"Unsupported state schema version {version} (max {SCHEMA_VERSION})")
+    payload = bytes(data[HEADER_SIZE:])
+    if flags & FLAG_ZSTD:
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    return _unpack(payload)
+
+
+def is_encoded(data) -> bool:
+    return isinstance(data, (bytes, bytearray)) and len(data) >= HEADER_SIZE and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+# Lectura de documentos antiguos guardados con pickle + base64 -------------------------
+
+# Únicas clases que pueden aparecer en un estado serializado con pickle
+_LEGACY_PICKLE_CLASSES = {
+    ("builtins", "set"), ("builtins", "frozenset"), ("builtins", "complex"),
+    ("datetime", "datetime"), ("datetime", "date"), ("datetime", "timedelta"), ("datetime", "timezone"),
+    ("google.api_core.datetime_helpers", "DatetimeWithNanoseconds"),
+}
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) in _LEGACY_PICKLE_CLASSES:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a legacy pickled state")
+
+
+def legacy_unpickle(data: bytes):
+    """
+    Lee un estado guardado con el antiguo formato pickle. Solo admite tipos básicos, así que
+    un documento manipulado no puede ejecutar código. Solo para migrar documentos antiguos.
+    """
+    return _RestrictedUnpickler(io.BytesIO(data)).load()
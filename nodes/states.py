@@ -3,7 +3,54 @@ from pydantic import BaseModel, Field
 import operator
 
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, Any
+
+
+def merge_messages(existing: List[dict], new: List[dict]) -> List[dict]:
+    """
+    Reducer del historial de mensajes.
+    Los nodos devuelven el estado completo, así que su lista ya contiene el historial
+    (recortado por append_message) y sustituye a la anterior. Los mensajes que llegan
+    de fuera del grafo (el mensaje del usuario de cada turno) se añaden al final.
+    Numera con "seq" los mensajes nuevos, continuando la numeración del historial, para
+    que FirestoreSaver sepa cuáles faltan por guardar en la subcolección messages.
+    """
+    existing = existing or []
+    new = new or []
+    # Un nodo devuelve el historial, que ya está numerado (aunque sean copias de los mensajes);
+    # la entrada del turno solo trae mensajes sin numerar
+    replaces_history = any(isinstance(m, dict) and "seq" in m for m in new)
+    merged = list(new) if replaces_history else existing + list(new)
+
+    next_seq = max([m["seq"] + 1 for m in existing + merged if isinstance(m, dict) and "seq" in m], default=0)
+    for i, message in enumerate(merged):
+        if isinstance(message, dict) and "seq" not in message:
+            merged[i] = {**message, "seq": next_seq}
+            next_seq += 1
+    return merged
+
+
+def merge_metadata(existing: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reducer de metadata: cada turno actualiza solo las claves que envía (p. ej. last_active).
+    created_at se queda con el primer valor, así cada turno puede enviarlo sin saber si la
+    sesión ya existía.
+    """
+    merged = {**(existing or {}), **(new or {})}
+    if existing and "created_at" in existing:
+        merged["created_at"] = existing["created_at"]
+    return merged
+
+
+def last_reply(messages: List[dict]) -> Optional[str]:
+    """Respuesta del asistente al último mensaje del usuario, o None si no hubo respuesta"""
+    for message in reversed(messages or []):
+        if message.get("role") == "assistant":
+            return message.get("content")
+        if message.get("role") == "user":
+            return None
+    return None
+
 
 @dataclass
 class DietState:
@@ -11,12 +58,14 @@ class DietState:
     forbidden_foods: List[str] = field(default_factory=list)
     diet: Dict[str, Dict[str, Dict[str, Tuple[float, str]]]] = field(default_factory=dict)
     budget: Optional[float] = None
-    grocery_list: List[str] = field(default_factory=list)
+    grocery_list: List[Dict[str, Any]] = field(default_factory=list)  # Producto, Cantidad, Unidades (+ precios)
+    basket: Dict[str, Any] = field(default_factory=dict)  # total de la cesta por supermercado y el más barato
     info_dietas: str = ""
     next: Optional[str] = None
     next_after_intolerancias: Optional[str] = None
-    messages: Annotated[List[dict], operator.add] = field(default_factory=list)  # historial completo
+    messages: Annotated[List[dict], merge_messages] = field(default_factory=list)  # historial (últimos mensajes)
     assistant_messages: List[str] = field(default_factory=list)  # solo los mensajes assistant, siempre strings simples
+    metadata: Annotated[Dict[str, Any], merge_metadata] = field(default_factory=dict)  # created_at, last_active, session_id...
 
 
 class SearchState(TypedDict):
@@ -1,8 +1,39 @@
 # prepare_embeddings.py
 
+import threading
 import spacy
 
-nlp = spacy.load("es_core_news_sm")
+# Solo hace falta el árbol de dependencias (dep_ == 'neg'): el parser y su tok2vec.
+# El resto de componentes de es_core_news_sm no se cargan.
+SPACY_MODEL = "es_core_news_sm"
+SPACY_DISABLED = ["morphologizer", "attribute_ruler", "lemmatizer", "ner", "senter"]
+
+_nlp = None
+_nlp_lock = threading.Lock()
+# Tokens (en minúsculas) de cada intolerancia ya analizada
+_intolerance_tokens_cache = {}
+
+
+def get_nlp():
+    """Carga el modelo de spaCy la primera vez que se necesita."""
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                _nlp = spacy.load(SPACY_MODEL, exclude=SPACY_DISABLED)
+    return _nlp
+
+
+def _intolerance_tokens(intolerances: list) -> dict:
+    """Tokens de cada intolerancia; las nuevas se procesan juntas con nlp.pipe y se cachean."""
+    missing = list({i.lower() for i in intolerances} - _intolerance_tokens_cache.keys())
+    if missing:
+        nlp = get_nlp()
+        # Para las intolerancias basta con tokenizar: no se ejecuta ningún componente
+        with nlp.select_pipes(disable=nlp.pipe_names):
+            for text, doc in zip(missing, nlp.pipe(missing)):
+                _intolerance_tokens_cache[text] = [token.text for token in doc]
+    return {i: _intolerance_tokens_cache[i.lower()] for i in intolerances}
 
 def append_message(state, message, max_messages=10):
     """
@@ -30,24 +61,30 @@ def identify_removed_intolerances(user_prompt: str, current_intolerances: list)
     """
     Identifica las intolerancias que el usuario menciona que ya no tiene.
     """
+    if not current_intolerances:
+        return []
+
+    prompt = user_prompt.lower()
+    doc = get_nlp()(prompt)
+
+    # Una sola pasada: posición de la primera negación (primer token cuyo texto es el
+    # núcleo de una relación 'neg') y tokens que aparecen después de ella
+    negated_heads = {token.head.text for token in doc if token.dep_ == 'neg'}
+    after_negation = set()
+    negation_seen = False
+    for token in doc:
+        if negation_seen:
+            after_negation.add(token.text)
+        elif token.text in negated_heads:
+            negation_seen = True
+
     removed = []
-    doc = nlp(user_prompt.lower())
-    negations = set([token.head.text for token in doc if token.dep_ == 'neg'])
-
-    for intolerance in current_intolerances:
-        intolerance_doc = nlp(intolerance.lower())
-        for neg in negations:
-            # Buscar si la intolerancia aparece después de una negación
-            for token in intolerance_doc:
-                if token.text in doc.text and token.i > [t.i for t in doc if t.text == neg][0]:
-                    removed.append(intolerance)
-                    break # Si se encuentra una negación, pasar a la siguiente intolerancia
-            if removed and intolerance in removed:
-                break # Evitar añadir la misma intolerancia varias veces
-
-        # Buscar frases explícitas como "ya no soy intolerante a la ..."
-        if f"no soy intolerante a {intolerance.lower()}" in doc.text:
-            if intolerance not in removed:
-                removed.append(intolerance)
+    for intolerance, tokens in _intolerance_tokens(current_intolerances).items():
+        # La intolerancia aparece después de una negación
+        if after_negation.intersection(tokens):
+            removed.append(intolerance)
+        # Frases explícitas como "ya no soy intolerante a la ..."
+        elif f"no soy intolerante a {intolerance.lower()}" in prompt:
+            removed.append(intolerance)
 
     return list(set(removed))
\ No newline at end of file
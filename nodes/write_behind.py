@@ -0,0 +1,124 @@
+"""
+Cola de escritura diferida (write-behind) para guardar las sesiones en Firestore.
+
+Las peticiones encolan el estado con submit() y responden sin esperar a Firestore. Un pool
+de hilos acotado hace los put(); si llegan varios guardados de la misma sesión antes de
+que se escriba, solo se escribe el último. Los fallos se reintentan con backoff exponencial
+y jitter, y close() vacía la cola al apagar el proceso.
+
+Configuración: WRITE_BEHIND_WORKERS (4), WRITE_BEHIND_MAX_RETRIES (5).
+"""
+import atexit
+import copy
+import os
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WriteBehindQueue:
+    """Coalescing, retrying background writer in front of a FirestoreSaver."""
+
+    def __init__(self, saver, max_workers: int = None, max_retries: int = None,
+                 base_delay: float = 0.5, max_delay: float = 30.0):
+        self.saver = saver
+        self.max_workers = max_workers or int(os.getenv("WRITE_BEHIND_WORKERS", "4"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "5"))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="write-behind")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}   # key -> snapshot waiting to be written (only the latest one)
+        self._in_flight = set()
+        self._closed = False
+        self._counters = {"submitted": 0, "coalesced": 0, "written": 0, "retries": 0, "failed": 0}
+        atexit.register(self.close)
+
+    def submit(self, key: str, value) -> None:
+        """Queue a save of the session; a pending save of the same session is replaced"""
+        # Number the new messages now, on the live state, so the next save does not
+        # store them again while this one is still queued
+        self.saver.assign_message_numbers(key, value)
+        snapshot = copy.deepcopy(value)
+
+        with self._lock:
+            if self._closed:
+                closed = True
+            else:
+                closed = False
+                self._counters["submitted"] += 1
+                if key in self._pending:
+                    self._counters["coalesced"] += 1
+                self._pending[key] = snapshot
+                if key not in self._in_flight:
+                    self._in_flight.add(key)
+                    self._executor.submit(self._flush, key)
+        if closed:
+            # Shutting down: write in the caller's thread instead of losing the save
+            self.saver.put(key, snapshot)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every queued save has been written (or given up). False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stop accepting background saves and drain the queue"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            pending = len(self._pending) + len(self._in_flight)
+        if pending:
+            print(f"💾 Flushing {pending} pending session saves...")
+        if not self.flush(timeout):
+            print(f"⚠️ Write-behind queue not drained after {timeout}s: {sorted(self._in_flight)}")
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "pending": len(self._pending), "in_flight": len(self._in_flight)}
+
+    def _flush(self, key):
+        """Worker loop for one session: write the latest snapshot until none is left"""
+        while True:
+            with self._lock:
+                value = self._pending.pop(key, None)
+                if value is None:
+                    self._in_flight.discard(key)
+                    self._idle.notify_all()
+                    return
+            self._write(key, value)
+
+    def _write(self, key, value):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.saver.put(key, value)
+                with self._lock:
+                    self._counters["written"] += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    with self._lock:
+                        self._counters["failed"] += 1
+                    print(f"❌ Giving up saving session {key} after {attempt + 1} attempts: {e}")
+                    traceback.print_exc()
+                    return
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = random.uniform(delay / 2, delay)  # jitter
+                print(f"⚠️ Error saving session {key} (attempt {attempt + 1}), retrying in {delay:.1f}s: {e}")
+                with self._lock:
+                    self._counters["retries"] += 1
+                time.sleep(delay)
+                # A newer save may have arrived meanwhile: retry with that one instead
+                with self._lock:
+                    value = self._pending.pop(key, value)
@@ -1,16 +1,19 @@
 import os
+import sys
 import fitz  # PyMuPDF
-import torch
 import weaviate
-from sentence_transformers import SentenceTransformer
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from weaviate.classes.init import Auth
 from weaviate.classes.config import Property, DataType, Configure
+from weaviate.classes.query import Filter
 import time
 import glob
 import traceback
 import re 
 
+# El backend de embeddings compartido vive en nodes/embeddings.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nodes'))
+from embeddings import get_embedding_service
+
 # --- 0. Conexión a Weaviate Cloud ---
 weaviate_url = os.environ.get("WEAVIATE_URL")
 weaviate_api_key = os.environ.get("WEAVIATE_API_KEY")
@@ -24,112 +27,129 @@ except Exception as e:
     print(f"❌ Error conectando a Weaviate: {e}")
     exit()
 
-# --- 1. Cargar modelo HuggingFace ---
-model_name = "intfloat/multilingual-e5-large"
-
+# --- 1. Cargar modelo de embeddings (mismo servicio/modelo que usan las consultas) ---
 try:
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    embedding_model = SentenceTransformer(model_name, device=device)
-    EMBEDDING_DIMENSION = embedding_model.get_sentence_embedding_dimension()
+    embedding_service = get_embedding_service()
+    embedding_model = embedding_service.backend
+    model_name = embedding_service.model_name
+    PASSAGE_PREFIX = embedding_service.passage_prefix
+    EMBEDDING_DIMENSION = embedding_service.dimension
     print(f"✅ Modelo cargado ({model_name}) en {embedding_model.device}. Dimensión: {EMBEDDING_DIMENSION}")
 except Exception as e:
-    print(f"❌ Error cargando modelo '{model_name}': {e}")
+    print(f"❌ Error cargando modelo de embeddings: {e}")
     if client.is_connected(): client.close()
     exit()
 
 
-# --- 2. Extraer y Aplanar Texto del PDF ---
-def extract_and_flatten_text_from_pdf(pdf_path):
+# --- 2. Extraer Texto del PDF Página a Página ---
+def iter_pdf_pages(pdf_path):
     """
-    Extrae todo el texto de un PDF, lo concatena, y lo limpia/aplana
-    eliminando saltos de línea y espacios extra.
+    Recorre un PDF página a página (sin cargar todo el texto en memoria) y
+    devuelve el texto limpio/aplanado de cada una junto a su número real.
+
+    Yields:
+        tuple: (page_number: int, cleaned_page_text: str). page_number empieza en 1.
 
-    Returns:
-        tuple: (cleaned_full_text: str, pdf_base_name: str) o (None, pdf_base_name) si falla.
+    Raises:
+        Cualquier error de lectura, también a mitad del PDF, para que el documento
+        cuente como fallido en vez de quedar subido a medias como si estuviera completo.
     """
-    all_text = []
     pdf_base_name = os.path.basename(pdf_path)
     try:
-        doc = fitz.open(pdf_path)
-        print(f"📄 Extrayendo texto de {len(doc)} páginas en '{pdf_base_name}'...")
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            page_text = page.get_text("text", sort=True)
-            if page_text.strip():
-                all_text.append(page_text)
-        doc.close()
-
-        if not all_text:
-            print(f"⚠️ No se encontró texto útil en '{pdf_base_name}'.")
-            return None, pdf_base_name
-
-        full_raw_text = " ".join(all_text)
-
-        cleaned_full_text = re.sub(r'[\n\t]+', ' ', full_raw_text)
-
-        cleaned_full_text = re.sub(r'\s{2,}', ' ', cleaned_full_text).strip()
-
-        print(f"📄 Texto extraído y aplanado de '{pdf_base_name}' (Longitud: {len(cleaned_full_text)}).")
-        return cleaned_full_text, pdf_base_name
-
+        with fitz.open(pdf_path) as doc:
+            print(f"📄 Extrayendo texto de {len(doc)} páginas en '{pdf_base_name}'...")
+            for page_num in range(len(doc)):
+                page_text = doc.load_page(page_num).get_text("text", sort=True)
+                cleaned_page_text = re.sub(r'[\n\t]+', ' ', page_text)
+                cleaned_page_text = re.sub(r'\s{2,}', ' ', cleaned_page_text).strip()
+                if cleaned_page_text:
+                    yield page_num + 1, cleaned_page_text
     except Exception as e:
         print(f"❌ Error abriendo o procesando PDF '{pdf_path}': {e}")
-        traceback.print_exc()
-        return None, pdf_base_name
+        raise
 
-# --- 3. Split por Tamaño (MODIFICADO) ---
-def split_flattened_text_by_size(flattened_text, source_pdf_name, chunk_size=700, chunk_overlap=150):
-    """
-    Divide el texto aplanado priorizando el tamaño y el solapamiento.
-    """
-    if not flattened_text:
-        return []
-
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        is_separator_regex=False,
-        separators=[" ", ""], 
-    )
+# --- 3. Split por Frases y Tokens, respetando páginas ---
+# Fin de frase: signo de cierre seguido de espacio y el inicio de la siguiente frase.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+(?=[¿¡"«(\[]?[A-ZÁÉÍÓÚÑÜ0-9])')
 
-    print(f"✂️ Dividiendo texto aplanado de '{source_pdf_name}' por tamaño (chunk_size={chunk_size}, overlap={chunk_overlap})...")
+def split_into_sentences(text):
+    """Divide un texto aplanado en frases."""
+    return [s.strip() for s in SENTENCE_BOUNDARY.split(text) if s.strip()]
 
-    text_chunks = splitter.split_text(flattened_text)
+def count_tokens(text):
+    """Número de tokens del texto según el tokenizer del modelo de embeddings."""
+    return len(embedding_model.tokenizer.tokenize(text))
 
-    # Crear la estructura de salida
-    chunks_with_info = []
-    for i, chunk_text in enumerate(text_chunks):
-
-        chunks_with_info.append({
-            "text": chunk_text,
-            "page_number": 0, 
-            "source_pdf": source_pdf_name,
-        })
-
-    print(f"✂️ Texto aplanado dividido en {len(chunks_with_info)} chunks.")
-    return chunks_with_info
+def split_pages_by_sentences(pages, source_pdf_name, max_tokens=None, overlap_sentences=1, length_function=None):
+    """
+    Agrupa frases consecutivas de cada página en chunks de como mucho max_tokens,
+    sin cruzar nunca un salto de página para conservar el page_number real.
+
+    Args:
+        pages: iterable de (page_number, texto) como el que devuelve iter_pdf_pages.
+        source_pdf_name: nombre del PDF de origen.
+        max_tokens: tamaño máximo de cada chunk. Por defecto, la ventana del modelo
+            menos el prefijo "passage: " y los tokens especiales.
+        overlap_sentences: frases que se repiten al inicio del chunk siguiente.
+        length_function: función de longitud (por defecto, count_tokens).
+
+    Yields:
+        dict: {"text", "page_number", "source_pdf"} por cada chunk.
+    """
+    length_function = length_function or count_tokens
+    if max_tokens is None:
+        max_tokens = embedding_model.max_seq_length - length_function(PASSAGE_PREFIX) - 2
+
+    for page_number, page_text in pages:
+        current, current_len = [], 0
+        for sentence in split_into_sentences(page_text):
+            sentence_len = length_function(sentence)
+            # Una frase más larga que la ventana se trocea por palabras
+            if sentence_len > max_tokens:
+                words = sentence.split(" ")
+                pieces, piece = [], []
+                for word in words:
+                    if piece and length_function(" ".join(piece + [word])) > max_tokens:
+                        pieces.append(" ".join(piece))
+                        piece = []
+                    piece.append(word)
+                if piece:
+                    pieces.append(" ".join(piece))
+            else:
+                pieces = [sentence]
+
+            for piece in pieces:
+                piece_len = length_function(piece) if len(pieces) > 1 else sentence_len
+                if current and current_len + piece_len > max_tokens:
+                    yield {"text": " ".join(s for s, _ in current), "page_number": page_number, "source_pdf": source_pdf_name}
+                    current = current[-overlap_sentences:] if overlap_sentences else []
+                    current_len = sum(n for _, n in current)
+                    # Si el solape no deja sitio a la nueva frase, se descarta
+                    if current_len + piece_len > max_tokens:
+                        current, current_len = [], 0
+                current.append((piece, piece_len))
+                current_len += piece_len
+
+        if current:
+            yield {"text": " ".join(s for s, _ in current), "page_number": page_number, "source_pdf": source_pdf_name}
 
 # --- 4. Embeddings con HF (Batch) ---
 
-def embed_text_chunks_batch(chunks_info: list[dict], model_name_for_prefix: str):
+def embed_text_chunks_batch(chunks_info: list[dict]):
     chunks_text = [info["text"] for info in chunks_info]
     if not chunks_text: return []
     print(f"🧠 Generando embeddings para {len(chunks_text)} chunks...")
     start_embed_time = time.time()
-    prefix = ""
-    if "e5" in model_name_for_prefix.lower():
-         prefix = "passage: "
-         chunks_text = [prefix + chunk for chunk in chunks_text]
     try:
-        embeddings = embedding_model.encode(chunks_text, show_progress_bar=True, batch_size=32)
+        # encode_passages ya añade el prefijo "passage: " de e5
+        embeddings = embedding_service.encode_passages(chunks_text, show_progress_bar=True, batch_size=32)
         print(f"🧠 Embeddings generados en {time.time() - start_embed_time:.2f}s.")
         return embeddings.tolist()
     except Exception as e:
         print(f"❌ Error durante la generación de embeddings: {e}")
         return []
 
-# --- 5. Crear/Verificar clase Weaviate (MODIFICADO - page_number opcional o placeholder) ---
+# --- 5. Crear/Verificar clase Weaviate ---
 def ensure_weaviate_class(client_instance, class_name, vector_dimension):
     """Verifica si la clase existe, si no, la crea."""
     try:
@@ -140,8 +160,7 @@ def ensure_weaviate_class(client_instance, class_name, vector_dimension):
                 vectorizer_config=Configure.Vectorizer.none(),
                 properties=[
                     Property(name="text", data_type=DataType.TEXT, description="Contenido del chunk de texto"),
-                    # Mantener page_number como INT pero tratarlo como no fiable o placeholder (e.g., siempre 0)
-                    Property(name="page_number", data_type=DataType.INT, description="Placeholder (página no relevante con este método)"),
+                    Property(name="page_number", data_type=DataType.INT, description="Página del PDF (empezando en 1) de la que sale el chunk"),
                     Property(name="source_pdf", data_type=DataType.TEXT, description="Nombre del archivo PDF de origen"),
                 ]
             )
@@ -153,23 +172,28 @@ def ensure_weaviate_class(client_instance, class_name, vector_dimension):
         print(f"❌ Error al crear/verificar la clase '{class_name}': {str(e)}")
         raise e
 
-# --- 6. Subir a Weaviate en batches (MODIFICADO - usa page_number=0) ---
-def upload_data_to_weaviate(client_instance, class_name, embeddings, chunks_info_list):
-    """Sube los datos (propiedades + vector) a Weaviate en batches."""
+# --- 6. Subir a Weaviate en batches ---
+def upload_data_to_weaviate(client_instance, class_name, embeddings, chunks_info_list, uploaded_ids=None):
+    """
+    Sube los datos (propiedades + vector) a Weaviate en batches.
+
+    Añade a uploaded_ids los UUID de los objetos guardados y devuelve False si
+    alguno no se pudo subir.
+    """
     # ... (Validaciones iniciales igual que antes) ...
     if not client_instance.is_connected(): #...
         print("❌ Cliente Weaviate no conectado.")
-        return
+        return False
     if not embeddings or not chunks_info_list or len(embeddings) != len(chunks_info_list): #...
         print(f"❌ Error: Desajuste Embeddings/Chunks.")
-        return
+        return False
     try:
         collection = client_instance.collections.get(class_name)
     except Exception as e: #...
         print(f"❌ Error obteniendo la colección '{class_name}': {e}.")
-        return
+        return False
 
-    object_count = 0
+    added_ids = []
     start_upload_time = time.time()
 
     source_pdf_name = chunks_info_list[0].get("source_pdf", "desconocido") if chunks_info_list else "desconocido"
@@ -188,16 +212,48 @@ def upload_data_to_weaviate(client_instance, class_name, embeddings, chunks_info
                 "source_pdf": chunk_info.get("source_pdf", "Unknown"),
             }
 
-            batch.add_object(properties=properties_payload, vector=embedding)
-            object_count += 1
-
-    print(f"⬆️ Subida de {object_count} objetos de '{source_pdf_name}' a '{class_name}' finalizada en {time.time() - start_upload_time:.2f}s.")
+            added_ids.append(batch.add_object(properties=properties_payload, vector=embedding))
+
+    failed = collection.batch.failed_objects
+    failed_ids = {str(error.object_.uuid) for error in failed}
+    if uploaded_ids is not None:
+        uploaded_ids.extend(uuid for uuid in added_ids if str(uuid) not in failed_ids)
+    if failed:
+        print(f"❌ {len(failed)} de {len(added_ids)} objetos de '{source_pdf_name}' no se subieron: {failed[0].message}")
+        return False
+
+    print(f"⬆️ Subida de {len(added_ids)} objetos de '{source_pdf_name}' a '{class_name}' finalizada en {time.time() - start_upload_time:.2f}s.")
+    return True
+
+def embed_and_upload(client_instance, class_name, chunks_info_list, uploaded_ids):
+    """Embebe y sube un grupo de chunks; devuelve False si falla cualquiera de los dos pasos."""
+    embeddings = embed_text_chunks_batch(chunks_info_list)
+    if not embeddings or len(embeddings) != len(chunks_info_list):
+        print(f"❌ Error/desajuste en embeddings.")
+        return False
+    return upload_data_to_weaviate(client_instance, class_name, embeddings, chunks_info_list, uploaded_ids)
+
+# delete_many borra como mucho QUERY_MAXIMUM_RESULTS objetos (10000 por defecto) en cada llamada
+DELETE_GROUP_SIZE = 1000
+
+def delete_uploaded_objects(client_instance, class_name, object_ids, source_pdf_name):
+    """Borra los objetos ya subidos de un PDF que ha fallado a medias, para no dejarlo incompleto en la clase."""
+    if not object_ids:
+        return
+    try:
+        collection = client_instance.collections.get(class_name)
+        for start in range(0, len(object_ids), DELETE_GROUP_SIZE):
+            collection.data.delete_many(where=Filter.by_id().contains_any(object_ids[start:start + DELETE_GROUP_SIZE]))
+        print(f"🗑️ Borrados los {len(object_ids)} objetos ya subidos de '{source_pdf_name}'.")
+    except Exception as e:
+        print(f"❌ Error borrando los objetos subidos de '{source_pdf_name}' ({len(object_ids)}): {e}")
 
 if __name__ == "__main__":
     overall_start_time = time.time()
 
     pdf_folder_path = "/Users/admin/Desktop/AgenteDietas/" # ¡AJUSTA ESTA RUTA!
     NOMBRE_DE_CLASE_UNIFICADO = "InfoDietasAplanado"  # Nombre definido
+    UPLOAD_GROUP_SIZE = 256  # Chunks que se embeben y suben de cada vez
 
     print(f"🏛️  Todos los documentos se cargarán en la clase Weaviate: '{NOMBRE_DE_CLASE_UNIFICADO}'")
     if not os.path.isdir(pdf_folder_path): 
@@ -216,44 +272,56 @@ if __name__ == "__main__":
         ensure_weaviate_class(client, NOMBRE_DE_CLASE_UNIFICADO, EMBEDDING_DIMENSION)
 
         for pdf_path in pdf_files:
-            flattened_text, pdf_filename = extract_and_flatten_text_from_pdf(pdf_path)
-
-            if flattened_text is None:
-                print(f"⚠️ No se pudo procesar o no había texto en '{pdf_filename}'. Saltando.")
-                total_failed_files += 1
-                continue 
-
-            print(f"\n🚀 Procesando '{pdf_filename}' (aplanado) para añadir a '{NOMBRE_DE_CLASE_UNIFICADO}'")
+            pdf_filename = os.path.basename(pdf_path)
+            print(f"\n🚀 Procesando '{pdf_filename}' para añadir a '{NOMBRE_DE_CLASE_UNIFICADO}'")
             start_pdf_time = time.time()
+            # UUID de lo ya subido de este PDF, para borrarlo si falla un grupo posterior
+            uploaded_ids = []
 
             try:
-                chunks_info = split_flattened_text_by_size(
-                    flattened_text,
+                chunks_stream = split_pages_by_sentences(
+                    iter_pdf_pages(pdf_path),
                     pdf_filename,
-                    chunk_size=1000, 
-                    chunk_overlap=200 
+                    overlap_sentences=1
                 )
-                if not chunks_info:
+
+                # Los chunks se embeben y suben por grupos según se leen las páginas
+                total_chunks = 0
+                upload_failed = False
+                pending_chunks = []
+                for chunk_info in chunks_stream:
+                    pending_chunks.append(chunk_info)
+                    if len(pending_chunks) < UPLOAD_GROUP_SIZE:
+                        continue
+                    if not embed_and_upload(client, NOMBRE_DE_CLASE_UNIFICADO, pending_chunks, uploaded_ids):
+                        upload_failed = True
+                        break
+                    total_chunks += len(pending_chunks)
+                    pending_chunks = []
+
+                if pending_chunks and not upload_failed:
+                    if embed_and_upload(client, NOMBRE_DE_CLASE_UNIFICADO, pending_chunks, uploaded_ids):
+                        total_chunks += len(pending_chunks)
+                    else:
+                        upload_failed = True
+
+                if upload_failed:
+                    print(f"❌ Falló un grupo de '{pdf_filename}'. Se descarta el PDF entero.")
+                    delete_uploaded_objects(client, NOMBRE_DE_CLASE_UNIFICADO, uploaded_ids, pdf_filename)
+                    total_failed_files += 1
+                    continue
+                if total_chunks == 0:
                     print(f"⚠️ No se generaron chunks de '{pdf_filename}'. Saltando.")
                     total_failed_files += 1
                     continue
 
-                # 3. Generar Embeddings
-                embeddings = embed_text_chunks_batch(chunks_info, model_name)
-                if not embeddings or len(embeddings) != len(chunks_info):
-                     print(f"❌ Error/desajuste en embeddings para '{pdf_filename}'. Saltando subida.")
-                     total_failed_files += 1
-                     continue
-
-                # 4. Subir datos a Weaviate
-                upload_data_to_weaviate(client, NOMBRE_DE_CLASE_UNIFICADO, embeddings, chunks_info)
-
                 total_processed_files += 1
-                print(f"✅ Procesamiento de '{pdf_filename}' completado en {time.time() - start_pdf_time:.2f}s.")
+                print(f"✅ Procesamiento de '{pdf_filename}' ({total_chunks} chunks) completado en {time.time() - start_pdf_time:.2f}s.")
 
             except Exception as e_pdf:
-                print(f"\n❌ Error procesando el PDF individual '{pdf_filename}' después de la extracción: {e_pdf}")
+                print(f"\n❌ Error procesando el PDF individual '{pdf_filename}': {e_pdf}")
                 traceback.print_exc()
+                delete_uploaded_objects(client, NOMBRE_DE_CLASE_UNIFICADO, uploaded_ids, pdf_filename)
                 total_failed_files += 1
                 print(f"⚠️ Saltando '{pdf_filename}' debido a error. Continuando...")
                 continue
@@ -265,7 +333,7 @@ if __name__ == "__main__":
     finally:
         print("\n--- Resumen de Ingesta ---")
         print(f"Total de archivos PDF encontrados: {len(pdf_files)}")
-        print(f"Archivos procesados y (probablemente) subidos con éxito: {total_processed_files}")
+        print(f"Archivos procesados y subidos con éxito: {total_processed_files}")
         print(f"Archivos fallidos o saltados: {total_failed_files}")
         print(f"Duración total del proceso: {time.time() - overall_start_time:.2f} segundos.")
         print("--------------------------")
@@ -2,7 +2,6 @@ import streamlit as st
 import requests
 import json
 import pandas as pd
-import base64
 import os
 import sys
 from datetime import datetime
@@ -16,13 +15,19 @@ API_BRIDGE_URL = "https://nutribot-api-447775611622.europe-west1.run.app"  # API
 # Choose which API to use - you can switch between them for testing
 API_URL = DIRECT_AGENT_URL  # or API_BRIDGE_URL
 
-# Function to download a file
-def get_download_link(file_path, file_name):
-    with open(file_path, "rb") as file:
-        contents = file.read()
-    b64 = base64.b64encode(contents).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="{file_name}">Descargar {file_name}</a>'
-    return href
+# Grocery list export of a session, downloaded from the API (None if the session has none yet).
+# Cached per turn so reruns of the script do not hit the API again.
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_grocery_list(session_id, turn, prices=False, file_format="csv"):
+    try:
+        response = requests.get(
+            f"{API_URL}/sessions/{session_id}/grocery-list",
+            params={"format": file_format, "prices": int(prices)},
+            timeout=30
+        )
+    except requests.RequestException:
+        return None
+    return response.content if response.status_code == 200 else None
 
 # Set page config
 st.set_page_config(
@@ -80,22 +85,17 @@ with st.sidebar:
     # Check for CSV files to download
     st.subheader("Descargar Archivos")
     
-    lista_compra_path = "lista_compra.csv"
-    lista_compra_precio_path = "lista_compra_con_precio.csv"
-    
-    # Also check in nodes directory
-    nodes_lista_compra_path = os.path.join("nodes", "lista_compra.csv")
-    nodes_lista_compra_precio_path = os.path.join("nodes", "lista_compra_con_precio.csv")
-    
-    if os.path.exists(lista_compra_path):
-        st.markdown(get_download_link(lista_compra_path, "lista_compra.csv"), unsafe_allow_html=True)
-    elif os.path.exists(nodes_lista_compra_path):
-        st.markdown(get_download_link(nodes_lista_compra_path, "lista_compra.csv"), unsafe_allow_html=True)
-        
-    if os.path.exists(lista_compra_precio_path):
-        st.markdown(get_download_link(lista_compra_precio_path, "lista_compra_con_precio.csv"), unsafe_allow_html=True)
-    elif os.path.exists(nodes_lista_compra_precio_path):
-        st.markdown(get_download_link(nodes_lista_compra_precio_path, "lista_compra_con_precio.csv"), unsafe_allow_html=True)
+    turn = len(st.session_state.messages)
+    downloads = [
+        ("lista_compra.csv", False, "csv", "text/csv"),
+        ("lista_compra_con_precio.csv", True, "csv", "text/csv"),
+        ("lista_compra_con_precio.xlsx", True, "xlsx",
+         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ]
+    for file_name, prices, file_format, mime in downloads:
+        contents = fetch_grocery_list(st.session_state.session_id, turn, prices, file_format)
+        if contents:
+            st.download_button(f"Descargar {file_name}", contents, file_name=file_name, mime=mime)
     
     # About section
     st.subheader("Sobre nutribot")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The agent modules are imported flat from nodes/, as api.py and main.py do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nodes"))
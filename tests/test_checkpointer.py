@@ -0,0 +1,195 @@
+"""Persistent checkpointer (SQLite stand-in) driven through a small graph over DietState."""
+import copy
+
+import pytest
+from langgraph.graph import END, START, StateGraph
+
+from firestore_checkpointer import (MAX_BATCH_BYTES, FirestoreCheckpointSaver, _BoundedCheckpointSaver,
+                                    create_checkpointer, seed_thread, turn_input)
+from states import DietState, merge_messages
+
+HISTORY = 2
+DIET = {1: {"desayuno": {"avena": (50.0, "g"), "leche": (200.0, "ml")}},
+        2: {"comida": {"lentejas": (80.0, "g")}}}
+
+
+def reply(state: DietState) -> DietState:
+    """Node in the style of the real ones: edits and returns the whole state"""
+    turn = sum(1 for m in state.messages if m["role"] == "user")
+    state.messages.append({"role": "assistant", "content": f"respuesta {turn}"})
+    state.diet = {**DIET, 3: {"cena": {"huevo": (turn, "ud")}}}
+    state.metadata["turns"] = turn
+    return state
+
+
+def build_graph(checkpointer):
+    workflow = StateGraph(DietState)
+    workflow.add_node("reply", reply)
+    workflow.add_edge(START, "reply")
+    workflow.add_edge("reply", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+
+@pytest.fixture
+def sqlite_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "checkpoints.sqlite")
+    monkeypatch.setenv("CHECKPOINT_SQLITE_PATH", path)
+    monkeypatch.setenv("CHECKPOINT_HISTORY", str(HISTORY))
+    return path
+
+
+def run_turns(graph, thread_id, turns):
+    state = None
+    for i in range(turns):
+        state = graph.invoke(turn_input(thread_id, f"mensaje {i}"),
+                             {"configurable": {"thread_id": thread_id}}, durability="exit")
+    return state
+
+
+def config(thread_id):
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+
+
+def test_history_stays_at_the_limit(sqlite_path):
+    checkpointer = create_checkpointer("sqlite")
+    graph = build_graph(checkpointer)
+
+    run_turns(graph, "s1", 6)
+    run_turns(graph, "s2", 1)
+
+    assert len(list(checkpointer.list(config("s1")))) == HISTORY
+    assert len(list(checkpointer.list(config("s2")))) <= HISTORY
+    # The latest checkpoint is the last turn
+    assert checkpointer.get_tuple(config("s1")).checkpoint["channel_values"]["metadata"]["turns"] == 6
+
+
+def test_blobs_are_pruned_after_n_turns(sqlite_path):
+    checkpointer = create_checkpointer("sqlite")
+    graph = build_graph(checkpointer)
+
+    def stored_blobs():
+        return set(checkpointer._query("SELECT channel, version FROM blobs WHERE thread_id = ?", ("s1",)))
+
+    run_turns(graph, "s1", 3)
+    after_three = len(stored_blobs())
+    run_turns(graph, "s1", 7)
+
+    # Only the values some kept checkpoint still points to are left, and they do not grow with the turns
+    index = checkpointer._load_index("s1", "")
+    used = {item for versions in index.values() for item in versions.items()}
+    assert len(index) == HISTORY
+    assert stored_blobs() == used
+    assert len(stored_blobs()) <= after_three
+
+
+def test_metadata_merges_across_turns(sqlite_path):
+    graph = build_graph(create_checkpointer("sqlite"))
+
+    first = run_turns(graph, "s1", 1)
+    later = run_turns(graph, "s1", 2)
+
+    metadata = later["metadata"]
+    assert metadata["created_at"] == first["metadata"]["created_at"]
+    assert metadata["last_active"] >= first["metadata"]["last_active"]
+    assert metadata["session_id"] == "s1"
+    assert metadata["turns"] == 3  # written by the node, kept next to the turn's keys
+
+
+def test_diet_round_trips_across_restarts(sqlite_path):
+    run_turns(build_graph(create_checkpointer("sqlite")), "s1", 2)
+
+    # A new checkpointer on the same file, as after an instance restart
+    state = build_graph(create_checkpointer("sqlite")).get_state({"configurable": {"thread_id": "s1"}}).values
+    assert state["diet"] == {**DIET, 3: {"cena": {"huevo": (2, "ud")}}}
+    assert isinstance(state["diet"][1]["desayuno"]["avena"], tuple)
+    assert [m["seq"] for m in state["messages"]] == [0, 1, 2, 3]
+
+
+def test_seeded_thread_continues_in_the_graph(sqlite_path):
+    checkpointer = create_checkpointer("sqlite")
+    seed_thread(checkpointer, "legacy", {
+        "intolerances": ["lactosa"],
+        "messages": [{"role": "user", "content": "hola", "seq": 0}],
+        "metadata": {"created_at": "2025-01-01T00:00:00"},
+        "message_count": 1,  # not a DietState field
+    })
+
+    state = run_turns(build_graph(checkpointer), "legacy", 1)
+    assert state["intolerances"] == ["lactosa"]
+    assert state["metadata"]["created_at"] == "2025-01-01T00:00:00"
+    assert [m["seq"] for m in state["messages"]] == [0, 1, 2]
+
+
+def test_merge_messages_ignores_copies_of_the_history():
+    history = merge_messages([], [{"role": "user", "content": "hola"}])
+    returned = copy.deepcopy(history) + [{"role": "assistant", "content": "buenas"}]
+
+    merged = merge_messages(history, returned)
+    assert [(m["seq"], m["content"]) for m in merged] == [(0, "hola"), (1, "buenas")]
+
+
+def test_storage_hooks_are_abstract():
+    class Incomplete(_BoundedCheckpointSaver):
+        def _thread_ids(self):
+            return []
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+class RecordingRef:
+    def __init__(self, path, commits):
+        self.path = path
+        self.commits = commits
+
+    def collection(self, name):
+        return RecordingRef(f"{self.path}/{name}", self.commits)
+
+    def document(self, name):
+        return RecordingRef(f"{self.path}/{name}", self.commits)
+
+    def set(self, data):
+        self.commits.append([self.path])
+
+
+class RecordingBatch:
+    def __init__(self, commits):
+        self.commits = commits
+        self.paths = []
+
+    def set(self, ref, data):
+        self.paths.append(ref.path)
+
+    def delete(self, ref):
+        self.paths.append(ref.path)
+
+    def commit(self):
+        self.commits.append(self.paths)
+
+
+class RecordingDb:
+    def __init__(self):
+        self.commits = []
+
+    def batch(self):
+        return RecordingBatch(self.commits)
+
+    def collection(self, name):
+        return RecordingRef(name, self.commits)
+
+
+def test_large_checkpoints_commit_in_batches_before_the_thread_document():
+    db = RecordingDb()
+    saver = FirestoreCheckpointSaver(collection_name="threads", db=db)
+    saver._pack = lambda data: (data, False)  # incompressible values, close to the document limit
+    value = b"x" * 900_000
+    blobs = {(f"canal{i}", "1"): ("bytes", value) for i in range(25)}
+    row = {"checkpoint_id": "c1", "parent_checkpoint_id": None, "checkpoint": ("bytes", b"{}"),
+           "metadata": ("json", "{}"), "channel_versions": {}}
+
+    saver._save_checkpoint("t1", "", row, blobs, drop_ids=[], drop_blobs=[])
+
+    assert len(db.commits) > 2
+    assert sum(len(paths) for paths in db.commits[:-1]) == 26
+    assert all(sum(len(value) for p in paths if "blobs" in p) <= MAX_BATCH_BYTES for paths in db.commits[:-1])
+    assert db.commits[-1] == ["threads/t1"]
@@ -0,0 +1,117 @@
+"""Message numbering of FirestoreSaver, shared by request threads and the write-behind worker."""
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core.exceptions import FailedPrecondition
+
+from firestore_saver import FirestoreSaver
+
+
+def test_concurrent_numbering_hands_out_each_seq_once(monkeypatch):
+    saver = FirestoreSaver(db=object())
+    reads = []
+
+    def stored_message_count(key):
+        reads.append(key)
+        time.sleep(0.01)  # a Firestore read, long enough for the threads to overlap
+        return 4
+
+    monkeypatch.setattr(saver, "_stored_message_count", stored_message_count)
+    states = [{"messages": [{"role": "user", "content": str(i)}]} for i in range(8)]
+    threads = [threading.Thread(target=saver.assign_message_numbers, args=("s1", state)) for state in states]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(state["messages"][0]["seq"] for state in states) == list(range(4, 12))
+    assert reads == ["s1"]
+
+
+def test_stored_messages_are_not_pending_again():
+    saver = FirestoreSaver(db=object())
+    saver._message_counts["s1"] = 0
+    state = {"messages": [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "buenas"}]}
+
+    pending, stored = saver._pending_messages("s1", state)
+    assert [m["seq"] for m in pending] == [0, 1] and stored == 0
+
+    saver._mark_messages_stored("s1", pending)
+    state["messages"].append({"role": "user", "content": "otra"})
+    pending, stored = saver._pending_messages("s1", state)
+    assert [m["seq"] for m in pending] == [2] and stored == 2
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+
+    def set(self, ref, data):
+        pass
+
+    def update(self, ref, changes, option=None):
+        self.db.updates.append((changes, option))
+
+    def commit(self):
+        if self.db.fail_with:
+            raise self.db.fail_with
+        return [SimpleNamespace(update_time="v2")]
+
+
+class FakeDb:
+    """Just enough of firestore.Client for put() to update a document"""
+
+    def __init__(self):
+        self.updates = []
+        self.fail_with = None
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return self
+
+    def document(self, key):
+        return self
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+
+def cached_saver(monkeypatch):
+    saver = FirestoreSaver(db=FakeDb())
+    saver._message_counts["s1"] = 0
+    saver._remember_persisted("s1", {"metadata": {"session_id": "s1"}, "message_count": 0}, "v1")
+    written = []
+    monkeypatch.setattr(saver, "_write_full", lambda key, value, new_messages=(): written.append(key))
+    return saver, written
+
+
+def test_put_updates_the_changed_fields_of_the_cached_version(monkeypatch):
+    saver, written = cached_saver(monkeypatch)
+
+    saver.put("s1", {"messages": [], "metadata": {"session_id": "s1", "turns": 1}})
+    assert saver.db.updates == [({"metadata.turns": 1}, {"last_update_time": "v1"})]
+    assert written == []
+    assert saver.cache_stats()["hits"] == 1
+    assert saver._cache.get("s1")[1] == "v2"
+
+
+def test_put_rewrites_a_session_written_elsewhere(monkeypatch):
+    saver, written = cached_saver(monkeypatch)
+    saver.db.fail_with = FailedPrecondition("updated by another instance")
+
+    saver.put("s1", {"messages": [], "metadata": {"session_id": "s1", "turns": 1}})
+    assert written == ["s1"]
+    assert saver.cache_stats()["stale"] == 1
+
+
+def test_put_without_a_cached_version_writes_the_whole_document(monkeypatch):
+    saver, written = cached_saver(monkeypatch)
+    saver._cache.invalidate("s1")  # evicted
+    saver._message_counts["s1"] = 0
+
+    saver.put("s1", {"messages": [], "metadata": {"session_id": "s1", "turns": 1}})
+    assert written == ["s1"]
+    assert saver.db.updates == []
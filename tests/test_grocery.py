@@ -0,0 +1,22 @@
+"""Ingredient keys and quantity consolidation of the grocery list (grocery.py)."""
+import pytest
+
+from grocery import GroceryItem, consolidate, ingredient_key
+
+
+@pytest.mark.parametrize("name, key", [
+    ("Nueces", "nuez"),
+    ("Raíces de jengibre", "raiz jengibre"),
+    ("Dulces", "dulce"),
+    ("Tomates frescos", "tomate"),
+    ("Limones", "limon"),
+    ("Papas", "patata"),
+])
+def test_ingredient_key(name, key):
+    assert ingredient_key(name) == key
+
+
+def test_consolidate_sums_the_same_ingredient():
+    items = consolidate([GroceryItem("Nueces", 100, "g"), GroceryItem("nuez", 0.2, "kg"),
+                         GroceryItem("Dulces", 2, "ud")])
+    assert [(item.name, item.quantity, item.unit) for item in items] == [("Nueces", 300.0, "g"), ("Dulces", 2.0, "ud")]
@@ -0,0 +1,59 @@
+"""Budget fitting of the priced basket (presupuesto.optimizar_cesta) on hand-made candidates."""
+import pandas as pd
+
+from presupuesto import filtrar_prohibidos, optimizar_cesta
+
+
+def candidates(names):
+    return pd.DataFrame({"item": range(len(names)), "rank": 0, "name": names,
+                         "cost": 1.0, "score": 0.9})
+
+
+def test_forbidden_foods_match_whole_words():
+    basket = candidates(["Sal marina", "Salmón ahumado", "Huevos camperos", "Patatas fritas", "Leche de vaca"])
+
+    kept = filtrar_prohibidos(basket, ["sal", "huevo", "papa"])
+    assert kept["name"].tolist() == ["Salmón ahumado", "Leche de vaca"]
+
+
+def test_no_forbidden_foods_keeps_every_candidate():
+    basket = candidates(["Sal marina", "Salmón ahumado"])
+
+    assert filtrar_prohibidos(basket, []).equals(basket)
+    assert filtrar_prohibidos(basket, ["", "  "]).equals(basket)
+
+
+def menu(rows):
+    """Candidates as (item, rank, name, cost, score) tuples"""
+    return pd.DataFrame(rows, columns=["item", "rank", "name", "cost", "score"])
+
+
+def test_budget_only_swaps_to_close_substitutes():
+    basket = menu([
+        (0, 0, "Salmón fresco", 12.0, 0.90),
+        (0, 1, "Salmón ahumado", 8.0, 0.84),     # within the score margin
+        (0, 2, "Merluza", 3.0, 0.70),            # cheaper, but another fish
+        (1, 0, "Tomate pera", 2.0, 0.80),
+        (1, 1, "Tomate cherry", 1.0, 0.40),      # far in score, same ingredient
+    ])
+
+    ajuste = optimizar_cesta(basket, 9.5, claves={0: "salmon", 1: "tomate"})
+    assert ajuste["elegidos"]["name"].to_dict() == {0: "Salmón ahumado", 1: "Tomate cherry"}
+    assert ajuste["fits"]
+    assert [(s["de"], s["a"]) for s in ajuste["swaps"]] == [("Salmón fresco", "Salmón ahumado"),
+                                                           ("Tomate pera", "Tomate cherry")]
+    assert ajuste["cambios_sugeridos"] == []
+
+
+def test_unrelated_products_are_only_suggested():
+    basket = menu([
+        (0, 0, "Salmón fresco", 12.0, 0.90),
+        (0, 1, "Merluza", 3.0, 0.70),
+        (1, 0, "Tomate pera", 2.0, 0.80),
+    ])
+
+    ajuste = optimizar_cesta(basket, 10.0, claves={0: "salmon", 1: "tomate"})
+    assert ajuste["elegidos"]["name"].to_dict() == {0: "Salmón fresco", 1: "Tomate pera"}
+    assert not ajuste["fits"]
+    assert ajuste["swaps"] == []
+    assert ajuste["cambios_sugeridos"] == [{"item": 0, "de": "Salmón fresco", "a": "Merluza", "ahorro": 9.0}]